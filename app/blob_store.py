@@ -0,0 +1,236 @@
+"""
+按内容寻址的上传文件存储
+
+上传文件按 sha256 保存一份在 data/blobs/<前两位>/<sha256><扩展名>，只读。
+入库时自己写出的临时文件直接重命名（跨文件系统时复制）；不属于存储的源文件（如 Chainlit 的临时文件）
+复制一份（文件系统支持时用 reflink 写时复制），不和源文件共用 inode，改为只读不会影响源文件。
+同样内容重复上传不会再占空间。
+对外使用的路径是 data/uploads/<sha256 前 16 位>/<原文件名> 的硬链接，生成的代码看到的仍是原文件名。
+执行内核的工作目录中放的也是只读硬链接（不支持时用符号链接），不再逐步复制文件。
+HTTP 上传按块异步写入临时文件并同时计算哈希，内存占用与文件大小无关；
+超过大小上限（或配置了扩展名白名单而不在其中）的上传在读取内容之前（或一旦超出）就被拒绝。
+列式缓存、概况分析、编码探测、样本和结果缓存都按同一个内容哈希缓存。
+"""
+import os
+import re
+import time
+import asyncio
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from typing import AsyncIterator, Dict, Iterable, Optional, Any
+
+import aiofiles
+
+from app.result_cache import record_file_digest
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BLOB_DIR = os.path.join(PROJECT_ROOT, "data", "blobs")
+UPLOAD_DIR = os.path.join(PROJECT_ROOT, "data", "uploads")
+
+HASH_CHUNK_BYTES = 1024 * 1024
+READ_ONLY_MODE = 0o444
+# Linux 的 FICLONE ioctl：btrfs、xfs 等支持写时复制的文件系统上复制文件不实际复制数据
+FICLONE = 0x40049409
+
+UPLOAD_MAX_BYTES = int(os.getenv("IDA_UPLOAD_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# 允许上传的扩展名（逗号分隔，如 ".csv,.xlsx"）；为空时不限制类型，与之前接受任意文件的行为一致
+UPLOAD_EXTENSIONS = {
+    ext if ext.startswith(".") else f".{ext}"
+    for ext in (item.strip().lower() for item in os.getenv("IDA_UPLOAD_EXTENSIONS", "").split(","))
+    if ext
+}
+
+
+class UploadRejected(ValueError):
+    """上传不符合要求；status_code 为对应的 HTTP 状态码"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def safe_filename(name: Optional[str]) -> str:
+    """去掉路径部分和不适合做文件名的字符，保留中文"""
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    name = re.sub(r'[\x00-\x1f<>:"/\\|?*]', "_", name)
+    return name.lstrip(".") or "upload"
+
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def blob_path(digest: str, ext: str = "") -> str:
+    return os.path.join(BLOB_DIR, digest[:2], f"{digest}{ext.lower()}")
+
+
+def _copy(source: str, dest: str):
+    """复制文件，文件系统支持时用 reflink"""
+    try:
+        import fcntl
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(source, dest)
+
+
+def _place(source: str, dest: str, move: bool):
+    """
+    把文件放到 dest 并设为只读：move 时重命名（跨文件系统时复制），否则复制
+
+    不属于存储的源文件不能硬链接：链接与源文件共用 inode，chmod 会把源文件也改成只读。
+    """
+    tmp_path = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if move:
+        try:
+            os.replace(source, tmp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            _copy(source, tmp_path)
+            os.remove(source)
+    else:
+        _copy(source, tmp_path)
+    os.chmod(tmp_path, READ_ONLY_MODE)
+    os.replace(tmp_path, dest)
+
+
+def _link(target: str, dest: str):
+    """在 dest 创建指向 target 的硬链接，不支持时用符号链接"""
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(target, dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(target, dest)
+    except OSError:
+        os.symlink(target, dest)
+
+
+def ingest_file(
+    source: str,
+    original_name: Optional[str] = None,
+    move: bool = False,
+    digest: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    把文件存入内容寻址存储
+
+    Args:
+        source: 待入库的文件
+        original_name: 原文件名，决定对外路径的文件名和扩展名
+        move: 为 True 时 source 会被移走（上传时写出的临时文件），否则复制一份，source 保持不变
+        digest: 调用方已在写入时计算好的 sha256，省去再读一遍文件
+
+    Returns:
+        {"file_path", "blob_path", "digest", "size", "deduplicated"}
+    """
+    name = safe_filename(original_name or os.path.basename(source))
+    digest = digest or hash_file(source)
+    blob = blob_path(digest, os.path.splitext(name)[1])
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+    deduplicated = os.path.exists(blob)
+    if deduplicated:
+        if move:
+            os.remove(source)
+    else:
+        _place(source, blob, move)
+
+    upload_dir = os.path.join(UPLOAD_DIR, digest[:16])
+    os.makedirs(upload_dir, exist_ok=True)
+    file_path = os.path.join(upload_dir, name)
+    _link(blob, file_path)
+
+    size = os.path.getsize(blob)
+    record_file_digest(file_path, digest)
+    record_file_digest(blob, digest)
+    logger.info(
+        f"上传文件已入库: {name} -> {blob}（{size} 字节"
+        + ("，内容已存在，未重复保存" if deduplicated else "")
+        + "）"
+    )
+    return {
+        "file_path": file_path,
+        "blob_path": blob,
+        "digest": digest,
+        "size": size,
+        "deduplicated": deduplicated,
+    }
+
+
+def ingest_bytes(content: bytes, original_name: Optional[str]) -> Dict[str, Any]:
+    """把内存中的上传内容写入临时文件后入库"""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp_path = os.path.join(BLOB_DIR, f"incoming.{os.getpid()}.{threading.get_ident()}.{time.time_ns()}")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    try:
+        return ingest_file(tmp_path, original_name, move=True, digest=hashlib.sha256(content).hexdigest())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def check_upload(
+    original_name: Optional[str],
+    size: Optional[int] = None,
+    max_bytes: int = UPLOAD_MAX_BYTES,
+    extensions: Iterable[str] = UPLOAD_EXTENSIONS,
+):
+    """读取内容之前检查扩展名（extensions 为空时不限制）和（已知的）大小"""
+    ext = os.path.splitext(original_name or "")[1].lower()
+    if extensions and ext not in extensions:
+        raise UploadRejected(f"不支持的文件类型: {ext or '无扩展名'}", 415)
+    if size is not None and size > max_bytes:
+        raise UploadRejected(f"文件大小 {size} 字节超过上限 {max_bytes} 字节", 413)
+
+
+async def ingest_stream(
+    chunks: AsyncIterator[bytes],
+    original_name: Optional[str],
+    max_bytes: int = UPLOAD_MAX_BYTES,
+) -> Dict[str, Any]:
+    """
+    按块异步写入上传内容并同时计算哈希，写完后移动入库
+
+    超过 max_bytes 时立即停止读取并删除已写入的部分。
+    """
+    check_upload(original_name, max_bytes=max_bytes)
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp_path = os.path.join(BLOB_DIR, f"incoming.{os.getpid()}.{threading.get_ident()}.{time.time_ns()}")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(f"文件大小超过上限 {max_bytes} 字节", 413)
+                hasher.update(chunk)
+                await f.write(chunk)
+        return await asyncio.to_thread(ingest_file, tmp_path, original_name, True, hasher.hexdigest())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def link_into(file_path: Optional[str], workspace: str) -> Optional[str]:
+    """在执行工作目录中放入上传文件的只读链接，返回链接路径"""
+    if not file_path or not os.path.exists(file_path):
+        return None
+    dest = os.path.join(workspace, os.path.basename(file_path))
+    _link(os.path.realpath(file_path), dest)
+    return dest
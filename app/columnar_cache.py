@@ -0,0 +1,235 @@
+"""
+上传文件的列式缓存
+
+上传完成后在后台把 CSV/Excel 转换一次为 Arrow IPC（Feather v2，不压缩）文件，
+Excel 的每个工作表各一个文件，按原文件内容哈希保存在 data/cache/columnar/<sha256> 目录中，
+内容相同的上传只转换一次。
+列类型在转换时推断好，不压缩的 IPC 文件可以直接内存映射（pyarrow.feather.read_table(path, memory_map=True)），
+之后的每个执行步骤不必再反复解析 CSV/Excel。
+manifest.json 最后写入，存在即表示缓存可用。
+"""
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, Any
+
+from app.sniffer import sniff_file
+from app.result_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+COLUMNAR_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "columnar")
+
+COLUMNAR_CACHE_ENABLED = os.getenv("IDA_COLUMNAR_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+# 小于该大小的文件直接读取原文件即可，不做转换
+COLUMNAR_MIN_BYTES = int(os.getenv("IDA_COLUMNAR_MIN_BYTES", str(1024 * 1024)))
+
+CSV_EXTENSIONS = {".csv", ".tsv"}
+EXCEL_EXTENSIONS = {".xlsx", ".xlsm", ".xls"}
+MANIFEST_NAME = "manifest.json"
+# 转换格式变化时递增，使旧缓存失效
+CACHE_VERSION = 1
+
+
+def cache_dir_for(file_path: str) -> str:
+    """按原文件内容哈希确定的缓存目录"""
+    return os.path.join(COLUMNAR_DIR, file_digest(file_path))
+
+
+def is_convertible(file_path: Optional[str]) -> bool:
+    if not file_path:
+        return False
+    return os.path.splitext(file_path)[1].lower() in CSV_EXTENSIONS | EXCEL_EXTENSIONS
+
+
+def safe_name(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", str(name)) or "sheet"
+
+
+def table_from_frame(frame):
+    """DataFrame 转 Arrow 表；混合类型的 object 列转为字符串"""
+    import pyarrow as pa
+
+    frame.columns = [str(column) for column in frame.columns]
+    try:
+        return pa.Table.from_pandas(frame, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        for column in frame.columns:
+            if frame[column].dtype == object:
+                frame[column] = frame[column].astype("string")
+        return pa.Table.from_pandas(frame, preserve_index=False)
+
+
+def write_table(table, dest: str) -> Dict[str, Any]:
+    import pyarrow.feather as feather
+
+    feather.write_feather(table, dest, compression="uncompressed")
+    return {"rows": table.num_rows, "columns": table.num_columns}
+
+
+def _convert_csv(file_path: str, dest: str) -> Dict[str, Any]:
+    """CSV 按探测出的编码和分隔符用 pyarrow 多线程解析；类型推断失败时退回 pandas"""
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    sniffed = sniff_file(file_path)
+    encoding, delimiter = sniffed["encoding"], sniffed["delimiter"]
+    try:
+        table = pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(encoding=encoding),
+            parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+        )
+        return dict(write_table(table, dest), encoding=encoding, engine="pyarrow")
+    except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+        logger.debug(f"pyarrow 解析 {file_path} 失败，改用 pandas: {e}")
+
+    import pandas as pd
+
+    frame = pd.read_csv(file_path, sep=delimiter, encoding=encoding, encoding_errors="replace")
+    return dict(write_table(table_from_frame(frame), dest), encoding=encoding, engine="pandas")
+
+
+def _convert_excel(file_path: str, cache_dir: str) -> List[Dict[str, Any]]:
+    """Excel 每个工作表转换为一个文件"""
+    import pandas as pd
+
+    sheets = []
+    for index, (sheet_name, frame) in enumerate(pd.read_excel(file_path, sheet_name=None).items()):
+        dest = os.path.join(cache_dir, f"{index:02d}_{safe_name(sheet_name)}.feather")
+        info = write_table(table_from_frame(frame), dest)
+        sheets.append(dict(info, sheet=str(sheet_name), path=dest))
+    return sheets
+
+
+def read_manifest(file_path: Optional[str]) -> Optional[Dict[str, Any]]:
+    """读取已完成的缓存清单；转换格式变化后返回 None"""
+    if not file_path or not os.path.exists(file_path):
+        return None
+    manifest_path = os.path.join(cache_dir_for(file_path), MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CACHE_VERSION:
+        return None
+    if not all(os.path.exists(sheet["path"]) for sheet in manifest.get("sheets", [])):
+        return None
+    return manifest
+
+
+def convert_file(file_path: str) -> Dict[str, Any]:
+    """把上传文件转换为列式缓存，返回缓存清单"""
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        return manifest
+
+    cache_dir = cache_dir_for(file_path)
+    tmp_dir = f"{cache_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    started = time.time()
+    try:
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in EXCEL_EXTENSIONS:
+            sheets = _convert_excel(file_path, tmp_dir)
+        else:
+            info = _convert_csv(file_path, os.path.join(tmp_dir, "data.feather"))
+            sheets = [dict(info, sheet=None, path=os.path.join(tmp_dir, "data.feather"))]
+
+        # 临时目录整体替换正式目录，路径随之改写
+        for sheet in sheets:
+            sheet["path"] = os.path.join(cache_dir, os.path.basename(sheet["path"]))
+        manifest = {
+            "version": CACHE_VERSION,
+            "digest": os.path.basename(cache_dir),
+            "format": "feather",
+            "sheets": sheets,
+            "convert_time": round(time.time() - started, 3),
+        }
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+        with open(os.path.join(cache_dir, MANIFEST_NAME + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(os.path.join(cache_dir, MANIFEST_NAME + ".tmp"), os.path.join(cache_dir, MANIFEST_NAME))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.info(
+        f"列式缓存已生成: {file_path} -> {cache_dir}，"
+        f"{len(sheets)} 个表，耗时 {manifest['convert_time']:.2f}s"
+    )
+    return manifest
+
+
+class ColumnarCache:
+    """在后台线程中转换上传文件，同一文件只转换一次"""
+
+    def __init__(self, enabled: bool = COLUMNAR_CACHE_ENABLED, min_bytes: int = COLUMNAR_MIN_BYTES):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="columnar-cache")
+        self.lock = threading.Lock()
+        self.futures: Dict[str, Future] = {}
+
+    def _run(self, file_path: str) -> Optional[Dict[str, Any]]:
+        try:
+            return convert_file(file_path)
+        except ImportError as e:
+            logger.warning(f"未安装 pyarrow，跳过列式缓存: {e}")
+        except Exception as e:
+            logger.error(f"生成列式缓存失败: {file_path}: {e}")
+        return None
+
+    def submit(self, file_path: Optional[str]) -> Optional[Future]:
+        """提交后台转换任务（不满足条件时返回 None）"""
+        if not self.enabled or not is_convertible(file_path) or not os.path.exists(file_path):
+            return None
+        if os.path.getsize(file_path) < self.min_bytes:
+            return None
+        key = os.path.abspath(file_path)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.result() is None and read_manifest(key) is None):
+                future = self.executor.submit(self._run, key)
+                self.futures[key] = future
+        return future
+
+    def get(self, file_path: Optional[str], wait: float = 0) -> Optional[Dict[str, Any]]:
+        """返回已完成的缓存清单；wait > 0 时最多等待转换完成这么多秒"""
+        if not self.enabled or not file_path:
+            return None
+        future = self.futures.get(os.path.abspath(file_path))
+        if future is not None and wait > 0:
+            try:
+                future.result(timeout=wait)
+            except Exception:
+                pass
+        return read_manifest(file_path)
+
+
+def describe_for_prompt(manifest: Optional[Dict[str, Any]]) -> str:
+    """提示词中的快速读取说明"""
+    if not manifest:
+        return ""
+    lines = [
+        "列式缓存（与原文件内容相同、列类型已推断，读取速度远快于 read_csv/read_excel，请优先使用；"
+        "可用 columns=[...] 只读取需要的列）:"
+    ]
+    for sheet in manifest["sheets"]:
+        label = f"工作表 {sheet['sheet']!r}" if sheet.get("sheet") is not None else "数据"
+        lines.append(
+            f"- {label}（{sheet['rows']} 行 × {sheet['columns']} 列）: "
+            f"pd.read_feather(r'{sheet['path']}')"
+        )
+    return "\n".join(lines)
+
+
+columnar_cache = ColumnarCache()
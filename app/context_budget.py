@@ -0,0 +1,164 @@
+"""
+上下文 token 预算
+
+分析步骤较多、观察结果较长时，发送给模型的上下文会越来越大，甚至超过模型窗口。
+这里按 token 预算压缩较早步骤的观察结果（最新一步始终保留完整内容）：
+- 第一级：保留错误信息、图表路径、开头和结尾几行，其余行中优先保留含数字的行
+- 第二级：仍超出预算时，进一步压缩为很短的摘要（错误信息与图表路径仍然原样保留）
+
+ReAct 循环中压缩结果记录在步骤的 prompt_observation 中，之后的步骤继续发送同样的内容，
+只有新压缩的步骤之后的消息会变化。生成报告时同样按预算压缩较早的执行结果。
+"""
+import os
+import re
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from app.token_counter import count_tokens, message_tokens
+
+logger = logging.getLogger(__name__)
+
+# 每次调用模型的输入 token 预算（模型窗口还需留出输出的空间）
+CONTEXT_MAX_TOKENS = int(os.getenv("IDA_CONTEXT_MAX_TOKENS", "64000"))
+# 第一级压缩后每条观察结果的 token 上限
+COMPACT_OBSERVATION_TOKENS = int(os.getenv("IDA_COMPACT_OBSERVATION_TOKENS", "600"))
+# 第二级压缩（摘要）后的 token 上限
+SUMMARY_OBSERVATION_TOKENS = 120
+
+HEAD_LINES = 3
+TAIL_LINES = 3
+MAX_LINE_CHARS = 300
+_ALWAYS_KEEP = re.compile(r"Traceback|Error|Exception|错误|失败|警告|Warning|PLOT_PATH::")
+_HAS_NUMBER = re.compile(r"\d")
+
+
+def _clip(line: str) -> str:
+    return line if len(line) <= MAX_LINE_CHARS else line[:MAX_LINE_CHARS] + "..."
+
+
+def compact_text(text: str, max_tokens: int) -> str:
+    """
+    把一段输出压缩到大约 max_tokens 个 token
+
+    错误信息和图表路径所在的行总是原样保留（可能因此超出上限），
+    其次保留开头和结尾几行，再按顺序补充含数字的行；省略的部分用一行说明代替。
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines()
+    keep = set()
+    used = 0
+
+    def add(index: int, force: bool = False) -> bool:
+        nonlocal used
+        if index in keep:
+            return True
+        cost = count_tokens(_clip(lines[index])) + 1
+        if not force and used + cost > max_tokens:
+            return False
+        keep.add(index)
+        used += cost
+        return True
+
+    for index, line in enumerate(lines):
+        if _ALWAYS_KEEP.search(line):
+            add(index, force=True)
+    edges = list(range(min(HEAD_LINES, len(lines)))) + list(range(max(0, len(lines) - TAIL_LINES), len(lines)))
+    for index in edges:
+        add(index)
+    for index, line in enumerate(lines):
+        if _HAS_NUMBER.search(line) and not add(index):
+            break
+
+    result: List[str] = []
+    skipped = 0
+    for index, line in enumerate(lines):
+        if index in keep:
+            if skipped:
+                result.append(f"...（省略 {skipped} 行）")
+                skipped = 0
+            result.append(_clip(line))
+        else:
+            skipped += 1
+    if skipped:
+        result.append(f"...（省略 {skipped} 行）")
+    return "\n".join(result)
+
+
+def compact_steps(
+    steps: List[Dict[str, Any]],
+    available: int,
+    render: Callable[[Dict[str, Any]], Sequence[BaseMessage]],
+) -> Optional[Dict[str, Any]]:
+    """
+    压缩较早步骤的观察结果，使这些步骤的消息不超过 available 个 token
+
+    压缩结果写入步骤的 prompt_observation（render 应优先使用它），压缩级别记录在
+    compact_level 中，已压缩的步骤不会重复处理。最新一步不压缩。
+
+    Returns:
+        本次发生压缩时返回 {"before_tokens", "after_tokens", "budget", "compacted_steps"}，否则返回 None
+    """
+    sizes = [sum(message_tokens(message) for message in render(step)) for step in steps]
+    before = sum(sizes)
+    if before <= available or len(steps) < 2:
+        return None
+
+    total = before
+    compacted = set()
+    for level, cap in ((1, COMPACT_OBSERVATION_TOKENS), (2, SUMMARY_OBSERVATION_TOKENS)):
+        for index, step in enumerate(steps[:-1]):
+            if total <= available:
+                break
+            if step.get("compact_level", 0) >= level or not step.get("observation"):
+                continue
+            step["prompt_observation"] = compact_text(step["observation"], cap)
+            step["compact_level"] = level
+            size = sum(message_tokens(message) for message in render(step))
+            total += size - sizes[index]
+            sizes[index] = size
+            compacted.add(index)
+    if not compacted:
+        return None
+
+    info = {"before_tokens": before, "after_tokens": total, "budget": available, "compacted_steps": len(compacted)}
+    logger.info(
+        f"上下文压缩: 压缩 {len(compacted)} 个步骤的观察结果，步骤消息 {before} → {total} token（预算 {available}）"
+    )
+    return info
+
+
+def compact_texts(texts: List[str], available: int) -> Tuple[List[str], Optional[Dict[str, Any]]]:
+    """
+    按预算压缩一组文本（例如报告用的各步骤执行结果），最后一条保留完整内容
+
+    Returns:
+        (压缩后的文本, 压缩信息或 None)
+    """
+    sizes = [count_tokens(text) for text in texts]
+    before = sum(sizes)
+    if before <= available or len(texts) < 2:
+        return texts, None
+
+    result = list(texts)
+    total = before
+    compacted = set()
+    for cap in (COMPACT_OBSERVATION_TOKENS, SUMMARY_OBSERVATION_TOKENS):
+        for index in range(len(result) - 1):
+            if total <= available:
+                break
+            if sizes[index] <= cap:
+                continue
+            result[index] = compact_text(result[index], cap)
+            size = count_tokens(result[index])
+            total += size - sizes[index]
+            sizes[index] = size
+            compacted.add(index)
+    if not compacted:
+        return texts, None
+
+    info = {"before_tokens": before, "after_tokens": total, "budget": available, "compacted_steps": len(compacted)}
+    logger.info(f"报告上下文压缩: 压缩 {len(compacted)} 条执行结果，{before} → {total} token（预算 {available}）")
+    return result, info
@@ -0,0 +1,312 @@
+"""
+data/ 目录的容量回收
+
+后台线程定期统计 data/ 的总大小，超过预算时按最近使用时间（LRU）删除条目，直到回落到预算的 90%。
+一个条目是可以整体删除的一组文件：
+- 上传文件：blob、data/uploads 下的链接，以及按同一内容哈希生成的列式缓存、概况、编码探测结果和样本
+- 图表：原图与缩略图
+- 被截断输出的完整内容文件、SQL 查询结果文件，以及旧版直接保存在 data/ 下的上传文件
+
+正在使用的会话（Chainlit 线程 metadata["file_path"]、进行中的 API 请求）登记的文件不会被删除，
+最近 JANITOR_MIN_AGE 秒内用过的条目也不会被删除。执行结果缓存（data/cache/exec）与大模型回复缓存
+（data/cache/llm）有各自的容量上限，这里只计入总大小。被删除文件的会话恢复时会提示文件已被清理，需要重新上传。
+"""
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import Dict, List, Optional, Any, Set, Tuple
+
+from app.blob_store import BLOB_DIR, UPLOAD_DIR
+from app.columnar_cache import COLUMNAR_DIR
+from app.profiler import PROFILE_DIR
+from app.sniffer import SNIFF_DIR
+from app.large_file import SAMPLE_DIR
+from app.sql_engine import SQL_DIR
+from app.plot_store import PLOTS_DIR, THUMBS_DIR
+from app.output_capture import ARTIFACTS_DIR, artifact_dir_for
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DATA_DIR = os.path.join(PROJECT_ROOT, "data")
+
+DATA_MAX_BYTES = int(os.getenv("IDA_DATA_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+JANITOR_INTERVAL = int(os.getenv("IDA_JANITOR_INTERVAL", "600"))
+# 最近这么多秒内用过的条目不删除，避免删掉刚上传、尚未登记的文件
+JANITOR_MIN_AGE = int(os.getenv("IDA_JANITOR_MIN_AGE", "600"))
+# 超出预算后删除到预算的这个比例，避免每次只删一点反复触发
+LOW_WATER_RATIO = 0.9
+
+
+def touch(file_path: Optional[str]):
+    """
+    记录文件被使用：只更新访问时间
+
+    修改时间保持不变，内容哈希的记忆（按大小和修改时间）仍然有效。
+    """
+    if not file_path:
+        return
+    try:
+        stat = os.stat(file_path)
+        os.utime(file_path, ns=(time.time_ns(), stat.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def _last_used(stat: os.stat_result) -> float:
+    return max(stat.st_atime, stat.st_mtime)
+
+
+def _tree_size(path: str, seen: Set[Tuple[int, int]]) -> int:
+    """文件或目录的大小，硬链接只计算一次"""
+    paths = [path]
+    if os.path.isdir(path) and not os.path.islink(path):
+        paths = [os.path.join(root, name) for root, _, files in os.walk(path) for name in files]
+    total = 0
+    for item in paths:
+        try:
+            stat = os.lstat(item)
+        except OSError:
+            continue
+        key = (stat.st_dev, stat.st_ino)
+        if key in seen:
+            continue
+        seen.add(key)
+        total += stat.st_size
+    return total
+
+
+def _is_temporary(name: str) -> bool:
+    return name.endswith(".tmp") or name.startswith("incoming.")
+
+
+class Janitor:
+    """按总大小预算回收 data/ 目录，记录回收的字节数"""
+
+    def __init__(
+        self,
+        data_dir: str = DATA_DIR,
+        max_bytes: int = DATA_MAX_BYTES,
+        interval: int = JANITOR_INTERVAL,
+        min_age: int = JANITOR_MIN_AGE,
+    ):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.min_age = min_age
+        self.lock = threading.Lock()
+        # 使用者（会话 ID 或请求 ID）-> 登记的文件路径
+        self.pins: Dict[str, Set[str]] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.stats = {
+            "runs": 0,
+            "evicted_entries": 0,
+            "evicted_files": 0,
+            "bytes_reclaimed": 0,
+            "skipped_pinned": 0,
+            "resume_missing": 0,
+            "errors": 0,
+            "last_run": None,
+            "last_total_bytes": 0,
+            "last_duration": 0.0,
+        }
+
+    # ---------- 登记正在使用的文件 ----------
+
+    def pin(self, file_path: Optional[str], owner: str):
+        """登记 owner 正在使用的文件，在 release(owner) 之前不会被删除"""
+        if not file_path:
+            return
+        with self.lock:
+            self.pins.setdefault(owner, set()).add(os.path.abspath(file_path))
+        touch(file_path)
+
+    def release(self, owner: str):
+        with self.lock:
+            self.pins.pop(owner, None)
+
+    def record_resume_missing(self):
+        """会话恢复时发现关联文件已被删除"""
+        with self.lock:
+            self.stats["resume_missing"] += 1
+
+    def _pinned(self) -> Tuple[Set[Tuple[int, int]], Set[str]]:
+        """登记文件的 (设备, inode)（硬链接指向同一个 blob）和使用者的输出目录"""
+        with self.lock:
+            owners = list(self.pins)
+            paths = [path for group in self.pins.values() for path in group]
+        inodes = set()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            inodes.add((stat.st_dev, stat.st_ino))
+        return inodes, {artifact_dir_for(owner) for owner in owners}
+
+    # ---------- 条目收集 ----------
+
+    def _upload_entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        if not os.path.isdir(BLOB_DIR):
+            return entries
+        for root, _, files in os.walk(BLOB_DIR):
+            for name in files:
+                if _is_temporary(name):
+                    continue
+                blob = os.path.join(root, name)
+                digest = os.path.splitext(name)[0]
+                try:
+                    stat = os.stat(blob)
+                except OSError:
+                    continue
+                entries.append({
+                    "kind": "upload",
+                    "paths": [
+                        blob,
+                        os.path.join(UPLOAD_DIR, digest[:16]),
+                        os.path.join(COLUMNAR_DIR, digest),
+                        os.path.join(PROFILE_DIR, f"{digest}.json"),
+                        os.path.join(SNIFF_DIR, f"{digest}.json"),
+                        os.path.join(SAMPLE_DIR, digest),
+                    ],
+                    "last_used": _last_used(stat),
+                    "inode": (stat.st_dev, stat.st_ino),
+                })
+        return entries
+
+    def _file_entries(self, kind: str, directory: str, recursive: bool = False) -> List[Dict[str, Any]]:
+        entries = []
+        if not os.path.isdir(directory):
+            return entries
+        walker = os.walk(directory) if recursive else [(directory, None, os.listdir(directory))]
+        for root, _, names in walker:
+            for name in names:
+                path = os.path.join(root, name)
+                if _is_temporary(name) or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                paths = [path]
+                if kind == "plot":
+                    paths.append(os.path.join(THUMBS_DIR, name))
+                elif kind == "legacy_upload":
+                    # 旧版列式缓存保存在原文件旁
+                    paths.append(path + ".columnar")
+                entries.append({
+                    "kind": kind,
+                    "paths": paths,
+                    "last_used": _last_used(stat),
+                    "inode": (stat.st_dev, stat.st_ino),
+                    "dir": root,
+                })
+        return entries
+
+    def _entries(self) -> List[Dict[str, Any]]:
+        return (
+            self._upload_entries()
+            + self._file_entries("legacy_upload", self.data_dir)
+            + self._file_entries("plot", PLOTS_DIR)
+            + self._file_entries("artifact", ARTIFACTS_DIR, recursive=True)
+            + self._file_entries("sql_result", SQL_DIR)
+        )
+
+    # ---------- 回收 ----------
+
+    def _remove(self, path: str) -> int:
+        if not os.path.lexists(path):
+            return 0
+        count = sum(len(files) for _, _, files in os.walk(path)) if os.path.isdir(path) else 1
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return count
+
+    def collect(self) -> Dict[str, Any]:
+        """执行一次回收，返回本次的统计"""
+        started = time.time()
+        seen: Set[Tuple[int, int]] = set()
+        entries = self._entries()
+        for entry in entries:
+            entry["size"] = sum(_tree_size(path, seen) for path in entry["paths"])
+        # 其余文件（执行结果缓存等）只计入总大小
+        total = sum(entry["size"] for entry in entries) + _tree_size(self.data_dir, seen)
+
+        summary = {"total_bytes": total, "evicted_entries": 0, "evicted_files": 0, "bytes_reclaimed": 0, "skipped_pinned": 0}
+        if total > self.max_bytes:
+            target = self.max_bytes * LOW_WATER_RATIO
+            pinned_inodes, live_dirs = self._pinned()
+            cutoff = time.time() - self.min_age
+            for entry in sorted(entries, key=lambda e: e["last_used"]):
+                if total <= target:
+                    break
+                if entry["last_used"] > cutoff:
+                    continue
+                if entry["inode"] in pinned_inodes or entry.get("dir") in live_dirs:
+                    summary["skipped_pinned"] += 1
+                    continue
+                try:
+                    files = sum(self._remove(path) for path in entry["paths"])
+                except OSError as e:
+                    logger.warning(f"清理 {entry['paths'][0]} 失败: {e}")
+                    with self.lock:
+                        self.stats["errors"] += 1
+                    continue
+                total -= entry["size"]
+                summary["evicted_entries"] += 1
+                summary["evicted_files"] += files
+                summary["bytes_reclaimed"] += entry["size"]
+                logger.info(f"容量回收: 删除{entry['kind']} {entry['paths'][0]}（{entry['size']} 字节）")
+
+        duration = round(time.time() - started, 3)
+        with self.lock:
+            self.stats["runs"] += 1
+            for name in ("evicted_entries", "evicted_files", "bytes_reclaimed", "skipped_pinned"):
+                self.stats[name] += summary[name]
+            self.stats["last_run"] = started
+            self.stats["last_total_bytes"] = total
+            self.stats["last_duration"] = duration
+        if summary["evicted_entries"]:
+            logger.info(
+                f"容量回收完成: 删除 {summary['evicted_entries']} 个条目，回收 {summary['bytes_reclaimed']} 字节，"
+                f"当前 {total} 字节 / 预算 {self.max_bytes} 字节，耗时 {duration:.2f}s"
+            )
+        return dict(summary, total_bytes=total, duration=duration)
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error(f"容量回收失败: {e}")
+                with self.lock:
+                    self.stats["errors"] += 1
+
+    def start(self):
+        """启动后台回收线程（只启动一次）"""
+        if self.interval <= 0 or self.max_bytes <= 0:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._loop, name="data-janitor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(
+                self.stats,
+                max_bytes=self.max_bytes,
+                interval=self.interval,
+                pinned_owners=len(self.pins),
+            )
+
+
+janitor = Janitor()
@@ -0,0 +1,225 @@
+"""
+增量 JSON 解析
+
+模型的回复按 token 流式到达，每收到一段文本就继续解析，产生两类事件：
+- ("delta", 路径, 文本)：字符串值新到达的一段（已处理转义）
+- ("end", 路径, 值)：一个值（字符串、数字、对象、数组等）解析完成
+
+路径是键和下标组成的元组，例如 ("thought",)、("action", "input")。
+开头的非 JSON 内容（例如 ```json 代码块标记）会被跳过。
+"""
+import json
+from typing import Any, List, Optional, Tuple
+
+Event = Tuple[str, Tuple[Any, ...], Any]
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_WHITESPACE = " \t\r\n"
+_SCALAR_CHARS = set("0123456789+-.eEtrufalsn")
+
+
+class _Frame:
+    """正在解析的对象或数组"""
+
+    __slots__ = ("container", "path", "state", "key")
+
+    def __init__(self, container, path: Tuple[Any, ...]):
+        self.container = container
+        self.path = path
+        # 对象: key / colon / value / comma；数组: value / comma
+        self.state = "key" if isinstance(container, dict) else "value"
+        self.key: Any = None
+
+
+class IncrementalJSONParser:
+    """逐段输入 JSON 文本的解析器，root 中始终是已解析出的部分结果"""
+
+    def __init__(self):
+        self.root: Any = None
+        self.done = False
+        self.stack: List[_Frame] = []
+        self.started = False
+        # 字符串状态
+        self.in_string = False
+        self.string_is_key = False
+        self.string_parts: List[str] = []
+        self.escape: Optional[str] = None
+        # 数字、true/false/null
+        self.scalar: Optional[str] = None
+
+    def value_at(self, path: Tuple[Any, ...]) -> Any:
+        """部分结果中指定路径的值，尚未解析到时返回 None"""
+        node = self.root
+        for part in path:
+            if isinstance(node, dict):
+                node = node.get(part)
+            elif isinstance(node, list) and isinstance(part, int) and part < len(node):
+                node = node[part]
+            else:
+                return None
+        return node
+
+    def _child_path(self) -> Tuple[Any, ...]:
+        if not self.stack:
+            return ()
+        frame = self.stack[-1]
+        if isinstance(frame.container, dict):
+            return frame.path + (frame.key,)
+        return frame.path + (len(frame.container),)
+
+    def _attach(self, value, events: List[Event], closed: bool = True):
+        """把值放入父容器；closed 为 False 表示容器刚开始解析"""
+        path = self._child_path()
+        if not self.stack:
+            self.root = value
+        else:
+            frame = self.stack[-1]
+            if isinstance(frame.container, dict):
+                frame.container[frame.key] = value
+            else:
+                frame.container.append(value)
+            frame.state = "comma"
+        if closed:
+            events.append(("end", path, value))
+            if not self.stack:
+                self.done = True
+        return path
+
+    def _close_container(self, events: List[Event]):
+        frame = self.stack.pop()
+        events.append(("end", frame.path, frame.container))
+        if not self.stack:
+            self.done = True
+
+    def _finish_scalar(self, events: List[Event]):
+        text, self.scalar = self.scalar, None
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        self._attach(value, events)
+
+    def _feed_string(self, text: str, index: int, events: List[Event]) -> int:
+        """处理字符串内部的字符，返回字符串结束后的位置（未结束时返回 len(text)）"""
+        chunk: List[str] = []
+        length = len(text)
+        while index < length:
+            char = text[index]
+            if self.escape is not None:
+                self.escape += char
+                if self.escape[0] == "u":
+                    if len(self.escape) == 5:
+                        try:
+                            chunk.append(chr(int(self.escape[1:], 16)))
+                        except ValueError:
+                            chunk.append(self.escape)
+                        self.escape = None
+                else:
+                    chunk.append(_ESCAPES.get(char, char))
+                    self.escape = None
+            elif char == "\\":
+                self.escape = ""
+            elif char == '"':
+                break
+            else:
+                chunk.append(char)
+            index += 1
+
+        piece = "".join(chunk)
+        if piece:
+            self.string_parts.append(piece)
+            if not self.string_is_key:
+                events.append(("delta", self._child_path(), piece))
+        if index >= length:
+            return length
+
+        # 字符串结束
+        self.in_string = False
+        value = "".join(self.string_parts)
+        self.string_parts = []
+        if self.string_is_key:
+            frame = self.stack[-1]
+            frame.key = value
+            frame.state = "colon"
+        else:
+            self._attach(_merge_surrogates(value), events)
+        return index + 1
+
+    def _start_value(self, char: str, events: List[Event]) -> bool:
+        """在期望值的位置遇到 char；返回是否已消费该字符"""
+        if char == '"':
+            self.in_string = True
+            self.string_is_key = False
+            return True
+        if char == "{" or char == "[":
+            container = {} if char == "{" else []
+            path = self._attach(container, events, closed=False)
+            self.stack.append(_Frame(container, path))
+            return True
+        if char in _SCALAR_CHARS:
+            self.scalar = char
+            return True
+        return True  # 无法识别的字符直接忽略
+
+    def feed(self, text: str) -> List[Event]:
+        """输入一段文本，返回这段文本产生的事件"""
+        events: List[Event] = []
+        index = 0
+        length = len(text or "")
+        while index < length and not self.done:
+            if self.in_string:
+                index = self._feed_string(text, index, events)
+                continue
+            char = text[index]
+
+            if self.scalar is not None:
+                if char in _SCALAR_CHARS:
+                    self.scalar += char
+                    index += 1
+                    continue
+                self._finish_scalar(events)
+                if self.done:
+                    break
+                continue
+
+            if not self.started:
+                # 跳过 JSON 之前的内容
+                if char in "{[":
+                    self.started = True
+                    self._start_value(char, events)
+                index += 1
+                continue
+
+            if char in _WHITESPACE:
+                index += 1
+                continue
+
+            frame = self.stack[-1]
+            if frame.state == "key":
+                if char == '"':
+                    self.in_string = True
+                    self.string_is_key = True
+                elif char == "}":
+                    self._close_container(events)
+            elif frame.state == "colon":
+                if char == ":":
+                    frame.state = "value"
+            elif frame.state == "value":
+                if char == "]" and isinstance(frame.container, list):
+                    self._close_container(events)
+                else:
+                    self._start_value(char, events)
+            elif frame.state == "comma":
+                if char == ",":
+                    frame.state = "key" if isinstance(frame.container, dict) else "value"
+                elif char in "}]":
+                    self._close_container(events)
+            index += 1
+        return events
+
+
+def _merge_surrogates(value: str) -> str:
+    """\\ud83d\\ude00 这样逐个解码的代理对合并为一个字符"""
+    if any("\ud800" <= char <= "\udfff" for char in value):
+        return value.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+    return value
@@ -0,0 +1,759 @@
+"""
+常驻 Python 内核管理
+
+每个聊天会话拥有一个长期运行的解释器子进程和独立的工作目录，
+变量（例如已加载的 df）在 ReAct 各轮次以及多轮对话之间保持不变。
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import queue
+import hashlib
+import codecs
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional, Callable, Any, Tuple
+
+from app.kernel_driver import MARK_START, MARK_END
+from app.output_capture import OutputCapture, artifact_dir_for
+from app.plot_store import store_figures, THUMBNAIL_WIDTH
+from app.blob_store import link_into
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DRIVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernel_driver.py")
+
+# 单元格执行超时（秒），与原先一次性子进程的语义保持一致
+CELL_TIMEOUT = 30
+# 超时后发送中断信号，等待内核自行结束单元格的宽限时间（秒）
+INTERRUPT_GRACE = 3
+# 内核启动超时（秒）
+STARTUP_TIMEOUT = 60
+# 会话内核空闲超时（秒）
+KERNEL_IDLE_TIMEOUT = int(os.getenv("IDA_KERNEL_IDLE_TIMEOUT", "1800"))
+
+# 预热内核池配置
+POOL_SIZE = int(os.getenv("IDA_POOL_SIZE", "2"))
+POOL_MAX_USES = int(os.getenv("IDA_POOL_MAX_USES", "20"))
+POOL_WARMUP = [
+    name.strip()
+    for name in os.getenv("IDA_POOL_WARMUP", "numpy,pandas,scipy,matplotlib,matplotlib.pyplot").split(",")
+    if name.strip()
+]
+
+# 按用户角色的单元格资源限制，可通过 IDA_LIMITS_<角色> 覆盖，
+# 例如 IDA_LIMITS_USER="memory_mb=2048,cpu_seconds=30,file_size_mb=256"
+DEFAULT_RESOURCE_LIMITS = {
+    "admin": {"memory_mb": 8192, "cpu_seconds": 120, "file_size_mb": 2048},
+    "user": {"memory_mb": 4096, "cpu_seconds": 60, "file_size_mb": 512},
+}
+LIMIT_NAMES = {"memory": "内存", "cpu": "CPU 时间", "file_size": "文件大小"}
+# 大文件模式下全量数据计算步骤的内存上限（MB），不低于角色的限制；0 表示不限制内存
+FULL_DATA_MEMORY_MB = int(os.getenv("IDA_FULL_DATA_MEMORY_MB", "16384"))
+
+
+def get_resource_limits(role: Optional[str]) -> Dict[str, int]:
+    """获取角色对应的资源限制，未知角色按普通用户处理"""
+    role = (role or "user").lower()
+    limits = dict(DEFAULT_RESOURCE_LIMITS.get(role, DEFAULT_RESOURCE_LIMITS["user"]))
+    override = os.getenv(f"IDA_LIMITS_{role.upper()}")
+    if override:
+        for item in override.split(","):
+            key, _, value = item.partition("=")
+            if key.strip() and value.strip():
+                try:
+                    limits[key.strip()] = int(value)
+                except ValueError:
+                    logger.warning(f"忽略无效的资源限制配置: {item}")
+    return limits
+
+
+def full_data_limits(limits: Dict[str, int], timeout: float) -> Dict[str, int]:
+    """
+    全量数据计算步骤的资源限制
+
+    CPU 时间至少与该步骤的超时相同，否则单元格会先因 CPU 时间超限被终止；
+    内存使用单独的上限 FULL_DATA_MEMORY_MB。
+    """
+    limits = dict(limits)
+    limits["cpu_seconds"] = max(int(limits.get("cpu_seconds") or 0), int(math.ceil(timeout)))
+    if FULL_DATA_MEMORY_MB <= 0:
+        limits.pop("memory_mb", None)
+    else:
+        limits["memory_mb"] = max(int(limits.get("memory_mb") or 0), FULL_DATA_MEMORY_MB)
+    return limits
+
+
+class KernelDiedError(RuntimeError):
+    """内核子进程意外退出"""
+
+
+class _StreamReader(threading.Thread):
+    """读取子进程输出流，按结束标记切分并放入事件队列"""
+
+    def __init__(self, name: str, pipe, token: str, events: "queue.Queue"):
+        super().__init__(name=f"kernel-{name}-reader", daemon=True)
+        self.stream_name = name
+        self.pipe = pipe
+        self.marker = MARK_START + token.encode("ascii") + b":"
+        self.events = events
+
+    def _held_back(self, buffer: bytes) -> int:
+        """返回缓冲区末尾可能是结束标记前缀的字节数"""
+        for size in range(min(len(self.marker) - 1, len(buffer)), 0, -1):
+            if self.marker.startswith(buffer[-size:]):
+                return size
+        return 0
+
+    def run(self):
+        buffer = b""
+        fd = self.pipe.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                break
+            buffer += chunk
+
+            while True:
+                start = buffer.find(self.marker)
+                if start < 0:
+                    keep = self._held_back(buffer)
+                    data, buffer = (buffer[:-keep], buffer[-keep:]) if keep else (buffer, b"")
+                    if data:
+                        self.events.put((self.stream_name, data))
+                    break
+
+                end = buffer.find(MARK_END, start + len(self.marker))
+                if end < 0:
+                    if start:
+                        self.events.put((self.stream_name, buffer[:start]))
+                        buffer = buffer[start:]
+                    break
+
+                if start:
+                    self.events.put((self.stream_name, buffer[:start]))
+                try:
+                    payload = json.loads(buffer[start + len(self.marker):end].decode("ascii"))
+                except ValueError:
+                    payload = {}
+                self.events.put((f"{self.stream_name}_done", payload))
+                buffer = buffer[end + len(MARK_END):]
+
+        if buffer:
+            self.events.put((self.stream_name, buffer))
+        self.events.put((f"{self.stream_name}_eof", None))
+
+
+class PythonKernel:
+    """一个常驻的 Python 解释器子进程"""
+
+    def __init__(self, workspace: str, env: Optional[Dict[str, str]] = None, warmup: Optional[List[str]] = None):
+        self.workspace = workspace
+        self.env = env or {}
+        self.warmup = warmup or []
+        self.uses = 0
+        self.startup_time = 0.0
+        self.process: Optional[subprocess.Popen] = None
+        self.token = uuid.uuid4().hex
+        self.events: "queue.Queue" = queue.Queue()
+        self.lock = threading.Lock()
+        self.cell_counter = 0
+        self.last_used = time.time()
+        self.started_at: Optional[float] = None
+
+    # ---------- 生命周期 ----------
+
+    def start(self):
+        """启动内核子进程并等待就绪"""
+        env = os.environ.copy()
+        env["PYTHONIOENCODING"] = "utf-8"
+        env["PROJECT_ROOT"] = PROJECT_ROOT
+        env["MPLBACKEND"] = "Agg"
+        env.update(self.env)
+
+        self.token = uuid.uuid4().hex
+        self.events = queue.Queue()
+        self.cell_counter = 0
+        self.uses = 0
+        spawned = time.time()
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", DRIVER_PATH, self.token, ",".join(self.warmup)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.workspace,
+            env=env,
+        )
+        _StreamReader("stdout", self.process.stdout, self.token, self.events).start()
+        _StreamReader("stderr", self.process.stderr, self.token, self.events).start()
+
+        result = self._wait_for_cell(0, STARTUP_TIMEOUT, None)
+        if result["status"] != "ready":
+            self.shutdown()
+            raise KernelDiedError(f"内核启动失败: {result.get('stderr') or result.get('error')}")
+        self.started_at = time.time()
+        self.last_used = time.time()
+        self.startup_time = self.started_at - spawned
+        logger.info(
+            f"内核已启动: pid={self.process.pid}, 工作目录={self.workspace}, "
+            f"预热模块={result['payload'].get('warmed', [])}, 启动耗时={self.startup_time:.2f}s"
+        )
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def interrupt(self):
+        """向内核发送中断信号，不丢失已有变量"""
+        if not self.is_alive():
+            return
+        try:
+            if os.name == "posix":
+                self.process.send_signal(signal.SIGINT)
+            else:
+                # Windows 下无法可靠地向子进程发送 Ctrl+C，只能终止
+                self.process.kill()
+        except Exception as e:
+            logger.warning(f"中断内核失败: {e}")
+
+    def shutdown(self):
+        """关闭内核子进程"""
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait(timeout=5)
+        except Exception as e:
+            logger.warning(f"关闭内核失败: {e}")
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                pipe.close()
+            except Exception:
+                pass
+        self.process = None
+
+    # ---------- 执行 ----------
+
+    def _send(self, command: Dict[str, Any]):
+        if not self.is_alive():
+            raise KernelDiedError("内核进程已退出")
+        try:
+            self.process.stdin.write((json.dumps(command, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise KernelDiedError(f"无法向内核发送指令: {e}")
+
+    def _wait_for_cell(
+        self,
+        cell_id: int,
+        timeout: float,
+        on_output: Optional[Callable[[str, str], None]],
+        artifact_dir: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """收集单元格输出，直到 stdout/stderr 都出现结束标记、超时或内核退出"""
+        decoders = {
+            "stdout": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            "stderr": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        }
+        # 输出有上限，超出部分写入文件，避免超大输出占满内存
+        artifact_dir = artifact_dir or artifact_dir_for(None)
+        outputs = {
+            "stdout": OutputCapture("stdout", artifact_dir),
+            "stderr": OutputCapture("stderr", artifact_dir),
+        }
+        done: Dict[str, Dict[str, Any]] = {}
+        started = time.time()
+        deadline = started + timeout
+        first_output_latency: Optional[float] = None
+        interrupted_at: Optional[float] = None
+        status = None
+
+        while len(done) < 2:
+            now = time.time()
+            if interrupted_at is None and now >= deadline:
+                # 超时：先尝试中断，保留内核状态
+                status = "timeout"
+                interrupted_at = now
+                self.interrupt()
+            elif interrupted_at is not None and now >= interrupted_at + INTERRUPT_GRACE:
+                # 中断无效，只能杀掉内核
+                self.shutdown()
+                status = "killed"
+                break
+
+            wait = (deadline if interrupted_at is None else interrupted_at + INTERRUPT_GRACE) - now
+            try:
+                kind, data = self.events.get(timeout=max(0.05, min(wait, 0.5)))
+            except queue.Empty:
+                continue
+
+            if kind in ("stdout", "stderr"):
+                text = decoders[kind].decode(data)
+                if text:
+                    if first_output_latency is None:
+                        first_output_latency = time.time() - started
+                    text = outputs[kind].write(text)
+                    if on_output and text:
+                        try:
+                            on_output(kind, text)
+                        except Exception as e:
+                            logger.warning(f"输出回调失败: {e}")
+            elif kind.endswith("_done"):
+                if data.get("id") == cell_id:
+                    done[kind[:-5]] = data
+            elif kind.endswith("_eof"):
+                status = "died"
+                break
+
+        for kind, decoder in decoders.items():
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                outputs[kind].write(tail)
+
+        artifacts = [info for info in (capture.close() for capture in outputs.values()) if info]
+        payload = done.get("stdout") or done.get("stderr") or {}
+        return {
+            "status": status or payload.get("status", "died"),
+            "error": payload.get("error"),
+            "stdout": outputs["stdout"].getvalue(),
+            "stderr": outputs["stderr"].getvalue(),
+            "payload": payload,
+            "first_output_latency": first_output_latency,
+            "artifacts": artifacts,
+            "stdout_bytes": outputs["stdout"].total_bytes,
+            "stderr_bytes": outputs["stderr"].total_bytes,
+        }
+
+    def execute(
+        self,
+        code: str,
+        timeout: float = CELL_TIMEOUT,
+        on_output: Optional[Callable[[str, str], None]] = None,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        artifact_dir: Optional[str] = None,
+        limits: Optional[Dict[str, int]] = None,
+    ) -> Dict[str, Any]:
+        """
+        在内核中执行一个代码单元
+
+        Returns:
+            dict: status(ok/error/timeout/killed/died)、stdout、stderr、wall_time、
+                  first_output_latency（提交到首个输出的延迟，无输出时为 None）、
+                  artifacts（被截断输出的完整内容文件引用）、
+                  usage（峰值 RSS、用户/系统 CPU、墙钟时间、写入字节数）、
+                  plots（单元格结束时自动捕获的图表引用）
+        """
+        with self.lock:
+            self.cell_counter += 1
+            cell_id = self.cell_counter
+            started = time.time()
+            figure_dir = os.path.join(cwd or self.workspace, ".ida_figures")
+            self._send({
+                "op": "exec",
+                "id": cell_id,
+                "code": code,
+                "cwd": cwd or self.workspace,
+                "env": env or {},
+                "limits": limits or {},
+                "figure_dir": figure_dir,
+                "thumbnail_width": THUMBNAIL_WIDTH,
+            })
+            result = self._wait_for_cell(cell_id, timeout, on_output, artifact_dir)
+            result["wall_time"] = time.time() - started
+            usage = dict(result["payload"].get("usage") or {})
+            usage["wall_time"] = round(result["wall_time"], 4)
+            usage["stdout_bytes"] = result.pop("stdout_bytes", 0)
+            usage["stderr_bytes"] = result.pop("stderr_bytes", 0)
+            usage["limits"] = limits or {}
+            result["usage"] = usage
+            result["limit_exceeded"] = result["payload"].get("limit_exceeded")
+            result["plots"] = store_figures(result["payload"].get("figures") or [])
+            self.uses += 1
+            self.last_used = time.time()
+            if result["status"] == "died":
+                self.shutdown()
+            return result
+
+    def reset(self):
+        """清空用户命名空间（已导入的模块仍保留在内核中）"""
+        with self.lock:
+            self.cell_counter += 1
+            cell_id = self.cell_counter
+            self._send({"op": "reset", "id": cell_id})
+            result = self._wait_for_cell(cell_id, CELL_TIMEOUT, None)
+            if result["status"] != "ok":
+                raise KernelDiedError(f"重置内核失败: {result['status']}")
+
+
+def _last_error_line(result: Dict[str, Any]) -> str:
+    """执行失败时最能说明原因的一行（通常是异常类型和消息）"""
+    lines = [line for line in (result.get("stderr") or result.get("error") or "").splitlines() if line.strip()]
+    return lines[-1].strip()[:300] if lines else result.get("status", "")
+
+
+def format_execution_result(result: Dict[str, Any], timeout: float = CELL_TIMEOUT) -> str:
+    """将内核执行结果整理为观察文本"""
+    execution_result = ""
+    for replay in result.get("replay_errors") or []:
+        # 延后补跑的单元失败时，它定义的变量在本次执行中可能不存在
+        execution_result += f"警告: 补跑「{replay['label']}」失败（{replay['error']}），其中定义的变量可能不存在\n"
+    execution_result += result.get("stdout", "")
+    if result.get("stderr"):
+        execution_result += f"\n错误输出:\n{result['stderr']}"
+
+    status = result.get("status")
+    if result.get("limit_exceeded"):
+        limit_name = LIMIT_NAMES.get(result["limit_exceeded"], result["limit_exceeded"])
+        execution_result += f"\n错误: 代码超出资源限制（{limit_name}），请减少数据量或分块处理"
+    if status in ("timeout", "killed"):
+        execution_result += f"\n错误: 代码执行超时（{int(timeout)}秒）"
+        if status == "killed":
+            execution_result += "，内核已重启，之前定义的变量已丢失"
+    elif status == "died":
+        execution_result += "\n错误: Python 内核意外退出，已重启，之前定义的变量已丢失"
+
+    # 自动捕获的图表沿用 PLOT_PATH:: 约定，便于报告引用
+    for plot in result.get("plots") or []:
+        execution_result += f"\n图表已自动保存: PLOT_PATH::{plot['url']}"
+    return execution_result
+
+
+class KernelPool:
+    """
+    预热内核池
+
+    池中的内核已导入常用科学计算库并设置 Agg 后端。每次执行检出一个干净的内核，
+    执行后清空命名空间归还；使用次数达到上限或已崩溃的内核会被替换。
+    """
+
+    def __init__(self, size: int = POOL_SIZE, warmup: Optional[List[str]] = None, max_uses: int = POOL_MAX_USES):
+        self.size = max(0, size)
+        self.warmup = POOL_WARMUP if warmup is None else warmup
+        self.max_uses = max(1, max_uses)
+        self.idle: List[PythonKernel] = []
+        self.lock = threading.Lock()
+        self.spawning = 0
+        self.stats = {
+            "checkouts": 0,
+            "cold_starts": 0,
+            "recycled": 0,
+            "retired": 0,
+            "first_output_latency_total": 0.0,
+            "first_output_samples": 0,
+        }
+
+    def _new_kernel(self) -> PythonKernel:
+        kernel = PythonKernel(tempfile.mkdtemp(prefix="ida_pool_"), warmup=self.warmup)
+        kernel.start()
+        return kernel
+
+    def _spawn_one(self):
+        try:
+            kernel = self._new_kernel()
+        except Exception as e:
+            logger.error(f"预热内核启动失败: {e}")
+            kernel = None
+        with self.lock:
+            self.spawning -= 1
+            if kernel is not None:
+                if len(self.idle) < self.size:
+                    self.idle.append(kernel)
+                    kernel = None
+        if kernel is not None:
+            self._discard(kernel)
+
+    def warm(self):
+        """在后台补足池中的预热内核"""
+        with self.lock:
+            missing = self.size - len(self.idle) - self.spawning
+            self.spawning += max(0, missing)
+        for _ in range(max(0, missing)):
+            threading.Thread(target=self._spawn_one, name="kernel-pool-spawn", daemon=True).start()
+
+    def checkout(self) -> PythonKernel:
+        """检出一个干净的预热内核，池为空时同步冷启动一个"""
+        kernel = None
+        with self.lock:
+            self.stats["checkouts"] += 1
+            while self.idle:
+                candidate = self.idle.pop()
+                if candidate.is_alive():
+                    kernel = candidate
+                    break
+                self._discard(candidate)
+        if kernel is None:
+            with self.lock:
+                self.stats["cold_starts"] += 1
+            logger.info("预热内核池为空，冷启动新内核")
+            kernel = self._new_kernel()
+        self.warm()
+        return kernel
+
+    def checkin(self, kernel: PythonKernel):
+        """归还内核：清空命名空间后放回池中，超过使用上限则退役"""
+        retire = (not kernel.is_alive()) or kernel.uses >= self.max_uses
+        if not retire:
+            try:
+                kernel.reset()
+            except Exception as e:
+                logger.warning(f"重置内核失败，退役处理: {e}")
+                retire = True
+
+        with self.lock:
+            if not retire and len(self.idle) < self.size:
+                self.idle.append(kernel)
+                self.stats["recycled"] += 1
+                kernel = None
+            else:
+                self.stats["retired"] += 1
+        if kernel is not None:
+            self._discard(kernel)
+        self.warm()
+
+    def record_latency(self, result: Dict[str, Any]):
+        """记录提交到首个输出的延迟"""
+        latency = result.get("first_output_latency")
+        if latency is None:
+            return
+        with self.lock:
+            self.stats["first_output_latency_total"] += latency
+            self.stats["first_output_samples"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = len(self.idle)
+        samples = stats.pop("first_output_samples")
+        total = stats.pop("first_output_latency_total")
+        stats["avg_first_output_latency"] = (total / samples) if samples else None
+        return stats
+
+    def _discard(self, kernel: PythonKernel):
+        kernel.shutdown()
+        try:
+            shutil.rmtree(kernel.workspace)
+        except Exception:
+            pass
+
+    def run(
+        self,
+        code: str,
+        file_path: Optional[str] = None,
+        timeout: float = CELL_TIMEOUT,
+        on_output: Optional[Callable[[str, str], None]] = None,
+        limits: Optional[Dict[str, int]] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, Any]:
+        """检出内核，在临时工作目录中执行一次代码后回收"""
+        kernel = self.checkout()
+        workspace = tempfile.mkdtemp(prefix="ida_exec_")
+        try:
+            link_into(file_path, workspace)
+            result = kernel.execute(code, timeout=timeout, on_output=on_output, cwd=workspace, env=env, limits=limits)
+            self.record_latency(result)
+            latency = result.get("first_output_latency")
+            logger.info(
+                f"预热内核执行完成: 状态={result['status']}, 耗时={result['wall_time']:.2f}s, "
+                f"首个输出延迟={'%.3fs' % latency if latency is not None else '无输出'}"
+            )
+            return result
+        finally:
+            self.checkin(kernel)
+            try:
+                shutil.rmtree(workspace)
+            except Exception as e:
+                logger.error(f"清理临时目录失败: {e}")
+
+    def shutdown(self):
+        with self.lock:
+            kernels, self.idle = self.idle, []
+        for kernel in kernels:
+            self._discard(kernel)
+
+
+kernel_pool = KernelPool()
+
+
+class KernelManager:
+    """按会话管理常驻内核：空闲超时回收、崩溃自动重启"""
+
+    def __init__(self, pool: KernelPool, idle_timeout: int = KERNEL_IDLE_TIMEOUT):
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.kernels: Dict[str, PythonKernel] = {}
+        # 内核上下文：会话内已执行代码单元的哈希链，内核重启后清空
+        self.contexts: Dict[str, str] = {}
+        # 命中结果缓存或 SQL 结果读入等尚未真正执行的代码单元及其说明，下次真正执行前先补跑
+        self.pending: Dict[str, List[Tuple[str, str]]] = {}
+        self.lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+
+    def _ensure_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap_loop, name="kernel-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(60, max(1, self.idle_timeout // 4)))
+            self.reap_idle()
+
+    def reap_idle(self):
+        """关闭空闲超时的内核"""
+        now = time.time()
+        with self.lock:
+            expired = [
+                sid for sid, kernel in self.kernels.items()
+                if now - kernel.last_used > self.idle_timeout and not kernel.lock.locked()
+            ]
+        for session_id in expired:
+            logger.info(f"会话内核空闲超时，关闭: {session_id}")
+            self.shutdown_kernel(session_id)
+
+    def get_kernel(self, session_id: str) -> PythonKernel:
+        """获取会话内核，不存在或已崩溃时重新启动"""
+        self._ensure_reaper()
+        with self.lock:
+            kernel = self.kernels.get(session_id)
+        if kernel is None:
+            # 新会话从预热池中取一个内核，省去导入 pandas 等库的时间
+            kernel = self.pool.checkout()
+            shutil.rmtree(kernel.workspace, ignore_errors=True)
+            kernel.workspace = tempfile.mkdtemp(prefix="ida_session_")
+            with self.lock:
+                existing = self.kernels.setdefault(session_id, kernel)
+            if existing is not kernel:
+                self.pool.checkin(kernel)
+                kernel = existing
+            else:
+                logger.info(f"创建会话内核: {session_id}, 工作目录: {kernel.workspace}")
+
+        if not kernel.is_alive():
+            if kernel.started_at is not None:
+                logger.warning(f"会话内核已退出，正在重启: {session_id}")
+            self._reset_context(session_id)
+            kernel.start()
+        return kernel
+
+    def _reset_context(self, session_id: str):
+        with self.lock:
+            self.contexts.pop(session_id, None)
+            self.pending.pop(session_id, None)
+
+    def _advance_context(self, session_id: str, code: str):
+        with self.lock:
+            previous = self.contexts.get(session_id, "")
+            self.contexts[session_id] = hashlib.sha256(f"{previous}\x00{code}".encode("utf-8")).hexdigest()
+
+    def context_digest(self, session_id: str) -> str:
+        """当前内核状态的摘要，用作结果缓存键的一部分"""
+        with self.lock:
+            return self.contexts.get(session_id, "")
+
+    def defer(self, session_id: str, code: str, label: str = "命中缓存的代码单元"):
+        """
+        记录一个命中结果缓存、未实际执行的代码单元
+
+        内核状态按已执行处理；下一次真正执行前会先静默补跑这些单元，保证变量一致。
+        补跑失败时 label 连同错误信息记录在那次执行结果的 replay_errors 中。
+        """
+        with self.lock:
+            self.pending.setdefault(session_id, []).append((code, label))
+        self._advance_context(session_id, code)
+
+    def prepare_workspace(self, kernel: PythonKernel, file_path: Optional[str]):
+        """在会话工作目录中放入上传文件的只读链接"""
+        dest_path = link_into(file_path, kernel.workspace)
+        if dest_path:
+            logger.debug(f"链接文件 {file_path} 到 {dest_path}")
+
+    def execute(
+        self,
+        session_id: str,
+        code: str,
+        file_path: Optional[str] = None,
+        timeout: float = CELL_TIMEOUT,
+        on_output: Optional[Callable[[str, str], None]] = None,
+        limits: Optional[Dict[str, int]] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, Any]:
+        """在会话内核中执行代码（env 为本次执行额外设置的环境变量）"""
+        kernel = self.get_kernel(session_id)
+        self.prepare_workspace(kernel, file_path)
+        options = {
+            "timeout": timeout,
+            "on_output": on_output,
+            "artifact_dir": artifact_dir_for(session_id),
+            "limits": limits,
+            "env": env,
+        }
+        with self.lock:
+            pending = self.pending.pop(session_id, [])
+        replay_errors: List[Dict[str, str]] = []
+        try:
+            for deferred, label in pending:
+                # 补跑延后的单元，输出已经展示过，这里丢弃；失败时报告给下一次观察结果
+                replay = kernel.execute(deferred, **dict(options, on_output=None))
+                logger.info(f"补跑{label}: 状态={replay['status']}")
+                if replay["status"] != "ok":
+                    replay_errors.append({"label": label, "status": replay["status"], "error": _last_error_line(replay)})
+            context = self.context_digest(session_id)
+            result = kernel.execute(code, **options)
+        except KernelDiedError as e:
+            logger.warning(f"会话内核不可用，重启后重试: {e}")
+            self._reset_context(session_id)
+            kernel.shutdown()
+            kernel.start()
+            context = ""
+            result = kernel.execute(code, **options)
+
+        result["context"] = context
+        result["replay_errors"] = replay_errors
+        if result["status"] in ("died", "killed"):
+            # 内核已重启，之前的变量全部丢失
+            self._reset_context(session_id)
+        else:
+            self._advance_context(session_id, code)
+        return result
+
+    def interrupt(self, session_id: str):
+        """中断会话内核中正在运行的代码"""
+        with self.lock:
+            kernel = self.kernels.get(session_id)
+        if kernel:
+            kernel.interrupt()
+
+    def shutdown_kernel(self, session_id: str):
+        """关闭会话内核并清理工作目录"""
+        self._reset_context(session_id)
+        with self.lock:
+            kernel = self.kernels.pop(session_id, None)
+        if kernel is None:
+            return
+        kernel.shutdown()
+        try:
+            shutil.rmtree(kernel.workspace)
+            logger.info(f"清理会话工作目录: {kernel.workspace}")
+        except Exception as e:
+            logger.error(f"清理会话工作目录失败: {e}")
+
+    def shutdown_all(self):
+        with self.lock:
+            session_ids = list(self.kernels.keys())
+        for session_id in session_ids:
+            self.shutdown_kernel(session_id)
+
+
+kernel_manager = KernelManager(kernel_pool)
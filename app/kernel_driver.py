@@ -0,0 +1,312 @@
+"""
+常驻 Python 内核的子进程入口
+
+由 app/kernel.py 以 `python -u kernel_driver.py <token> [预热模块,...]` 启动，只依赖标准库。
+协议:
+- 父进程通过 stdin 逐行发送 JSON 指令:
+  {"op": "exec", "id": 1, "code": "...", "cwd": "...", "limits": {...}, "figure_dir": "..."}
+- 用户代码的输出直接写入 stdout/stderr
+- 每条指令完成后，在 stdout 和 stderr 上各写一个结束标记:
+  MARK_START + JSON + MARK_END，父进程据此切分单元格输出
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import importlib
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # Windows 下没有 rlimit，只统计墙钟时间
+    resource = None
+
+MARK_START = b"\x1eIDA-KERNEL-"
+MARK_END = b"\x1f"
+
+
+def write_marker(token: str, payload: dict):
+    """在 stdout 与 stderr 上写入结束标记"""
+    data = MARK_START + token.encode("ascii") + b":" + json.dumps(payload, ensure_ascii=True).encode("ascii") + MARK_END
+    for stream, fd in ((sys.stdout, 1), (sys.stderr, 2)):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+        os.write(fd, data)
+
+
+class CpuLimitExceeded(Exception):
+    """单元格 CPU 时间超出限制"""
+
+
+def _on_cpu_limit(signum, frame):
+    raise CpuLimitExceeded("CPU 时间超出限制")
+
+
+def apply_limits(limits: dict) -> list:
+    """
+    为当前单元格设置软限制，返回需要恢复的原始值
+
+    limits: memory_mb（地址空间）、cpu_seconds（本单元格 CPU 时间）、file_size_mb（单个写入文件大小）
+    """
+    if resource is None or not limits:
+        return []
+    previous = []
+
+    def set_soft(kind, value):
+        soft, hard = resource.getrlimit(kind)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(kind, (value, hard))
+        previous.append((kind, soft, hard))
+
+    try:
+        if limits.get("memory_mb"):
+            set_soft(resource.RLIMIT_AS, int(limits["memory_mb"]) * 1024 * 1024)
+        if limits.get("cpu_seconds"):
+            # RLIMIT_CPU 按进程累计，在已用时间基础上追加本单元格的额度
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            set_soft(resource.RLIMIT_CPU, used + int(limits["cpu_seconds"]))
+        if limits.get("file_size_mb"):
+            set_soft(resource.RLIMIT_FSIZE, int(limits["file_size_mb"]) * 1024 * 1024)
+    except (ValueError, OSError):
+        pass
+    return previous
+
+
+def restore_limits(previous: list):
+    for kind, soft, hard in reversed(previous):
+        try:
+            resource.setrlimit(kind, (soft, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def _read_proc(path: str, field: str):
+    """读取 /proc/self 下 "字段: 数值" 格式的条目"""
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def begin_usage() -> dict:
+    """记录单元格开始时的资源使用快照"""
+    try:
+        # 重置 VmHWM，使峰值 RSS 只反映本单元格（Linux 4.0+）
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    snapshot = {"wall": time.time(), "wchar": _read_proc("/proc/self/io", "wchar")}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        snapshot.update(utime=usage.ru_utime, stime=usage.ru_stime)
+    return snapshot
+
+
+def end_usage(snapshot: dict) -> dict:
+    """计算单元格的资源使用记录"""
+    record = {"wall_time": round(time.time() - snapshot["wall"], 4)}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record["cpu_user"] = round(usage.ru_utime - snapshot["utime"], 4)
+        record["cpu_sys"] = round(usage.ru_stime - snapshot["stime"], 4)
+        peak_kb = _read_proc("/proc/self/status", "VmHWM")
+        if peak_kb is None:
+            # ru_maxrss 在 macOS 上单位是字节，其它平台是 KB
+            peak_kb = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        record["peak_rss_kb"] = peak_kb
+    wchar = _read_proc("/proc/self/io", "wchar")
+    if wchar is not None and snapshot.get("wchar") is not None:
+        record["bytes_written"] = wchar - snapshot["wchar"]
+    return record
+
+
+def new_namespace() -> dict:
+    """创建用户代码的全局命名空间"""
+    return {"__name__": "__main__", "__builtins__": __builtins__}
+
+
+def warm_up(modules: list):
+    """预先导入常用科学计算库，失败的模块直接跳过"""
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            continue
+    if "matplotlib" in sys.modules:
+        try:
+            sys.modules["matplotlib"].use("Agg")
+        except Exception:
+            pass
+    return loaded
+
+
+def clean_up(base_env: dict, base_cwd: str):
+    """回收内核前恢复环境：关闭图表、还原环境变量和工作目录"""
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is not None:
+        try:
+            pyplot.close("all")
+        except Exception:
+            pass
+    os.environ.clear()
+    os.environ.update(base_env)
+    try:
+        os.chdir(base_cwd)
+    except OSError:
+        pass
+
+
+def capture_figures(figure_dir: str, cell_id: int, thumbnail_width: int) -> list:
+    """导出当前所有打开的 matplotlib 图表（原图 + 缩略图），然后全部关闭"""
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return []
+    figures = []
+    for number in pyplot.get_fignums():
+        try:
+            figure = pyplot.figure(number)
+            os.makedirs(figure_dir, exist_ok=True)
+            path = os.path.join(figure_dir, f"cell{cell_id}_fig{number}.png")
+            figure.savefig(path, format="png", bbox_inches="tight")
+            thumbnail = os.path.join(figure_dir, f"cell{cell_id}_fig{number}_thumb.png")
+            dpi = max(10, thumbnail_width / (figure.get_figwidth() or 1))
+            figure.savefig(thumbnail, format="png", dpi=dpi)
+            figures.append({"path": path, "thumbnail": thumbnail})
+        except Exception as e:
+            sys.stderr.write(f"[图表导出失败] {type(e).__name__}: {e}\n")
+    try:
+        pyplot.close("all")
+    except Exception:
+        pass
+    return figures
+
+
+def print_user_traceback(error: BaseException):
+    """打印异常堆栈，省略驱动程序自身的栈帧"""
+    tb = error.__traceback__.tb_next if error.__traceback__ else None
+    traceback.print_exception(type(error), error, tb)
+
+
+def run_cell(code: str, cell_id: int, namespace: dict) -> dict:
+    """执行一个代码单元，返回状态信息"""
+    status = "ok"
+    error = None
+    limit_exceeded = None
+    try:
+        compiled = compile(code, f"<cell-{cell_id}>", "exec")
+        exec(compiled, namespace)
+    except MemoryError as e:
+        status = "error"
+        error = "MemoryError"
+        limit_exceeded = "memory"
+        print_user_traceback(e)
+    except CpuLimitExceeded as e:
+        status = "error"
+        error = str(e)
+        limit_exceeded = "cpu"
+        print_user_traceback(e)
+    except KeyboardInterrupt as e:
+        status = "interrupted"
+        error = "KeyboardInterrupt"
+        print_user_traceback(e)
+    except SystemExit as e:
+        # 用户代码调用 sys.exit() 不应结束内核
+        if e.code not in (None, 0):
+            status = "error"
+            error = f"SystemExit: {e.code}"
+    except BaseException as e:
+        status = "error"
+        error = f"{type(e).__name__}: {e}"
+        if isinstance(e, OSError) and e.errno == errno.EFBIG:
+            limit_exceeded = "file_size"
+        print_user_traceback(e)
+    return {"status": status, "error": error, "limit_exceeded": limit_exceeded}
+
+
+def main():
+    token = sys.argv[1]
+    warmup = [name for name in (sys.argv[2] if len(sys.argv) > 2 else "").split(",") if name]
+    commands = sys.stdin
+    # 用户代码不允许读取指令通道
+    sys.stdin = open(os.devnull, "r")
+
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    if hasattr(signal, "SIGXFSZ"):
+        # 超过文件大小限制时让 write 抛出 EFBIG，而不是终止内核
+        signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+
+    loaded = warm_up(warmup)
+    base_env = dict(os.environ)
+    base_cwd = os.getcwd()
+    namespace = new_namespace()
+    write_marker(token, {"id": 0, "status": "ready", "pid": os.getpid(), "warmed": loaded})
+
+    while True:
+        try:
+            line = commands.readline()
+        except KeyboardInterrupt:
+            # 空闲时收到的中断信号直接忽略
+            continue
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            command = json.loads(line)
+        except ValueError:
+            continue
+
+        op = command.get("op")
+        cell_id = command.get("id", 0)
+        try:
+            if op == "exec":
+                if command.get("cwd"):
+                    os.chdir(command["cwd"])
+                for key, value in (command.get("env") or {}).items():
+                    os.environ[key] = str(value)
+                snapshot = begin_usage()
+                previous = apply_limits(command.get("limits") or {})
+                try:
+                    result = run_cell(command.get("code", ""), cell_id, namespace)
+                finally:
+                    restore_limits(previous)
+                result["usage"] = end_usage(snapshot)
+                if command.get("figure_dir"):
+                    result["figures"] = capture_figures(
+                        command["figure_dir"], cell_id, int(command.get("thumbnail_width") or 320)
+                    )
+            elif op == "reset":
+                clean_up(base_env, base_cwd)
+                namespace = new_namespace()
+                result = {"status": "ok", "error": None}
+            elif op == "shutdown":
+                write_marker(token, {"id": cell_id, "status": "ok", "error": None})
+                break
+            else:
+                result = {"status": "error", "error": f"unknown op: {op}"}
+        except KeyboardInterrupt:
+            result = {"status": "interrupted", "error": "KeyboardInterrupt"}
+
+        result["id"] = cell_id
+        write_marker(token, result)
+
+
+if __name__ == "__main__":
+    main()
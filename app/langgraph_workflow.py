@@ -1,10 +1,11 @@
-from typing import Dict, TypedDict, Annotated, Sequence, List, Optional, Literal, Union, Any
-import os, sys, json, logging, tempfile, shutil, subprocess, time, re, ast, contextlib, io, builtins
+from typing import Dict, TypedDict, Annotated, Sequence, List, Optional, Literal, Union, Any, Callable, Awaitable
+import os, sys, json, logging, tempfile, shutil, subprocess, time, re, ast, contextlib, io, builtins, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langgraph.prebuilt import ToolNode
 from langgraph_codeact import create_codeact
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
-from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END
 import os
 import sys
@@ -14,6 +15,24 @@ import subprocess
 import logging
 import json
 from dotenv import load_dotenv
+from app.scheduler import execution_scheduler, ExecutionCancelled
+from app.preflight import preflight_check, format_preflight_report
+from app.result_cache import result_cache, is_deterministic, file_digest, make_key
+from app.columnar_cache import columnar_cache, describe_for_prompt
+from app.previewers import preview_file, previewer_file_type
+from app.sniffer import sniff_file, file_env, format_read_options
+from app.large_file import large_file_sampler, is_full_data_run, format_for_prompt as format_large_file, format_pending_for_prompt, FULL_DATA_TIMEOUT, LARGE_FILE_BYTES, SAMPLE_WAIT_SECONDS
+from app.profiler import dataset_profiler, format_schema_block, PROFILE_WAIT_SECONDS
+from app.janitor import touch as touch_file
+from app.sql_engine import run_query, format_sql_result, load_result_code, should_load, describe_for_prompt as describe_sql_tables
+from app.kernel import kernel_manager, kernel_pool, format_execution_result, get_resource_limits, full_data_limits, CELL_TIMEOUT
+from app.llm_client import llm, structured_output
+from app.reply_parser import reply_parser, reply_schema
+from app.llm_cache import llm_cache, make_key as make_cache_key, model_identity
+from app.llm_limiter import llm_limiter, is_retryable, OUTPUT_TOKEN_RESERVE
+from app.json_stream import IncrementalJSONParser
+from app.token_counter import count_tokens, count_message_tokens, message_tokens
+from app.context_budget import CONTEXT_MAX_TOKENS, compact_steps, compact_texts
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -29,6 +48,7 @@ class AgentState(TypedDict):
     file_content: Optional[str]
     file_type: Optional[str]
     code_to_execute: Optional[str]
+    sql_to_execute: Optional[str]
     execution_result: Optional[str]
     intermediate_steps: List[Dict[str, Any]]
     current_step: int
@@ -37,9 +57,28 @@ class AgentState(TypedDict):
     action_input: Optional[Union[Dict[str, Any], str]]
     observation: Optional[str]
     is_done: bool
-
-# 初始化LLM
-llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL_NAME", "gpt-4o"), temperature=0)
+    session_id: Optional[str]
+    user_id: Optional[str]
+    user_role: Optional[str]
+    output_artifacts: List[Dict[str, Any]]
+    execution_usage: Optional[Dict[str, Any]]
+    execution_cached: bool
+    execution_plots: List[Dict[str, Any]]
+    preflight: Optional[Dict[str, Any]]
+    file_profile: Optional[Dict[str, Any]]
+    large_file: Optional[Dict[str, Any]]
+    large_file_pending: bool
+    execution_timeout: Optional[int]
+    file_context: Optional[str]
+    sql_enabled: bool
+
+# 模型回复无法解析时记录的行动名称
+INVALID_REPLY_ACTION = "invalid_reply"
+
+# 代码执行与 SQL 查询专用线程池：排队等待槽位的任务也占用线程，
+# 与 asyncio 默认线程池分开，避免挤占事件循环中 to_thread 的文件读取
+EXECUTION_THREADS = int(os.getenv("IDA_EXECUTION_THREADS", "32"))
+execution_executor = ThreadPoolExecutor(max_workers=EXECUTION_THREADS, thread_name_prefix="code-execution")
 
 # 定义工具函数
 def read_file_content(
@@ -47,171 +86,48 @@ def read_file_content(
     max_preview_lines: int = 10,
     max_preview_chars: int = 4000,
 ) -> str:
-    """Read file content preview: binary files report length, text files return truncated preview."""
-    binary_exts = {'.xlsx', '.xls', '.xlsb', '.xlsm', '.parquet', '.feather'}
+    """Read file content preview via the format-aware previewer registry (never reads the whole file)."""
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-    except Exception:
-        ext = ''
-
-    if ext in binary_exts:
-        try:
-            with open(file_path, 'rb') as f:
-                data = f.read()
-            logger.info(f"Read binary file: {file_path}")
-            return f"[binary file, length: {len(data)} bytes]"
-        except Exception as e:
-            logger.error(f"Failed to read binary file: {e}")
-            return f"Failed to read file: {e}"
-
-    encodings = ['utf-8', 'gbk', 'cp936', 'gb18030', 'latin1']
-    for encoding in encodings:
-        try:
-            with open(file_path, 'r', encoding=encoding) as file:
-                content_parts: List[str] = []
-                total_chars = 0
-                line_count = 0
-                line_limit_reached = False
-                char_limit_reached = False
-
-                while True:
-                    line = file.readline()
-                    if line == '':
-                        break
-
-                    content_parts.append(line)
-                    total_chars += len(line)
-                    line_count += 1
-
-                    if total_chars >= max_preview_chars:
-                        char_limit_reached = True
-                        break
-                    if line_count >= max_preview_lines:
-                        line_limit_reached = True
-                        break
-
-                truncated = False
-                if char_limit_reached:
-                    truncated = True
-                elif line_limit_reached:
-                    extra = file.read(1)
-                    if extra:
-                        truncated = True
-
-                preview = ''.join(content_parts)
-                if len(preview) > max_preview_chars:
-                    preview = preview[:max_preview_chars]
-                    truncated = True
-
-                if truncated:
-                    preview = preview[:max_preview_chars].rstrip('\n')
-                    preview += f"\n... (preview truncated to {line_count} lines and approximately {len(preview)} characters)"
-
-                logger.info(
-                    f"Loaded preview with encoding {encoding}: {file_path} (lines: {line_count}, chars: {len(preview)})"
-                )
-                return preview
-        except UnicodeDecodeError:
-            continue
-        except Exception as e:
-            logger.error(f"Failed to read file: {e}")
-            return f"Failed to read file: {e}"
-
-    # If all encodings fail, fall back to binary read
-    try:
-        with open(file_path, 'rb') as file:
-            binary_content = file.read()
-        logger.warning(f"Fallback to binary read: {file_path}")
-        return f"[binary file, length: {len(binary_content)} bytes]"
+        return preview_file(file_path, max_preview_lines, max_preview_chars)
     except Exception as e:
         logger.error(f"Failed to read file: {e}")
         return f"Failed to read file: {e}"
 
 def detect_file_type(file_path):
-    """检测文件类型"""
+    """检测文件类型（有预览器的格式按注册的类型识别）"""
     if file_path:
+        file_type = previewer_file_type(file_path)
+        if file_type:
+            return file_type
         extension = os.path.splitext(file_path)[1].lower()
-        if extension in ['.csv', '.xlsx', '.xls']:
-            return 'data'
-        elif extension in ['.py']:
+        if extension in ['.py']:
             return 'python'
         elif extension in ['.js', '.ts']:
             return 'javascript'
-        elif extension in ['.json']:
-            return 'json'
-        elif extension in ['.txt', '.md']:
-            return 'text'
     return 'unknown'
 
 # ReAct Agent 核心逻辑
-def react_agent_node(state: AgentState) -> AgentState:
-    """ReAct Agent 的思考-行动循环"""
-    # 如果已经完成或达到最大迭代次数，直接返回
-    if state.get("is_done", False) or state.get("current_step", 0) >= state.get("max_iterations", 5):
-        state["is_done"] = True
-        
-        # 确保生成最终回复
-        if not any(isinstance(msg, AIMessage) for msg in state["messages"]):
-            ai_message = AIMessage(content=f"已达到最大迭代次数 {state.get('max_iterations', 5)}，无法继续处理。请检查您的请求或尝试简化任务。")
-            messages = list(state["messages"])
-            messages.append(ai_message)
-            state["messages"] = messages
-            
-        return state
-    
-    # 构建提示
-    messages = list(state["messages"])
-    
-    # 添加文件信息（如果有）
-    file_info = ""
-    if state.get("file_path"):
-        file_path = state["file_path"]
-        file_type = state.get("file_type") or detect_file_type(file_path)
-        file_content = state.get("file_content")
-        
-        if not file_content and os.path.exists(file_path):
-            file_content = read_file_content(file_path)
-            state["file_content"] = file_content
-            state["file_type"] = file_type
-        
-        if file_content:
-            file_info = f"文件路径: {file_path}\n文件类型: {file_type}\n文件内容:\n{file_content}\n"
-    
-    # 添加中间步骤历史
-    steps_history = ""
-    if state.get("intermediate_steps"):
-        for i, step in enumerate(state["intermediate_steps"]):
-            thought = step.get("thought", "")
-            action = step.get("action", "")
-            action_input = step.get("action_input")
-            observation = step.get("observation", "")
-
-            if isinstance(action_input, dict):
-                action_input_str = json.dumps(action_input, ensure_ascii=False)
-            elif action_input is None:
-                action_input_str = ""
-            else:
-                action_input_str = str(action_input)
+@lru_cache(maxsize=2)
+def build_system_prompt(sql_enabled: bool) -> str:
+    """
+    固定的系统提示词（行动说明、输出格式与代码要求）
 
-            steps_history += f"步骤 {i+1}:\n思考: {thought}\n行动: {action}\n行动输入: {action_input_str}\n观察: {observation}\n\n"
-    
-    # 构建系统提示
+    内容只取决于是否提供 run_sql，每一步逐字节相同，服务端可以缓存这段前缀；
+    文件信息和步骤记录放在之后的消息中。
+    """
     system_prompt = f"""你是一个数据分析助手，使用ReAct（思考-行动）方法解决问题。
 你可以进行如下行动，但每次只可选其一:
 1. execute_code: 执行生成的代码并获取结果
 2. final_answer: 生成最终回复内容并结束对话
-
-{file_info if file_info else ""}
-
-{steps_history if steps_history else ""}
+{"3. run_sql: 用 SQL 直接查询上传的文件（适合对大文件做聚合、筛选），返回前若干行结果" if sql_enabled else ""}
 
 你必须严格按照以下JSON格式进行回应：
 '''
 {{
   "thought": "在这里分析问题，制定计划，并反思。",
   "action": {{
-    "name": "行动名称（execute_code 或 final_answer）",
-    "input": "仅当行动名称为 'execute_code' 时，在此处生成要执行的Python代码；仅当行动名称为 'final_answer' 时，当你有足够信息回答用户问题时，在此处提供最终的文字答案。"
+    "name": "行动名称（execute_code{"、run_sql" if sql_enabled else ""} 或 final_answer）",
+    "input": "仅当行动名称为 'execute_code' 时，在此处生成要执行的Python代码；{"仅当行动名称为 'run_sql' 时，在此处提供一条 SQL 查询语句；" if sql_enabled else ""}仅当行动名称为 'final_answer' 时，当你有足够信息回答用户问题时，在此处提供最终的文字答案。"
   }}
 }}
 '''
@@ -223,15 +139,16 @@ def react_agent_node(state: AgentState) -> AgentState:
 - 使用 pandas/numpy 等库处理数据时，务必使用 print 打印关键结果。
 - 打印表格/序列前，设置完整显示选项: 
   - DataFrame/Series 请优先使用 to_string() 打印完整内容。
+  - 单次输出有长度上限，超长部分会被截断（只保留开头和结尾），大表请先打印汇总或关键行。
   - numpy 如需打印数组，可设置 threshold/edgeitems 放宽显示限制。
   - 如果读取了文件，请使用 state 中提供的路径，避免硬编码其它路径。
   - 确保代码可独立运行，不依赖交互输入。
+- 代码在同一个持续运行的 Python 会话中执行，之前步骤中定义的变量（例如已读取的 df）仍然可用，无需重复读取文件。
 - 当你需要生成图表、绘图或任何视觉化结果时，你必须严格遵循以下规则：
   - 禁止直接显示：绝对禁止调用 plt.show() 或任何其他试图打开图形界面的函数。你的运行环境是无界面的服务器。
-  - 保存为文件：你必须将图表保存为 PNG 格式的图片文件。文件名必须保证全局唯一性。
-  - 保存位置：图表文件必须保存到项目根目录下的 data/plots 目录中。你可以通过环境变量 PROJECT_ROOT 获取项目根目录路径。
-  - 中文字体：使用中文时，必须设置微软雅黑字体：`plt.rcParams['font.sans-serif'] = ['Microsoft YaHei']`，`plt.rcParams['axes.unicode_minus'] = False`
-  - 打印访问路径：文件保存成功后，你必须立即关闭图表 (plt.close()) 以释放内存，然后以 PLOT_PATH::./data/plots/你的唯一文件名.png 的精确格式，打印出该图片的路径。"""
+  - 自动保存：每段代码执行结束时，所有打开的 matplotlib 图表都会被自动保存并关闭，执行结果中会附带 PLOT_PATH::./data/plots/xxx.png 形式的路径。无需调用 savefig、plt.close() 或手动打印路径。
+  - 多张图表：需要多张图时，为每张图分别调用 plt.figure() 或 plt.subplots()，不要在同一张图上反复覆盖。
+  - 中文字体：使用中文时，必须设置微软雅黑字体：`plt.rcParams['font.sans-serif'] = ['Microsoft YaHei']`，`plt.rcParams['axes.unicode_minus'] = False`"""
 
     # 追加更严格的分析准则，避免对年份/时间/编号做不必要的统计
     # system_prompt += (
@@ -243,18 +160,221 @@ def react_agent_node(state: AgentState) -> AgentState:
     #     "4) 猜列名前先打印候选列并说明选择依据，再进行计算。\n"
     #     "5) 输出围绕洞见（趋势、异常、对比）；表格过长时先展示示例并在总结中归纳结论。\n"
     # )
+
+    return system_prompt
+
+def build_file_info(state: AgentState) -> str:
+    """
+    提示词中的文件信息（预览或数据概况、读取参数、列式缓存、大文件样本）
+
+    涉及文件读取，由 react_agent_node 放到线程中执行。
+    """
+    file_info = ""
+    if state.get("file_path"):
+        file_path = state["file_path"]
+        file_type = state.get("file_type") or detect_file_type(file_path)
+        file_content = state.get("file_content")
+
+        if not file_content and state.get("file_profile"):
+            # 已有全量扫描的数据概况时，用紧凑的结构说明代替原始预览
+            file_content = format_schema_block(state["file_profile"])
+            state["file_content"] = file_content
+            state["file_type"] = file_type
+        elif not file_content and os.path.exists(file_path):
+            file_content = read_file_content(file_path)
+            state["file_content"] = file_content
+            state["file_type"] = file_type
+        
+        if file_content:
+            file_info = f"文件路径: {file_path}\n文件类型: {file_type}\n文件内容:\n{file_content}\n"
+
+        # 文本数据文件附上探测出的编码和分隔符，第一次读取即可成功
+        read_options = format_read_options(sniff_file(file_path))
+        if read_options:
+            file_info += f"{read_options}\n"
+
+        # 后台转换完成后，提示模型使用列式缓存快速读取
+        fast_path = describe_for_prompt(columnar_cache.get(file_path))
+        if fast_path:
+            file_info += f"{fast_path}\n"
+
+        # 大文件模式：探索性步骤使用样本
+        large_file_info = format_large_file(state.get("large_file"))
+        if state.get("large_file_pending"):
+            large_file_info = format_pending_for_prompt(os.path.getsize(file_path))
+        if large_file_info:
+            file_info += f"{large_file_info}\n"
+    return file_info
+
+def build_step_messages(intermediate_steps: List[Dict[str, Any]]) -> List[BaseMessage]:
+    """
+    已完成的步骤转换为消息：模型的回复（AIMessage）和观察结果（HumanMessage）
+
+    同一步骤每次生成的内容相同，新步骤只追加在末尾，之前的消息保持不变。
+    """
+    messages: List[BaseMessage] = []
+    for step in intermediate_steps:
+        reply = {
+            "thought": step.get("thought", ""),
+            "action": {"name": step.get("action", ""), "input": step.get("action_input")},
+        }
+        # 无法解析的回复按原文发送
+        messages.append(AIMessage(content=step.get("raw_reply") or json.dumps(reply, ensure_ascii=False)))
+        # 超出上下文预算时发送压缩后的观察结果
+        observation = step.get("prompt_observation") or step.get("observation") or "(无观察结果)"
+        messages.append(HumanMessage(content=f"观察:\n{observation}\n\n请根据观察更新你的计划或给出最终答案。"))
+    return messages
+
+def feed_agent_reply(
+    parser: IncrementalJSONParser,
+    text: str,
+    on_delta: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> bool:
+    """把一段回复交给增量解析器，发出 thought_delta / action_delta 事件；返回 action.input 是否已解析完成"""
+    input_done = False
+    for kind, path, value in parser.feed(text):
+        if kind == "end" and path == ("action", "input"):
+            input_done = True
+        if kind != "delta" or on_delta is None:
+            continue
+        if path == ("thought",):
+            on_delta({"type": "thought_delta", "content": value})
+        elif path[:2] == ("action", "input"):
+            on_delta({
+                "type": "action_delta",
+                "action": parser.value_at(("action", "name")) or "",
+                "content": value,
+            })
+    return input_done
+
+async def stream_agent_reply(
+    messages: List[BaseMessage],
+    on_delta: Optional[Callable[[Dict[str, Any]], None]] = None,
+    actions: Sequence[str] = ("execute_code", "final_answer"),
+    input_tokens: Optional[int] = None,
+) -> tuple[str, Optional[Dict[str, Any]]]:
+    """
+    流式调用大模型并增量解析回复 JSON
+
+    thought 和 action.input 的新内容到达时立即通过 on_delta 回调发出
+    （thought_delta / action_delta 事件）。action.input 解析完成且已知行动名称时
+    不再等待剩余的结束括号，直接返回，代码可以尽早开始执行。
+    服务端支持结构化输出时按 actions 生成的 JSON Schema 约束回复格式；
+    服务端拒绝该参数时降级后重试。开启回复缓存时，命中的回复按同样的方式发出事件。
+    请求经过全局限流器排队（llm_queued 事件），429/5xx 在收到任何内容之前按退避时间重试。
+
+    Returns:
+        (回复文本, 解析结果)；解析出行动时回复文本是解析结果的 JSON 序列化，否则是收到的原文；
+        无法增量解析时解析结果为 None
+    """
+    cache_key = make_cache_key(llm, messages)
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        logger.info("命中大模型回复缓存")
+        parser = IncrementalJSONParser()
+        feed_agent_reply(parser, cached, on_delta)
+        return cached, parser.root if isinstance(parser.root, dict) else None
+
+    tokens = (input_tokens if input_tokens is not None else count_message_tokens(messages)) + OUTPUT_TOKEN_RESERVE
+    on_queue = (lambda info: on_delta({"type": "llm_queued", **info})) if on_delta is not None else None
+    attempt = 0
+    while True:
+        await llm_limiter.acquire(tokens, on_queue)
+        response_format = structured_output.response_format("agent_reply", reply_schema(tuple(actions)))
+        parser = IncrementalJSONParser()
+        received: List[str] = []
+        input_done = False
+        stream = llm.astream(messages, **({"response_format": response_format} if response_format else {}))
+        try:
+            async for chunk in stream:
+                text = chunk.content if isinstance(chunk.content, str) else ""
+                received.append(text)
+                input_done = feed_agent_reply(parser, text, on_delta) or input_done
+                if parser.done or (input_done and parser.value_at(("action", "name"))):
+                    break
+        except Exception as e:
+            # 还没有收到任何内容时：服务端不支持结构化输出则降级后重试，限流或服务端错误则退避后重试
+            if received:
+                raise
+            if structured_output.downgrade(e):
+                continue
+            if await llm_limiter.backoff(e, attempt, on_queue):
+                attempt += 1
+                continue
+            raise
+        finally:
+            await stream.aclose()
+        if not (isinstance(parser.root, dict) and parser.value_at(("action", "name"))):
+            return "".join(received), parser.root if isinstance(parser.root, dict) else None
+        # 提前结束时收到的原文缺少结尾括号，记录、回放和缓存的都是解析结果序列化后的完整回复
+        response_content = json.dumps(parser.root, ensure_ascii=False)
+        await llm_cache.aput(cache_key, model_identity(llm)["model"], response_content)
+        return response_content, parser.root
+
+async def react_agent_node(
+    state: AgentState,
+    on_delta: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> AgentState:
+    """ReAct Agent 的思考-行动循环（异步流式调用大模型，等待期间不阻塞事件循环）
+
+    on_delta 会收到模型生成过程中 thought 与 action.input 的增量内容，以及上下文压缩事件。
+    """
+    # 如果已经完成或达到最大迭代次数，直接返回
+    if state.get("is_done", False) or state.get("current_step", 0) >= state.get("max_iterations", 5):
+        state["is_done"] = True
+        
+        # 确保生成最终回复
+        if not any(isinstance(msg, AIMessage) for msg in state["messages"]):
+            ai_message = AIMessage(content=f"已达到最大迭代次数 {state.get('max_iterations', 5)}，无法继续处理。请检查您的请求或尝试简化任务。")
+            messages = list(state["messages"])
+            messages.append(ai_message)
+            state["messages"] = messages
+            
+        return state
     
-    # 添加系统消息（使用正确的消息类型）
-    messages.insert(0, SystemMessage(content=system_prompt))
-    
-    # 调用LLM获取回应
-    response = llm.invoke(messages)
-    response_content = response.content
-    logger.info(f"LLM响应原文: {response_content[:500]}")
+    # 文件信息（预览、读取参数、可查询的表）每次查询只生成一次，之后各步骤保持不变
+    file_context = state.get("file_context")
+    if file_context is None:
+        # 文件读取放到线程中
+        file_context = await asyncio.to_thread(build_file_info, state)
+        # 上传文件可以用 SQL 查询时才提供 run_sql 行动
+        sql_info = await asyncio.to_thread(describe_sql_tables, state.get("file_path"))
+        if sql_info:
+            file_context += f"{sql_info}\n"
+        state["file_context"] = file_context
+        state["sql_enabled"] = bool(sql_info)
+
+    # 固定前缀 + 文件信息 + 对话消息 + 每个步骤一对消息（模型回复、观察），前面的部分在各步骤间不变
+    messages: List[BaseMessage] = [SystemMessage(content=build_system_prompt(bool(state.get("sql_enabled"))))]
+    if file_context:
+        messages.append(SystemMessage(content=file_context))
+    messages.extend(state["messages"])
+
+    # 步骤消息超出剩余预算时压缩较早步骤的观察结果
+    steps = state.get("intermediate_steps") or []
+    compaction = compact_steps(
+        steps,
+        CONTEXT_MAX_TOKENS - count_message_tokens(messages),
+        lambda step: build_step_messages([step]),
+    )
+    if compaction and on_delta is not None:
+        on_delta({"type": "context_compacted", "scope": "agent", **compaction})
+    messages.extend(build_step_messages(steps))
+
+    input_tokens = count_message_tokens(messages)
+    logger.info(
+        f"第 {state.get('current_step', 0) + 1} 步输入 token: {input_tokens}"
+        f"（固定前缀 {message_tokens(messages[0])}，消息 {len(messages)} 条）"
+    )
+
+    # 流式调用LLM，边生成边解析
+    actions = ("execute_code", "final_answer") + (("run_sql",) if state.get("sql_enabled") else ())
+    response_content, streamed_data = await stream_agent_reply(messages, on_delta, actions, input_tokens)
+    logger.info(f"LLM回复: {response_content[:500]}")
     
-    # 直接解析大模型返回的JSON格式内容
+    # 解析大模型返回的JSON格式内容，格式有误时在本地修复
     try:
-        response_data = json.loads(response_content)
+        response_data = reply_parser.parse(response_content, streamed_data)
         thought = response_data.get("thought", "")
         action_obj = response_data.get("action", {})
         action = action_obj.get("name", "")
@@ -320,15 +440,24 @@ def react_agent_node(state: AgentState) -> AgentState:
     except Exception as e:
         logger.error(f"解析大模型JSON回复失败: {e}，原始内容: {response_content[:100]}...")
         state["error"] = f"解析大模型JSON回复失败: {e}"
-        ai_message = AIMessage(content="AI回复格式解析失败，请检查大模型输出。")
-        messages = list(state.get("messages", []))
-        messages.append(ai_message)
-        state["messages"] = messages
+        # 记录为无效步骤：下一轮把原始回复和错误说明发给模型，不会重复执行上一步的行动
+        intermediate_steps = state.get("intermediate_steps", [])
+        intermediate_steps.append({
+            "thought": "",
+            "action": INVALID_REPLY_ACTION,
+            "action_input": None,
+            "raw_reply": response_content,
+            "observation": f"上一条回复无法解析为 JSON（{e}），请严格按照要求的 JSON 格式重新回复。",
+        })
+        state["current_step"] = state.get("current_step", 0) + 1
+        state["intermediate_steps"] = intermediate_steps
+        state["action"] = INVALID_REPLY_ACTION
+        state["action_input"] = None
 
     return state
 
 # 定义节点函数
-def agent_node(state: AgentState) -> AgentState:
+async def agent_node(state: AgentState) -> AgentState:
     """代理节点，分析用户指令并决定下一步操作"""
     messages = state["messages"]
     file_path = state.get("file_path")
@@ -342,8 +471,10 @@ def agent_node(state: AgentState) -> AgentState:
     # 添加提示到消息历史
     all_messages = messages + [HumanMessage(content=prompt)]
     
-    # 调用LLM
-    response = llm.invoke(all_messages)
+    # 调用LLM（经全局限流器排队）
+    response = await llm_limiter.call(
+        lambda: llm.ainvoke(all_messages), count_message_tokens(all_messages) + OUTPUT_TOKEN_RESERVE
+    )
     
     # 更新状态
     return {
@@ -352,85 +483,110 @@ def agent_node(state: AgentState) -> AgentState:
     }
 
 # 安全的代码执行沙箱
-def safe_code_executor(code: str, _locals: dict[str, Any]) -> tuple[str, dict[str, Any]]:
-    """安全执行代码并返回结果和新变量"""
-    # 创建临时目录
-    temp_dir = tempfile.mkdtemp()
-    logger.info(f"创建临时目录: {temp_dir}")
-    
+def safe_code_executor(
+    code: str,
+    _locals: dict[str, Any],
+    on_output: Optional[Callable[[str, str], None]] = None,
+) -> tuple[str, dict[str, Any]]:
+    """安全执行代码并返回结果和新变量
+
+    on_output(stream, text) 会在代码运行期间收到 stdout/stderr 的增量输出。
+    """
     # 确保项目根目录下的data/plots目录存在
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     plots_dir = os.path.join(project_root, "data", "plots")
     os.makedirs(plots_dir, exist_ok=True)
-    logger.info(f"确保项目plots目录存在: {plots_dir}")
-    
+
+    # 大文件模式下在全量数据上运行的步骤使用更长的超时
+    timeout = _locals.get("execution_timeout") or CELL_TIMEOUT
+
+    # 按用户角色设置内存/CPU/文件大小限制；全量数据计算步骤放宽 CPU 时间与内存限制
+    limits = get_resource_limits(_locals.get("user_role"))
+    if _locals.get("execution_timeout"):
+        limits = full_data_limits(limits, timeout)
+    # 探测出的文件编码和分隔符通过环境变量提供给代码
+    env = file_env(_locals.get("file_path"))
+
     try:
-        # 存储执行前的变量键
-        original_keys = set(_locals.keys())
-        
-        # 如果有上传的文件，复制到临时目录
-        if _locals.get("file_path") and os.path.exists(_locals["file_path"]):
-            file_name = os.path.basename(_locals["file_path"])
-            dest_path = os.path.join(temp_dir, file_name)
-            shutil.copy2(_locals["file_path"], dest_path)
-            logger.info(f"复制文件 {_locals['file_path']} 到 {dest_path}")
-        
-        # 写入代码到临时文件
-        code_file = os.path.join(temp_dir, "code_to_execute.py")
-        with open(code_file, "w", encoding="utf-8") as f:
-            f.write(code)
-        
-        # 设置环境变量
-        env = os.environ.copy()
-        env["PYTHONIOENCODING"] = "utf-8"
-        env["PROJECT_ROOT"] = project_root  # 添加项目根目录环境变量
-        
-        # 执行代码，设置超时
-        try:
-            process = subprocess.Popen(
-                [sys.executable, code_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=False,  # 改为二进制模式
-                cwd=temp_dir,
-                env=env
+        session_id = _locals.get("session_id")
+        if session_id:
+            # 有会话ID时使用常驻内核，变量在多次执行之间保留
+            result = kernel_manager.execute(
+                session_id,
+                code,
+                file_path=_locals.get("file_path"),
+                timeout=timeout,
+                on_output=on_output,
+                limits=limits,
+                env=env,
             )
-            
-            # 设置超时时间为30秒
-            try:
-                stdout_bytes, stderr_bytes = process.communicate(timeout=30)
-                # 使用utf-8解码
-                stdout = stdout_bytes.decode('utf-8', errors='replace')
-                stderr = stderr_bytes.decode('utf-8', errors='replace')
-                execution_result = stdout
-                if stderr:
-                    execution_result += f"\n错误输出:\n{stderr}"
-                
-            except subprocess.TimeoutExpired:
-                process.kill()
-                execution_result = "错误: 代码执行超时（30秒）"
-                
-        except Exception as e:
-            execution_result = f"代码执行错误: {str(e)}"
-    
-        # 确定执行期间创建的新变量
-        # 注意：这里我们无法获取子进程中创建的变量，这只是一个占位符
-        # 实际使用时，可能需要通过其他方式传递变量
-        new_keys = set(_locals.keys()) - original_keys
-        new_vars = {key: _locals[key] for key in new_keys}
-        
-        return execution_result, new_vars
-        
-    finally:
-        # 清理临时目录
-        try:
-            shutil.rmtree(temp_dir)
-            logger.info(f"清理临时目录: {temp_dir}")
-        except Exception as e:
-            logger.error(f"清理临时目录失败: {e}")
+        else:
+            # 否则从预热内核池检出一个干净的内核，执行后回收
+            result = kernel_pool.run(
+                code,
+                file_path=_locals.get("file_path"),
+                timeout=timeout,
+                on_output=on_output,
+                limits=limits,
+                env=env,
+            )
+        execution_result = format_execution_result(result, timeout)
+        artifacts = result.get("artifacts", [])
+        usage = result.get("usage")
+        plots = result.get("plots") or []
+        logger.info(f"代码执行资源使用: {json.dumps(usage, ensure_ascii=False)}")
+
+        # 成功且可复现的执行结果写入缓存
+        if result_cache.enabled and result["status"] == "ok" and not result.get("limit_exceeded") and is_deterministic(code):
+            key = make_key(code, file_digest(_locals.get("file_path")), result.get("context", ""))
+            result_cache.put(key, {name: result.get(name) for name in CACHED_RESULT_FIELDS})
+    except Exception as e:
+        execution_result = f"代码执行错误: {str(e)}"
+        artifacts = []
+        usage = None
+        plots = []
+
+    # 子进程中创建的变量保留在内核里，只回传被截断输出的引用、资源使用记录和自动捕获的图表
+    return execution_result, {"output_artifacts": artifacts, "execution_usage": usage, "execution_cached": False, "execution_plots": plots}
+
+# 缓存中保存的执行结果字段
+CACHED_RESULT_FIELDS = ("status", "error", "stdout", "stderr", "artifacts", "usage", "limit_exceeded", "plots")
+
+def lookup_cached_execution(code: str, state: AgentState) -> Optional[tuple[str, dict[str, Any]]]:
+    """查找相同代码、相同输入文件、相同内核上下文的缓存结果，命中时无需执行"""
+    if not result_cache.enabled:
+        return None
+    if not is_deterministic(code):
+        result_cache.record_skip()
+        return None
+
+    session_id = state.get("session_id")
+    context = kernel_manager.context_digest(session_id) if session_id else ""
+    cached = result_cache.get(make_key(code, file_digest(state.get("file_path")), context))
+    if cached is None:
+        return None
+
+    if session_id:
+        # 内核状态按已执行处理，下次真正执行前补跑；补跑失败会在那次的观察结果中报告
+        kernel_manager.defer(session_id, code, label=f"第 {state.get('current_step', 0)} 步命中缓存的代码")
+    logger.info("代码执行结果命中缓存")
+    return format_execution_result(cached, CELL_TIMEOUT), {
+        "output_artifacts": cached.get("artifacts") or [],
+        "execution_usage": cached.get("usage"),
+        "execution_cached": True,
+        "execution_plots": [plot for plot in cached.get("plots") or [] if os.path.exists(plot["path"])],
+    }
+
+def execute_code_node(
+    state: AgentState,
+    on_output: Optional[Callable[[str, str], None]] = None,
+    on_queue: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> AgentState:
+    """执行代码节点
 
-def execute_code_node(state: AgentState) -> AgentState:
-    """执行代码节点"""
+    代码先在全局调度器中排队获取执行槽位，on_queue 会收到排队位置与等待时间。
+    """
     code = state.get("code_to_execute")
     if not code:
         logger.warning("没有代码可执行")
@@ -438,13 +594,44 @@ def execute_code_node(state: AgentState) -> AgentState:
             state["intermediate_steps"][-1]["observation"] = "错误：没有代码可执行"
         return state
 
-    # 使用安全沙箱执行代码
-    execution_result, new_vars = safe_code_executor(state.get("code_to_execute") or code, state)
+    # 静态预检：能修正的直接改写，不能修正的直接把诊断作为观察结果，不启动执行
+    check = preflight_check(code, state.get("file_path"))
+    report = format_preflight_report(check)
+    state["preflight"] = {"ok": check["ok"], "errors": check["errors"], "fixes": check["fixes"]}
+    if report:
+        logger.info(f"代码预检: {report}")
+
+    large_file = state.get("large_file") or state.get("large_file_pending")
+    state["execution_timeout"] = FULL_DATA_TIMEOUT if large_file and is_full_data_run(code) else None
+
+    if not check["ok"]:
+        execution_result, new_vars = report, {"output_artifacts": [], "execution_usage": None, "execution_cached": False, "execution_plots": []}
+    else:
+        code = check["code"]
+        cached = lookup_cached_execution(code, state)
+        if cached is not None:
+            execution_result, new_vars = cached
+        else:
+            # 在全局调度器分配的槽位中，使用安全沙箱执行代码
+            user_id = state.get("user_id") or state.get("session_id") or "anonymous"
+            try:
+                with execution_scheduler.slot(user_id, code, on_update=on_queue, cancel_event=cancel_event):
+                    execution_result, new_vars = safe_code_executor(code, state, on_output=on_output)
+            except ExecutionCancelled:
+                execution_result, new_vars = "执行已取消", {"output_artifacts": [], "execution_usage": None, "execution_cached": False, "execution_plots": []}
+        if report:
+            execution_result = f"{report}\n\n{execution_result}"
     
     # 更新状态
     state["execution_result"] = execution_result
     if state.get("intermediate_steps") and len(state["intermediate_steps"]) > 0:
         state["intermediate_steps"][-1]["observation"] = execution_result
+        if new_vars.get("output_artifacts"):
+            state["intermediate_steps"][-1]["artifacts"] = new_vars["output_artifacts"]
+        if new_vars.get("execution_usage"):
+            state["intermediate_steps"][-1]["usage"] = new_vars["execution_usage"]
+        if new_vars.get("execution_plots"):
+            state["intermediate_steps"][-1]["plots"] = new_vars["execution_plots"]
     state["code_to_execute"] = None
 
     # 将新变量添加到状态中
@@ -453,6 +640,50 @@ def execute_code_node(state: AgentState) -> AgentState:
     
     return state
 
+def run_sql_node(
+    state: AgentState,
+    on_output: Optional[Callable[[str, str], None]] = None,
+    on_queue: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> AgentState:
+    """SQL 查询节点
+
+    与代码执行共用全局调度器的执行槽位；完整结果写入 parquet，
+    有常驻内核时在下一次执行代码前设置变量 sql_result_path，不超过读入上限的结果同时读入 sql_result。
+    """
+    sql = state.get("sql_to_execute")
+    if not sql:
+        logger.warning("没有 SQL 可执行")
+        if state.get("intermediate_steps"):
+            state["intermediate_steps"][-1]["observation"] = "错误：没有 SQL 可执行"
+        return state
+
+    user_id = state.get("user_id") or state.get("session_id") or "anonymous"
+    session_id = state.get("session_id")
+    try:
+        with execution_scheduler.slot(user_id, sql, on_update=on_queue, cancel_event=cancel_event):
+            result = run_query(sql, state["file_path"], cancel_event=cancel_event)
+        loaded = should_load(result)
+        if result["status"] == "ok" and session_id:
+            label = "SQL 结果读入 sql_result" if loaded else "设置 SQL 结果路径 sql_result_path"
+            kernel_manager.defer(session_id, load_result_code(result["path"], preload=loaded), label=label)
+        execution_result = format_sql_result(result, in_session=bool(session_id), loaded=loaded)
+    except ExecutionCancelled:
+        execution_result = "执行已取消"
+    except Exception as e:
+        execution_result = f"SQL 执行错误: {str(e)}"
+
+    state["execution_result"] = execution_result
+    if state.get("intermediate_steps"):
+        state["intermediate_steps"][-1]["observation"] = execution_result
+    state["sql_to_execute"] = None
+    state["output_artifacts"] = []
+    state["execution_usage"] = None
+    state["execution_cached"] = False
+    state["execution_plots"] = []
+    state["preflight"] = None
+    return state
+
 def final_answer_node(state: AgentState) -> AgentState:
     """生成最终回答"""
     action_input = state.get("action_input")
@@ -501,7 +732,7 @@ def define_tools():
         """检测文件类型"""
         if file_path:
             extension = os.path.splitext(file_path)[1].lower()
-            if extension in ['.csv', '.xlsx', '.xls']:
+            if previewer_file_type(file_path) == 'data':
                 return 'data'
             elif extension in ['.py']:
                 return 'python'
@@ -543,9 +774,93 @@ def create_codeact_workflow(llm):
     # 编译工作流（不使用checkpointer）
     return code_act.compile()
 
-async def process_query_streaming(instruction: str, file_path: Optional[str] = None, history_messages: Optional[List[Dict]] = None):
-    """流式处理用户查询，实时返回每一步的思考过程"""
-    import asyncio
+async def stream_events(run: Callable[[Callable[[Dict[str, Any]], None]], Awaitable[Any]], step: int):
+    """
+    运行 run(emit)，同时把通过 emit 发出的事件（thought_delta、action_delta、llm_queued 等）流式返回
+
+    最后一个事件为 {"type": "_result", "result": ...}，携带 run 的返回值，不对外转发。
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    task = asyncio.ensure_future(run(events.put_nowait))
+    try:
+        while True:
+            getter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield {**getter.result(), "step": step}
+                continue
+            getter.cancel()
+            break
+        while not events.empty():
+            yield {**events.get_nowait(), "step": step}
+        yield {"type": "_result", "result": task.result()}
+    except (asyncio.CancelledError, GeneratorExit):
+        # 用户中止：停止生成
+        task.cancel()
+        raise
+
+async def stream_code_execution(state: AgentState, step: int, node: Callable[..., AgentState] = None):
+    """
+    在线程中执行代码（node 默认为 execute_code_node，SQL 查询为 run_sql_node），同时把增量输出作为 code_execution_output 事件、
+    排队状态作为 code_execution_queued 事件流式返回
+
+    最后一个事件为 {"type": "_state", "state": ...}，携带执行后的状态，不对外转发。
+    """
+
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    cancel_event = threading.Event()
+
+    def on_output(stream: str, text: str):
+        loop.call_soon_threadsafe(events.put_nowait, (stream, text))
+
+    def on_queue(info: Dict[str, Any]):
+        loop.call_soon_threadsafe(events.put_nowait, ("queue", info))
+
+    def drain(pending: List[tuple]):
+        # 合并队列中相邻的同类输出，减少事件数量
+        while not events.empty():
+            pending.append(events.get_nowait())
+        merged: List[Dict[str, Any]] = []
+        for stream, data in pending:
+            if stream == "queue":
+                merged.append({"type": "code_execution_queued", "step": step, **data})
+            elif merged and merged[-1].get("stream") == stream:
+                merged[-1]["content"] += data
+            else:
+                merged.append({"type": "code_execution_output", "step": step, "stream": stream, "content": data})
+        return merged
+
+    task = loop.run_in_executor(execution_executor, node or execute_code_node, state, on_output, on_queue, cancel_event)
+    try:
+        while not task.done():
+            pending: List[tuple] = []
+            waiter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if waiter in done:
+                pending.append(waiter.result())
+                # 让紧随其后的输出一起合并
+                await asyncio.sleep(0.05)
+            else:
+                waiter.cancel()
+            for event in drain(pending):
+                yield event
+        for event in drain([]):
+            yield event
+        yield {"type": "_state", "state": await task}
+    except (asyncio.CancelledError, GeneratorExit):
+        # 用户中止：撤销排队，并中断内核里仍在运行的代码
+        cancel_event.set()
+        if state.get("session_id"):
+            kernel_manager.interrupt(state["session_id"])
+        raise
+
+async def process_query_streaming(instruction: str, file_path: Optional[str] = None, history_messages: Optional[List[Dict]] = None, session_id: Optional[str] = None, user_role: Optional[str] = None, user_id: Optional[str] = None):
+    """流式处理用户查询，实时返回每一步的思考过程
+
+    session_id 不为空时，代码在该会话的常驻内核中执行，变量跨轮次保留。
+    user_role 决定代码执行的资源限制，user_id 用于全局调度器的公平排队。
+    """
     from typing import AsyncGenerator
     
     # 初始化对话消息
@@ -572,6 +887,8 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
 
     # 将文件上下文注入为系统消息
     if file_path and os.path.exists(file_path):
+        # 记录最近使用，容量回收时最后才考虑删除
+        touch_file(file_path)
         try:
             file_name = os.path.basename(file_path)
             file_type = detect_file_type(file_path)
@@ -595,6 +912,7 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
         "file_content": None,
         "file_type": detect_file_type(file_path) if file_path and os.path.exists(file_path) else None,
         "code_to_execute": None,
+        "sql_to_execute": None,
         "execution_result": None,
         "intermediate_steps": [],
         "current_step": 0,
@@ -603,11 +921,73 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
         "action_input": None,
         "observation": None,
         "is_done": False,
+        "session_id": session_id,
+        "user_id": user_id,
+        "user_role": user_role,
+        "file_profile": None,
+        "large_file": None,
+        "large_file_pending": False,
+        "execution_timeout": None,
+        "file_context": None,
+        "sql_enabled": False,
     }
 
+    # 等待后台数据概况分析（上传时已提交，这里重复提交不会重复分析），超时则使用原始预览
+    if file_path and os.path.exists(file_path):
+        profile_future = dataset_profiler.submit(file_path)
+        if profile_future is not None:
+            try:
+                state["file_profile"] = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(profile_future)), PROFILE_WAIT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                logger.info(f"数据概况分析未在 {PROFILE_WAIT_SECONDS}s 内完成，使用原始预览")
+
+    # 大文件模式：最多等待 SAMPLE_WAIT_SECONDS 秒（同一文件只抽样一次），超时则先开始分析，
+    # 样本就绪后在下一步思考之前补充到提示词；抽样结果通过事件告知前端
+    sample_future = large_file_sampler.submit(file_path)
+    file_size = os.path.getsize(file_path) if sample_future is not None else 0
+
+    def large_file_ready() -> Dict[str, Any]:
+        return {
+            "type": "large_file_mode",
+            "step": state["current_step"],
+            "status": "ready",
+            "file_size": file_size,
+            "threshold": LARGE_FILE_BYTES,
+            "tables": state["large_file"]["tables"],
+            "elapsed": state["large_file"]["elapsed"],
+        }
+
+    if sample_future is not None:
+        yield {
+            "type": "large_file_mode",
+            "step": 0,
+            "status": "sampling",
+            "file_size": file_size,
+            "threshold": LARGE_FILE_BYTES,
+        }
+        try:
+            state["large_file"] = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(sample_future)), SAMPLE_WAIT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.info(f"大文件抽样未在 {SAMPLE_WAIT_SECONDS}s 内完成，先开始分析，样本就绪后再使用")
+            state["large_file_pending"] = True
+        if state["large_file"]:
+            yield large_file_ready()
+
     try:
         # 迭代式 ReAct 回路，每一步都流式返回
         for iteration in range(state.get("max_iterations", 5)):
+            # 后台抽样在分析过程中完成：重新生成文件说明，之后的步骤使用样本
+            if state["large_file_pending"] and sample_future.done():
+                state["large_file_pending"] = False
+                state["large_file"] = sample_future.result()
+                state["file_context"] = None
+                if state["large_file"]:
+                    yield large_file_ready()
+
             # 发送步骤开始信号
             yield {
                 "type": "step_start",
@@ -615,8 +995,16 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                 "message": f"🤔 开始第 {iteration + 1} 步思考..."
             }
 
-            # 1) 让 Agent 分析并给出"思考/行动/行动输入"
-            state = react_agent_node(state)
+            # 1) 让 Agent 分析并给出"思考/行动/行动输入"，生成过程中流式返回增量内容
+            agent_events = stream_events(lambda emit: react_agent_node(state, on_delta=emit), iteration + 1)
+            try:
+                async for event in agent_events:
+                    if event["type"] == "_result":
+                        state = event["result"]
+                    else:
+                        yield event
+            finally:
+                await agent_events.aclose()
             
             # 获取当前步骤信息
             current_step = state.get("intermediate_steps", [])[-1] if state.get("intermediate_steps") else {}
@@ -632,6 +1020,15 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                     "content": thought
                 }
 
+            # 回复无法解析：把错误说明作为观察返回，下一轮让模型重新回复
+            if action == INVALID_REPLY_ACTION:
+                yield {
+                    "type": "observation",
+                    "step": iteration + 1,
+                    "content": current_step.get("observation", "")
+                }
+                continue
+
             # 流式返回行动
             if action:
                 yield {
@@ -662,10 +1059,24 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                     
                     # 获取最近一次的LLM思考和代码执行结果
                     last_thought = thought if thought else ""
+
+                    # 超出预算时压缩较早的执行结果，最后一次保留完整内容
+                    all_execution_results, compaction = compact_texts(all_execution_results, report_budget(last_thought))
+                    if compaction:
+                        yield {"type": "context_compacted", "step": iteration + 1, "scope": "report", **compaction}
                     
                     # 调用makeReport函数生成报告，并将其作为最终答案
                     try:
-                        report_md = makeReport(last_thought, all_execution_results)
+                        # 报告请求排队时把 llm_queued 事件转发给前端
+                        report_events = stream_events(lambda emit: makeReport(last_thought, all_execution_results, emit), iteration + 1)
+                        try:
+                            async for event in report_events:
+                                if event["type"] == "_result":
+                                    report_md = event["result"]
+                                else:
+                                    yield event
+                        finally:
+                            await report_events.aclose()
                         print(report_md) # debug
                         # 输出报告作为最终答案
                         yield {
@@ -707,10 +1118,24 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                 
                 # 获取最近一次的LLM思考和代码执行结果
                 last_thought = thought if thought else ""
+
+                # 超出预算时压缩较早的执行结果，最后一次保留完整内容
+                all_execution_results, compaction = compact_texts(all_execution_results, report_budget(last_thought))
+                if compaction:
+                    yield {"type": "context_compacted", "step": iteration + 1, "scope": "report", **compaction}
                 
                 # 调用makeReport函数生成报告，并将其作为最终答案
                 try:
-                    report_md = makeReport(last_thought, all_execution_results)
+                    # 报告请求排队时把 llm_queued 事件转发给前端
+                    report_events = stream_events(lambda emit: makeReport(last_thought, all_execution_results, emit), iteration + 1)
+                    try:
+                        async for event in report_events:
+                            if event["type"] == "_result":
+                                report_md = event["result"]
+                            else:
+                                yield event
+                    finally:
+                        await report_events.aclose()
                     print(report_md) # debug
                     # 输出报告作为最终答案
                     yield {
@@ -730,31 +1155,49 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                         }
                 break
 
-            # 2.2) 只保留 execute_code 相关判断
-            if ("执行代码" in action_text) or (normalized_action in ("execute_code",)) or ("execute_code" in action_text):
+            # 2.2) execute_code 与 run_sql 相关判断
+            is_sql = (normalized_action == "run_sql") or ("run_sql" in action_text)
+            if is_sql or ("执行代码" in action_text) or (normalized_action in ("execute_code",)) or ("execute_code" in action_text):
                 # 流式显示代码执行开始
                 if isinstance(action_input, str):
                     code = action_input
                 elif isinstance(action_input, dict):
-                    code = action_input.get("code")
+                    code = (action_input.get("sql") or action_input.get("query")) if is_sql else action_input.get("code")
                 else:
                     code = None
                 if code:
-                    state["code_to_execute"] = code
+                    state["sql_to_execute" if is_sql else "code_to_execute"] = code
                     print(f"----------\n{code}\n----------")
                     yield {
                         "type": "code_execution_start",
                         "step": iteration + 1,
-                        "code": code
+                        "code": code,
+                        "language": "sql" if is_sql else "python",
+                        # 大文件模式下标明本步骤运行在样本还是全量数据上；SQL 总是扫描全量数据
+                        "data_scope": ("full" if is_sql or is_full_data_run(code) else "sample") if state.get("large_file") else None
                     }
-                # 执行代码
-                state = execute_code_node(state)
+                # 执行代码，运行期间流式返回增量输出
+                execution_events = stream_code_execution(state, iteration + 1, run_sql_node if is_sql else execute_code_node)
+                try:
+                    async for event in execution_events:
+                        if event["type"] == "_state":
+                            state = event["state"]
+                        else:
+                            yield event
+                finally:
+                    # 前端中止时关闭执行流，由其负责中断内核
+                    await execution_events.aclose()
                 # 流式返回执行结果
                 execution_result = state.get("execution_result") or "(无输出)"
                 yield {
                     "type": "code_execution_result",
                     "step": iteration + 1,
-                    "result": execution_result
+                    "result": execution_result,
+                    "artifacts": state.get("output_artifacts") or [],
+                    "usage": state.get("execution_usage"),
+                    "preflight": state.get("preflight"),
+                    "cached": bool(state.get("execution_cached")),
+                    "plots": state.get("execution_plots") or []
                 }
                 # 更新观察结果
                 if state.get("intermediate_steps") and len(state["intermediate_steps"]) > 0:
@@ -765,10 +1208,7 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
                     "step": iteration + 1,
                     "content": execution_result
                 }
-                # 将执行结果反馈为"观察"，继续下一轮对话
-                state_messages = list(state["messages"])
-                state_messages.append(HumanMessage(content=f"观察:\n{execution_result}\n\n请根据观察更新你的计划或给出最终答案。"))
-                state["messages"] = state_messages
+                # 观察已记录在步骤中，下一轮作为消息发送给模型
                 continue
 
             # 其他动作，直接继续下一轮
@@ -800,27 +1240,50 @@ async def process_query_streaming(instruction: str, file_path: Optional[str] = N
             "message": f"处理失败: {str(e)}"
         }
 
-def makeReport(last_thought, all_execution_results):
+REPORT_PROMPT_TEMPLATE = """
+    你是一个数据分析助手，请根据以下信息生成一份Markdown格式的报告：
+    历史分析过程如下
+    {thought}
+    历史代码执行结果如下
+    {results}
+    请生成一份结构清晰的Markdown报告，必要时附带上图片
+    注意，你只需要以Markdown格式的文本返回报告,不需要任何语法的包裹。
+    """
+
+def report_budget(last_thought: str) -> int:
+    """报告提示词中执行结果部分可用的 token 数"""
+    return CONTEXT_MAX_TOKENS - count_tokens(REPORT_PROMPT_TEMPLATE) - count_tokens(last_thought)
+
+async def invoke_text(prompt: str, on_event: Optional[Callable[[Dict[str, Any]], None]] = None) -> str:
+    """调用大模型生成一段文本：开启回复缓存时优先使用缓存，否则经全局限流器排队调用"""
+    cache_key = make_cache_key(llm, prompt)
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        logger.info("命中大模型回复缓存")
+        return cached
+    on_queue = (lambda info: on_event({"type": "llm_queued", **info})) if on_event is not None else None
+    response = await llm_limiter.call(lambda: llm.ainvoke(prompt), count_tokens(prompt) + OUTPUT_TOKEN_RESERVE, on_queue)
+    content = response.content
+    await llm_cache.aput(cache_key, model_identity(llm)["model"], content)
+    return content
+
+async def makeReport(last_thought, all_execution_results, on_event=None):
     """
     生成任务执行报告，包含思考过程和执行结果
+
+    限流或服务端错误在 invoke_text 中已经退避重试过，不再用更短的输入重复请求；
+    其它错误（例如输入过长）依次尝试后半部分结果、最后一次结果。
     
     Args:
         last_thought (str): 最后一次LLM的思考内容
         all_execution_results (list): 所有历史步骤的执行结果列表
+        on_event (callable): 接收排队事件（llm_queued）的回调
         
     Returns:
         str: Markdown格式的报告内容
     """
     # 提示词模板
-    prompt_template = """
-    你是一个数据分析助手，请根据以下信息生成一份Markdown格式的报告：
-    历史分析过程如下
-    {thought}
-    历史代码执行结果如下
-    {results}
-    请生成一份结构清晰的Markdown报告，必要时附带上图片
-    注意，你只需要以Markdown格式的文本返回报告,不需要任何语法的包裹。
-    """
+    prompt_template = REPORT_PROMPT_TEMPLATE
     
     try:
         # 第一次尝试：使用所有执行结果
@@ -828,8 +1291,10 @@ def makeReport(last_thought, all_execution_results):
         prompt = prompt_template.format(thought=last_thought, results=all_results_text)
         
         # 调用AI生成报告
-        return llm.invoke(prompt).content
+        return await invoke_text(prompt, on_event)
     except Exception as e:
+        if is_retryable(e):
+            raise
         logger.warning(f"使用全部执行结果生成报告失败: {str(e)}，尝试使用后半部分结果")
         
         try:
@@ -840,8 +1305,10 @@ def makeReport(last_thought, all_execution_results):
             prompt = prompt_template.format(thought=last_thought, results=half_results_text)
             
             # 调用AI生成报告
-            return llm.invoke(prompt).content
+            return await invoke_text(prompt, on_event)
         except Exception as e:
+            if is_retryable(e):
+                raise
             logger.warning(f"使用后半部分执行结果生成报告失败: {str(e)}，尝试仅使用最后一次执行结果")
             
             try:
@@ -852,11 +1319,11 @@ def makeReport(last_thought, all_execution_results):
                     prompt = prompt_template.format(thought=last_thought, results=last_result_text)
                     
                     # 调用AI生成报告
-                    return llm.invoke(prompt).content
+                    return await invoke_text(prompt, on_event)
                 else:
                     # 没有执行结果
                     prompt = prompt_template.format(thought=last_thought, results="没有执行结果。")
-                    return llm.invoke(prompt).content
+                    return await invoke_text(prompt, on_event)
             except Exception as e:
                 logger.error(f"生成报告最终失败: {str(e)}")
                 return f"# 报告生成失败\n\n生成报告时发生错误: {str(e)}"
@@ -0,0 +1,236 @@
+"""
+大文件模式
+
+上传文件超过大小阈值时，先按块扫描一遍抽取一份蓄水池样本（有合适的低基数分类列时，
+额外保证每个类别至少有若干行），保存为列式文件并按内容哈希缓存在 data/cache/samples。
+探索性步骤（查看结构、试算、调试代码）只读取样本；分析方案确认后，
+代码第一行带有 FULL_DATA_MARKER 的步骤才在全量数据上运行，并使用更长的超时。
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, Any
+
+from app.result_cache import file_digest
+from app.profiler import iter_tables
+from app.columnar_cache import table_from_frame, write_table, safe_name
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SAMPLE_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "samples")
+
+LARGE_FILE_BYTES = int(os.getenv("IDA_LARGE_FILE_BYTES", str(512 * 1024 * 1024)))
+SAMPLE_ROWS = int(os.getenv("IDA_SAMPLE_ROWS", "100000"))
+FULL_DATA_TIMEOUT = int(os.getenv("IDA_FULL_DATA_TIMEOUT", "600"))
+# 第一步思考前最多等待抽样完成的秒数，超时则先开始分析，样本就绪后再补充到提示词
+SAMPLE_WAIT_SECONDS = float(os.getenv("IDA_SAMPLE_WAIT_SECONDS", "30"))
+
+# 分层抽样：分类列的取值个数上限，以及每个类别至少保留的行数
+MAX_STRATA = 50
+MIN_PER_STRATUM = 50
+FULL_DATA_MARKER = "# ida:full-data"
+_MARKER_PATTERN = re.compile(r"^\s*#\s*ida\s*:\s*full-data\b", re.IGNORECASE | re.MULTILINE)
+# 抽样逻辑变化时递增，使旧样本失效
+SAMPLE_VERSION = 1
+
+ROW_COLUMN = "_ida_row"
+KEY_COLUMN = "_ida_key"
+
+
+def is_large_file(file_path: Optional[str]) -> bool:
+    return bool(file_path) and os.path.exists(file_path) and os.path.getsize(file_path) >= LARGE_FILE_BYTES
+
+
+def is_full_data_run(code: Optional[str]) -> bool:
+    """代码中带有全量数据标记时在全量数据上运行"""
+    return bool(code) and bool(_MARKER_PATTERN.search(code))
+
+
+def choose_strata_column(chunk) -> Optional[str]:
+    """从第一块数据中选一个取值较少的分类列作为分层依据"""
+    import pandas as pd
+
+    for column in chunk.columns:
+        series = chunk[column]
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            continue
+        distinct = series.nunique(dropna=True)
+        if 2 <= distinct <= MAX_STRATA and distinct < len(series) / 10:
+            return str(column)
+    return None
+
+
+def _sample_table(chunks, sample_rows: int, seed: int) -> Dict[str, Any]:
+    """
+    单遍蓄水池抽样：每行分配一个随机键，始终保留键最小的 sample_rows 行；
+    分层列存在时，每个类别另外保留键最小的 MIN_PER_STRATUM 行，保证少数类别也出现在样本中
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    strata: Dict[Any, Any] = {}
+    strata_column = None
+    total = 0
+
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        if total == 0:
+            strata_column = choose_strata_column(chunk)
+        chunk = chunk.assign(**{
+            ROW_COLUMN: np.arange(total, total + len(chunk)),
+            KEY_COLUMN: rng.random(len(chunk)),
+        })
+        total += len(chunk)
+        reservoir = chunk if reservoir is None else pd.concat([reservoir, chunk], ignore_index=True)
+        reservoir = reservoir.nsmallest(sample_rows, KEY_COLUMN)
+
+        if strata_column is not None:
+            for value, group in chunk.groupby(strata_column, dropna=False, sort=False):
+                if value not in strata and len(strata) >= MAX_STRATA:
+                    continue
+                previous = strata.get(value)
+                group = group if previous is None else pd.concat([previous, group], ignore_index=True)
+                strata[value] = group.nsmallest(MIN_PER_STRATUM, KEY_COLUMN)
+
+    if reservoir is None:
+        return {"frame": None, "rows_total": 0, "strata_column": None}
+    sample = pd.concat([reservoir, *strata.values()], ignore_index=True) if strata else reservoir
+    sample = (
+        sample.drop_duplicates(ROW_COLUMN)
+        .sort_values(ROW_COLUMN)
+        .drop(columns=[ROW_COLUMN, KEY_COLUMN])
+        .reset_index(drop=True)
+    )
+    return {"frame": sample, "rows_total": total, "strata_column": strata_column}
+
+
+def _manifest_path(digest: str) -> str:
+    return os.path.join(SAMPLE_DIR, digest, "manifest.json")
+
+
+def load_sample(digest: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_manifest_path(digest), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != SAMPLE_VERSION or manifest.get("sample_rows_target") != SAMPLE_ROWS:
+        return None
+    if not all(os.path.exists(table["path"]) for table in manifest["tables"]):
+        return None
+    return manifest
+
+
+def build_sample(file_path: str) -> Dict[str, Any]:
+    """抽取样本并按内容哈希缓存，返回样本清单"""
+    digest = file_digest(file_path)
+    manifest = load_sample(digest)
+    if manifest is not None:
+        return manifest
+
+    started = time.time()
+    sample_dir = os.path.dirname(_manifest_path(digest))
+    os.makedirs(sample_dir, exist_ok=True)
+    tables: List[Dict[str, Any]] = []
+    seed = int(digest[:8], 16)
+    for index, (name, chunks) in enumerate(iter_tables(file_path)):
+        sampled = _sample_table(chunks, SAMPLE_ROWS, seed)
+        if sampled["frame"] is None:
+            continue
+        path = os.path.join(sample_dir, f"{index:02d}_{safe_name(name or 'data')}.feather")
+        write_table(table_from_frame(sampled["frame"]), path)
+        tables.append({
+            "name": name,
+            "path": path,
+            "rows_total": sampled["rows_total"],
+            "sample_rows": len(sampled["frame"]),
+            "strata_column": sampled["strata_column"],
+        })
+
+    manifest = {
+        "version": SAMPLE_VERSION,
+        "digest": digest,
+        "file_size": os.path.getsize(file_path),
+        "sample_rows_target": SAMPLE_ROWS,
+        "tables": tables,
+        "elapsed": round(time.time() - started, 3),
+    }
+    tmp_path = f"{_manifest_path(digest)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, _manifest_path(digest))
+    logger.info(
+        f"大文件样本已生成: {file_path}，"
+        + "，".join(f"{t['sample_rows']}/{t['rows_total']} 行" for t in tables)
+        + f"，耗时 {manifest['elapsed']:.2f}s"
+    )
+    return manifest
+
+
+class LargeFileSampler:
+    """在后台线程中为大文件抽样，同一文件只抽样一次"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="large-file-sampler")
+        self.lock = threading.Lock()
+        self.futures: Dict[str, Future] = {}
+
+    def _run(self, file_path: str) -> Optional[Dict[str, Any]]:
+        try:
+            return build_sample(file_path)
+        except Exception as e:
+            logger.error(f"大文件抽样失败: {file_path}: {e}")
+            return None
+
+    def submit(self, file_path: Optional[str]) -> Optional[Future]:
+        """提交后台抽样任务（不是大文件时返回 None）"""
+        if not is_large_file(file_path):
+            return None
+        key = os.path.abspath(file_path)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.result() is None):
+                future = self.executor.submit(self._run, key)
+                self.futures[key] = future
+        return future
+
+
+def format_for_prompt(manifest: Optional[Dict[str, Any]]) -> str:
+    """提示词中的大文件模式说明"""
+    if not manifest or not manifest["tables"]:
+        return ""
+    size_mb = manifest["file_size"] / 1024 / 1024
+    lines = [f"大文件模式：原文件 {size_mb:.0f}MB，已抽取样本（列式文件，读取很快）:"]
+    for table in manifest["tables"]:
+        label = f"表 {table['name']!r}" if table.get("name") is not None else "数据"
+        strata = f"，按列 {table['strata_column']!r} 分层" if table.get("strata_column") else ""
+        lines.append(
+            f"- {label}: 样本 {table['sample_rows']} 行 / 共 {table['rows_total']} 行{strata}: "
+            f"pd.read_feather(r'{table['path']}')"
+        )
+    lines.append(
+        f"探索性步骤（查看结构、试算、调试代码）只读取样本。分析方案确认后，把最终计算写成一段代码，"
+        f"第一行写 `{FULL_DATA_MARKER}`，该步骤会在全量数据上运行（超时 {FULL_DATA_TIMEOUT} 秒）；"
+        f"其中读取全量数据（优先使用列式缓存），只打印最终结果。最终回答中的数字必须来自全量数据的计算。"
+    )
+    return "\n".join(lines)
+
+
+def format_pending_for_prompt(file_size: int) -> str:
+    """样本尚未就绪时提示词中的大文件模式说明"""
+    return (
+        f"大文件模式：原文件 {file_size / 1024 / 1024:.0f}MB，样本仍在抽取中，完成后会提供样本文件。"
+        f"在此之前不要把整个文件读入内存，查看结构、试算时只读取前若干行（例如 nrows=10000）；"
+        f"需要全量数据的最终计算，第一行写 `{FULL_DATA_MARKER}`（超时 {FULL_DATA_TIMEOUT} 秒），只打印最终结果。"
+    )
+
+
+large_file_sampler = LargeFileSampler()
@@ -0,0 +1,173 @@
+"""
+大模型回复缓存（可选）
+
+同一数据集上的固定分析（演示、回归检查、定时报告）每天会重复运行多次，temperature=0 时
+相同的输入基本得到相同的回复。开启后按 (模型名称, temperature, 规范化后的消息列表) 精确匹配，
+命中时直接返回之前的回复，不再请求服务端。
+
+回复保存在 SQLite 文件 data/cache/llm/responses.sqlite 中（WAL 模式，多个进程可以共用），
+超过 LLM_CACHE_TTL 秒的条目视为过期，总大小超过上限时删除最久未使用的条目。
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional, Sequence, Union
+
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+LLM_CACHE_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "llm")
+LLM_CACHE_PATH = os.path.join(LLM_CACHE_DIR, "responses.sqlite")
+
+LLM_CACHE_ENABLED = os.getenv("IDA_LLM_CACHE_ENABLED", "0").lower() not in ("0", "false", "no")
+LLM_CACHE_TTL = int(os.getenv("IDA_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.getenv("IDA_LLM_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# 提示词格式、回复处理方式或保存的回复格式变化时递增，使旧缓存失效
+# 2: 智能体回复保存为解析结果序列化后的完整 JSON（版本 1 可能保存了提前结束时截断的原文）
+LLM_CACHE_VERSION = "2"
+# 超出上限后删除到上限的这个比例
+LOW_WATER_RATIO = 0.9
+_TRAILING_SPACE = re.compile(r"[ \t]+(?=\n)")
+
+
+def normalize_messages(messages: Union[str, Sequence[BaseMessage]]) -> list:
+    """规范化消息列表：统一换行符、去掉行尾和首尾空白，只保留角色和内容"""
+    if isinstance(messages, str):
+        messages = [("human", messages)]
+    else:
+        messages = [(message.type, message.content) for message in messages]
+    normalized = []
+    for role, content in messages:
+        if isinstance(content, str):
+            content = _TRAILING_SPACE.sub("", content.replace("\r\n", "\n")).strip()
+        normalized.append([role, content])
+    return normalized
+
+
+def model_identity(model: Any) -> Dict[str, Any]:
+    """缓存键中的模型部分：名称与 temperature"""
+    name = getattr(model, "model_name", None) or getattr(model, "model", None) or type(model).__name__
+    return {"model": str(name), "temperature": getattr(model, "temperature", None)}
+
+
+def make_key(model: Any, messages: Union[str, Sequence[BaseMessage]]) -> str:
+    payload = {"version": LLM_CACHE_VERSION, **model_identity(model), "messages": normalize_messages(messages)}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """SQLite 中的大模型回复缓存，带过期时间和总大小上限（按最近使用时间淘汰）"""
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_PATH,
+        ttl: int = LLM_CACHE_TTL,
+        max_bytes: int = LLM_CACHE_MAX_BYTES,
+        enabled: bool = LLM_CACHE_ENABLED,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "evictions": 0, "errors": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        """在持有 self.lock 时调用"""
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, content TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.connection = connection
+        return self.connection
+
+    def get(self, key: str) -> Optional[str]:
+        """未开启、未命中或已过期时返回 None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            try:
+                connection = self._connect()
+                row = connection.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] > self.ttl:
+                    connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.stats["expired"] += 1
+                    row = None
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            except sqlite3.Error as e:
+                logger.warning(f"读取大模型回复缓存失败: {e}")
+                self.stats["errors"] += 1
+                return None
+            self.stats["hits"] += 1
+        return row[0]
+
+    def put(self, key: str, model: str, content: str):
+        if not self.enabled or not content:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, content, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, content, len(content.encode("utf-8")), now, now),
+                )
+                self.stats["stores"] += 1
+                self._evict(connection, now)
+            except sqlite3.Error as e:
+                logger.warning(f"写入大模型回复缓存失败: {e}")
+                self.stats["errors"] += 1
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        """删除过期条目；总大小仍超过上限时按最近使用时间删除"""
+        expired = connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,)).rowcount
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * LOW_WATER_RATIO
+            for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if total <= target:
+                    break
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        self.stats["expired"] += max(expired, 0)
+        self.stats["evictions"] += evicted
+
+    async def aget(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, model: str, content: str):
+        if self.enabled:
+            await asyncio.to_thread(self.put, key, model, content)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats, enabled=self.enabled, ttl=self.ttl, max_bytes=self.max_bytes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+llm_cache = LLMCache()
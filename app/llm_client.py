@@ -0,0 +1,88 @@
+"""
+共享的大模型客户端
+
+进程内所有会话共用一个 ChatOpenAI 实例及其底层的 httpx 连接池（同步与异步各一个），
+连接复用，不必每次请求重新建立 TLS 连接。异步路径（ainvoke/astream）等待模型响应时
+不占用事件循环，一个会话等待模型不会阻塞同一进程中其它会话的 websocket。
+
+结构化输出：优先让服务端按 JSON Schema 约束回复格式（json_schema），服务端不支持时
+自动降级为只保证合法 JSON 的 json_object，再不支持则关闭，由本地修复解析兜底。
+"""
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o")
+# 连接池中最多同时打开的连接数与保持空闲的连接数
+LLM_MAX_CONNECTIONS = int(os.getenv("IDA_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("IDA_LLM_MAX_KEEPALIVE", "20"))
+LLM_TIMEOUT = float(os.getenv("IDA_LLM_TIMEOUT", "120"))
+# 结构化输出模式：json_schema / json_object / off
+LLM_STRUCTURED_OUTPUT = os.getenv("IDA_LLM_STRUCTURED_OUTPUT", "json_schema").lower()
+STRUCTURED_MODES = ("json_schema", "json_object", "off")
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE)
+
+
+def create_llm(**kwargs) -> ChatOpenAI:
+    """创建使用共享连接池的 ChatOpenAI 实例"""
+    timeout = httpx.Timeout(LLM_TIMEOUT, connect=10.0)
+    options = dict(
+        model=LLM_MODEL_NAME,
+        temperature=0,
+        # 重试由 app/llm_limiter 统一调度（全局退避），SDK 不再自行重试
+        max_retries=0,
+        http_client=httpx.Client(limits=_limits(), timeout=timeout),
+        http_async_client=httpx.AsyncClient(limits=_limits(), timeout=timeout),
+    )
+    options.update(kwargs)
+    return ChatOpenAI(**options)
+
+
+class StructuredOutput:
+    """当前使用的结构化输出模式，服务端拒绝时逐级降级（进程内只降级，不恢复）"""
+
+    def __init__(self, mode: str = LLM_STRUCTURED_OUTPUT):
+        self.lock = threading.Lock()
+        self.mode = mode if mode in STRUCTURED_MODES else "off"
+
+    def response_format(self, name: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """当前模式下请求的 response_format 参数；关闭时返回 None"""
+        if self.mode == "json_schema":
+            return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+        if self.mode == "json_object":
+            return {"type": "json_object"}
+        return None
+
+    def downgrade(self, error: Exception) -> bool:
+        """
+        请求因 response_format 不被支持而失败时降级一级
+
+        Returns:
+            是否已降级（调用方可以用新的模式重试）
+        """
+        if not isinstance(error, openai.APIStatusError) or error.status_code not in (400, 422):
+            return False
+        message = str(error)
+        if not any(word in message for word in ("response_format", "json_schema", "json_object")):
+            return False
+        with self.lock:
+            if self.mode == "off":
+                return False
+            previous = self.mode
+            self.mode = STRUCTURED_MODES[STRUCTURED_MODES.index(previous) + 1]
+        logger.warning(f"服务端不支持结构化输出 {previous}，改用 {self.mode}: {message[:200]}")
+        return True
+
+
+llm = create_llm()
+structured_output = StructuredOutput()
@@ -0,0 +1,235 @@
+"""
+全局大模型限流与重试
+
+进程内所有会话共用一个限流器，同时限制每分钟请求数（RPM）和每分钟 token 数（TPM）：
+- 请求数用滑动窗口限制：记录最近 60 秒内每次请求的时间，满额时等到最早的一次移出窗口
+- token 数用令牌桶限制，每次请求按预估的输入 token 加上输出预留扣减
+等待按到达顺序进行（FIFO），等待期间通过回调告知排队位置，前端可以显示排队状态。
+
+服务端返回 429 或 5xx、连接失败时按指数退避加随机抖动重试（优先使用 Retry-After），
+429 还会让所有会话在退避期间暂停发送新请求，避免继续触发限流。
+OpenAI SDK 自身的重试在创建客户端时关闭，重试统一由这里调度。
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# 每分钟请求数与 token 数上限，0 表示不限制
+LLM_RPM = int(os.getenv("IDA_LLM_RPM", "500"))
+LLM_TPM = int(os.getenv("IDA_LLM_TPM", "200000"))
+LLM_MAX_RETRIES = int(os.getenv("IDA_LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("IDA_LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("IDA_LLM_BACKOFF_MAX", "30"))
+# 每次请求为输出预留的 token 数
+OUTPUT_TOKEN_RESERVE = 1024
+# RPM 与 TPM 的统计窗口
+WINDOW_SECONDS = 60.0
+
+
+def is_retryable(error: Exception) -> bool:
+    """429、5xx 与连接错误可以重试"""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMLimiter:
+    """按 RPM 与 TPM 限流的全局排队器，带指数退避重试"""
+
+    def __init__(
+        self,
+        rpm: int = LLM_RPM,
+        tpm: int = LLM_TPM,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # 滑动窗口内已发出请求的时间（time.monotonic）
+        self.sent: Deque[float] = deque()
+        self.tokens = float(tpm)
+        self.refilled_at = time.monotonic()
+        # 429 之后所有请求暂停到这个时间
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {
+            "requests": 0,
+            "tokens": 0,
+            "queued": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+            "retries": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "failures": 0,
+        }
+
+    def _get_lock(self) -> asyncio.Lock:
+        # 锁绑定事件循环；脚本中多次 asyncio.run 时重新创建
+        loop = asyncio.get_running_loop()
+        if self.lock is None or self.loop is not loop:
+            self.lock = asyncio.Lock()
+            self.loop = loop
+        return self.lock
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.tpm), self.tokens + (now - self.refilled_at) * self.tpm / WINDOW_SECONDS)
+        self.refilled_at = now
+
+    def _token_wait(self, tokens: int) -> float:
+        """令牌桶中有足够 token 之前还需等待的秒数"""
+        if self.tpm <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (tokens - self.tokens) * WINDOW_SECONDS / self.tpm)
+
+    def _request_wait(self) -> float:
+        """滑动窗口中的请求数达到上限时，还需等待多少秒才能再发一次请求"""
+        if self.rpm <= 0:
+            return 0.0
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] >= WINDOW_SECONDS:
+            self.sent.popleft()
+        if len(self.sent) < self.rpm:
+            return 0.0
+        return self.sent[len(self.sent) - self.rpm] + WINDOW_SECONDS - now
+
+    async def acquire(self, tokens: int, on_queue: Optional[Callable[[Dict[str, Any]], None]] = None):
+        """
+        排队获取一次请求的配额
+
+        需要等待时 on_queue 收到 {"status": "waiting", "position", "wait_time", "reason"}，
+        获得配额时收到 {"status": "granted", "wait_time"}。
+        """
+        tokens = min(max(1, tokens), self.tpm) if self.tpm > 0 else tokens
+        started = time.monotonic()
+        self.waiting += 1
+        position = self.waiting
+        notified = False
+        try:
+            async with self._get_lock():
+                while True:
+                    pause = self.paused_until - time.monotonic()
+                    request_wait = self._request_wait()
+                    token_wait = self._token_wait(tokens)
+                    wait = max(pause, request_wait, token_wait)
+                    if wait <= 0:
+                        break
+                    if on_queue is not None and not notified:
+                        if pause > 0:
+                            reason = "rate_limited"
+                        else:
+                            reason = "requests_per_minute" if request_wait >= token_wait else "tokens_per_minute"
+                        on_queue({
+                            "status": "waiting",
+                            "position": position,
+                            "wait_time": round(time.monotonic() - started, 2),
+                            "reason": reason,
+                        })
+                        notified = True
+                    await asyncio.sleep(min(wait, 1.0))
+                if self.rpm > 0:
+                    self.sent.append(time.monotonic())
+                if self.tpm > 0:
+                    self.tokens -= tokens
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        self.stats["requests"] += 1
+        self.stats["tokens"] += tokens
+        self.stats["total_wait"] += waited
+        self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+        if notified:
+            self.stats["queued"] += 1
+            if on_queue is not None:
+                on_queue({"status": "granted", "wait_time": round(waited, 2)})
+
+    async def backoff(
+        self,
+        error: Exception,
+        attempt: int,
+        on_queue: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> bool:
+        """
+        第 attempt 次（从 0 开始）请求失败后判断能否重试，可以时等待退避时间
+
+        Returns:
+            是否应当重试
+        """
+        if not is_retryable(error) or attempt >= self.max_retries:
+            self.stats["failures"] += 1
+            return False
+        status = getattr(error, "status_code", None)
+        delay = _retry_after(error)
+        if delay is None:
+            # 指数退避，抖动范围为计算值的 50%~100%
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        if status == 429:
+            self.stats["rate_limited"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        elif status is not None:
+            self.stats["server_errors"] += 1
+        self.stats["retries"] += 1
+        logger.warning(f"大模型请求失败（{status or type(error).__name__}），{delay:.1f}s 后第 {attempt + 1} 次重试: {str(error)[:200]}")
+        if on_queue is not None:
+            on_queue({"status": "retrying", "attempt": attempt + 1, "delay": round(delay, 2), "error": str(status or type(error).__name__)})
+        await asyncio.sleep(delay)
+        return True
+
+    async def call(
+        self,
+        request: Callable[[], Any],
+        tokens: int,
+        on_queue: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Any:
+        """限流后执行 await request()，可重试的错误按退避时间重试"""
+        attempt = 0
+        while True:
+            await self.acquire(tokens, on_queue)
+            try:
+                return await request()
+            except Exception as e:
+                if not await self.backoff(e, attempt, on_queue):
+                    raise
+                attempt += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        self._refill()
+        self._request_wait()
+        return dict(
+            self.stats,
+            rpm=self.rpm,
+            tpm=self.tpm,
+            waiting=self.waiting,
+            recent_requests=len(self.sent),
+            available_tokens=int(self.tokens),
+            paused_for=round(max(0.0, self.paused_until - time.monotonic()), 2),
+        )
+
+
+llm_limiter = LLMLimiter()
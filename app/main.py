@@ -1,12 +1,74 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 import os
 import json
 from typing import Optional
 import tempfile
-from langgraph_workflow import process_query, process_query_streaming
+from app.langgraph_workflow import process_query_streaming
 import time
+from app.output_capture import read_artifact_page, PAGE_SIZE
+from app.scheduler import execution_scheduler
+from app.result_cache import result_cache
+from app.columnar_cache import columnar_cache
+from app.profiler import dataset_profiler
+from app.large_file import large_file_sampler
+from app.janitor import janitor
+from app.llm_client import structured_output
+from app.reply_parser import reply_parser
+from app.llm_cache import llm_cache
+from app.llm_limiter import llm_limiter
+from app.blob_store import (
+    ingest_stream, check_upload, UploadRejected, UPLOAD_MAX_BYTES, UPLOAD_CHUNK_BYTES, UPLOAD_EXTENSIONS,
+)
+
+# multipart 表单中除文件外其它字段的余量
+UPLOAD_FORM_SLACK_BYTES = 1024 * 1024
+
+
+class UploadTooLarge(HTTPException):
+    """请求体超过上传上限；继承 HTTPException，解析表单时抛出也会原样传出而不是变成 400"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"上传内容超过上限 {max_bytes} 字节")
+
+
+class UploadSizeLimit:
+    """
+    POST 请求体的大小上限（纯 ASGI 中间件）
+
+    声明的 Content-Length 超出时在解析表单之前直接返回 413；没有声明长度（分块传输）时
+    在 Starlette 读取请求体、把表单写入临时文件的过程中计数，一旦超出就中止读取，不会先完整接收。
+    上限为 UPLOAD_MAX_BYTES 加上表单其它字段的余量，每个请求读取一次。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        max_bytes = UPLOAD_MAX_BYTES + UPLOAD_FORM_SLACK_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            response = JSONResponse(status_code=413, content={"error": UploadTooLarge(UPLOAD_MAX_BYTES).detail})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise UploadTooLarge(UPLOAD_MAX_BYTES)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 
 app = FastAPI()
 
@@ -18,6 +80,53 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(UploadSizeLimit)
+
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large(request: Request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"error": exc.detail})
+
+
+async def save_upload(file: UploadFile) -> str:
+    """按块读取上传文件，边写边计算哈希后入库，返回文件路径"""
+    check_upload(file.filename, getattr(file, "size", None), max_bytes=UPLOAD_MAX_BYTES, extensions=UPLOAD_EXTENSIONS)
+
+    async def chunks():
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+    stored = await ingest_stream(chunks(), file.filename, max_bytes=UPLOAD_MAX_BYTES)
+    return stored["file_path"]
+
+
+async def collect_query_result(instruction: str, file_path: Optional[str], messages: list, user_id: Optional[str]) -> dict:
+    """运行流式分析并把事件汇总为一次性返回的结果（response、final_answer、intermediate_steps 等）"""
+    result = {"response": None, "final_answer": None, "intermediate_steps": [], "execution_result": None, "file_path": file_path}
+    async for chunk in process_query_streaming(instruction, file_path, messages, user_id=user_id):
+        if chunk["type"] == "final_answer":
+            result["final_answer"] = chunk["content"]
+        elif chunk["type"] == "final_response":
+            result.update(
+                response=chunk["content"],
+                intermediate_steps=chunk["intermediate_steps"],
+                execution_result=chunk["execution_result"],
+                file_path=chunk["file_path"],
+            )
+        elif chunk["type"] == "error":
+            result["response"] = chunk["message"]
+    result["response"] = result["final_answer"] or result["response"]
+    return result
+
+
+@app.on_event("startup")
+async def start_janitor():
+    """启动 data/ 目录的容量回收"""
+    janitor.start()
+
 
 @app.get("/")
 async def root():
@@ -25,6 +134,7 @@ async def root():
 
 @app.post("/api/process")
 async def process_request(
+    request: Request,
     instruction: str = Form(...),
     file: Optional[UploadFile] = File(None),
     messages_json: Optional[str] = Form(None)
@@ -39,38 +149,34 @@ async def process_request(
         except Exception as e:
             return {"error": f"解析消息历史错误: {str(e)}"}
     
-    # 如果上传了文件，保存到项目 data/ 目录
+    # 如果上传了文件，存入项目 data/blobs
     if file:
         try:
-            # 确保 data 目录存在（项目根目录下）
-            base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-            data_dir = os.path.join(base_dir, 'data')
-            os.makedirs(data_dir, exist_ok=True)
-
-            # 生成保存文件名，避免覆盖
-            original_name = os.path.basename(file.filename)
-            name, ext = os.path.splitext(original_name)
-            timestamp = int(time.time())
-            safe_name = f"{name}_{timestamp}{ext}"
-            file_path = os.path.join(data_dir, safe_name)
-
-            # 写入上传内容
-            content = await file.read()
-            with open(file_path, 'wb') as f:
-                f.write(content)
+            # 按块写入并按内容寻址入库，重复上传同样的文件不会再保存一份
+            file_path = await save_upload(file)
+            # 后台转换为列式缓存并分析数据概况，后续执行步骤读取更快
+            columnar_cache.submit(file_path)
+            dataset_profiler.submit(file_path)
+            large_file_sampler.submit(file_path)
+        except UploadRejected as e:
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
         except Exception as e:
             return {"error": f"文件处理错误: {str(e)}"}
     
-    # 调用LangGraph工作流处理请求
+    # 调用LangGraph工作流处理请求，处理期间登记上传文件，容量回收不会删除
+    request_owner = f"request-{id(request)}"
+    janitor.pin(file_path, request_owner)
     try:
-        result = process_query(instruction, file_path, messages)
-        
-        return result
+        user_id = request.client.host if request.client else None
+        return await collect_query_result(instruction, file_path, messages, user_id)
     except Exception as e:
         return {"error": f"处理请求时出错: {str(e)}"}
+    finally:
+        janitor.release(request_owner)
 
 @app.post("/api/process-stream")
 async def process_request_stream(
+    request: Request,
     instruction: str = Form(...),
     file: Optional[UploadFile] = File(None),
     messages_json: Optional[str] = Form(None)
@@ -85,36 +191,35 @@ async def process_request_stream(
         except Exception as e:
             return {"error": f"解析消息历史错误: {str(e)}"}
     
-    # 如果上传了文件，保存到项目 data/ 目录
+    # 如果上传了文件，存入项目 data/blobs
     if file:
         try:
-            # 确保 data 目录存在（项目根目录下）
-            base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-            data_dir = os.path.join(base_dir, 'data')
-            os.makedirs(data_dir, exist_ok=True)
-
-            # 生成保存文件名，避免覆盖
-            original_name = os.path.basename(file.filename)
-            name, ext = os.path.splitext(original_name)
-            timestamp = int(time.time())
-            safe_name = f"{name}_{timestamp}{ext}"
-            file_path = os.path.join(data_dir, safe_name)
-
-            # 写入上传内容
-            content = await file.read()
-            with open(file_path, 'wb') as f:
-                f.write(content)
+            # 按块写入并按内容寻址入库，重复上传同样的文件不会再保存一份
+            file_path = await save_upload(file)
+            # 后台转换为列式缓存并分析数据概况，后续执行步骤读取更快
+            columnar_cache.submit(file_path)
+            dataset_profiler.submit(file_path)
+            large_file_sampler.submit(file_path)
+        except UploadRejected as e:
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
         except Exception as e:
             return {"error": f"文件处理错误: {str(e)}"}
     
+    # 请求处理期间登记上传文件，容量回收不会删除
+    request_owner = f"request-{id(request)}"
+    janitor.pin(file_path, request_owner)
+
     # 流式处理函数
     async def generate_stream():
         try:
-            async for chunk in process_query_streaming(instruction, file_path, messages):
+            # 与 Chainlit 会话共用全局执行调度器，按客户端地址公平排队
+            user_id = request.client.host if request.client else None
+            async for chunk in process_query_streaming(instruction, file_path, messages, user_id=user_id):
                 yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
         except Exception as e:
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)}, ensure_ascii=False)}\n\n"
         finally:
+            janitor.release(request_owner)
             yield "data: [DONE]\n\n"
     
     return StreamingResponse(
@@ -124,4 +229,37 @@ async def process_request_stream(
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
         }
-    )
\ No newline at end of file
+    )
+
+@app.get("/api/scheduler")
+async def scheduler_stats():
+    """全局代码执行调度器的运行状态"""
+    return execution_scheduler.get_stats()
+
+@app.get("/api/exec-cache")
+async def exec_cache_stats():
+    """代码执行结果缓存的命中统计"""
+    return result_cache.get_stats()
+
+@app.get("/api/janitor")
+async def janitor_stats():
+    """data/ 目录容量回收的统计（回收字节数、删除条目数等）"""
+    return janitor.get_stats()
+
+@app.get("/api/llm")
+async def llm_stats():
+    """大模型调用相关统计：回复解析（严格解析、本地修复、失败）、当前结构化输出模式、回复缓存命中与全局限流排队"""
+    return {
+        "structured_output": structured_output.mode,
+        "replies": reply_parser.get_stats(),
+        "cache": llm_cache.get_stats(),
+        "limiter": llm_limiter.get_stats(),
+    }
+
+@app.get("/api/artifacts/{artifact_id:path}")
+async def read_artifact(artifact_id: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """分页读取被截断的完整代码输出"""
+    try:
+        return read_artifact_page(artifact_id, offset, limit)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
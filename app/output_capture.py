@@ -0,0 +1,170 @@
+"""
+有界的代码输出捕获
+
+输出超过上限时只在内存中保留开头和结尾，完整内容写入会话的输出文件，
+观察结果中只保留一个引用，前端可按页读取完整输出。
+"""
+import os
+import re
+import time
+import uuid
+import logging
+from collections import deque
+from typing import Dict, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+ARTIFACTS_DIR = os.path.join(PROJECT_ROOT, "data", "artifacts")
+
+# 单个输出流在内存中保留的最大字节数（开头和结尾各占一半）
+OUTPUT_CAP_BYTES = int(os.getenv("IDA_OUTPUT_CAP_BYTES", "32768"))
+# 分页读取完整输出时每页的默认字节数
+PAGE_SIZE = 16384
+
+
+def _byte_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def _take_head(text: str, max_bytes: int) -> str:
+    """按字节上限截取文本开头，不切断多字节字符"""
+    return text.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
+
+
+def _take_tail(text: str, max_bytes: int) -> str:
+    """按字节上限截取文本结尾，不切断多字节字符"""
+    data = text.encode("utf-8")
+    return data[-max_bytes:].decode("utf-8", errors="ignore") if max_bytes > 0 else ""
+
+
+def artifact_dir_for(session_id: Optional[str]) -> str:
+    """会话输出文件目录"""
+    name = re.sub(r"[^A-Za-z0-9_-]", "_", session_id) if session_id else "shared"
+    return os.path.join(ARTIFACTS_DIR, name)
+
+
+class OutputCapture:
+    """单个输出流的有界捕获缓冲区"""
+
+    def __init__(self, name: str, artifact_dir: str, cap_bytes: int = OUTPUT_CAP_BYTES):
+        self.name = name
+        self.artifact_dir = artifact_dir
+        self.cap_bytes = max(1024, cap_bytes)
+        self.half = self.cap_bytes // 2
+        self.total_bytes = 0
+        self.chunks = []
+        self.head = ""
+        self.tail: deque = deque()
+        self.tail_bytes = 0
+        self.spill_file = None
+        self.spill_path: Optional[str] = None
+        self.notified = False
+
+    @property
+    def truncated(self) -> bool:
+        return self.spill_path is not None
+
+    def _spill(self):
+        """首次超过上限：把已有内容写入文件，切换到首尾保留模式"""
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        file_name = f"{self.name}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.log"
+        self.spill_path = os.path.join(self.artifact_dir, file_name)
+        self.spill_file = open(self.spill_path, "w", encoding="utf-8")
+        buffered = "".join(self.chunks)
+        self.chunks = []
+        self.spill_file.write(buffered)
+        self.head = _take_head(buffered, self.half)
+        tail = _take_tail(buffered, self.half)
+        self.tail = deque([tail])
+        self.tail_bytes = _byte_len(tail)
+        logger.info(f"输出超过 {self.cap_bytes} 字节，完整内容写入: {self.spill_path}")
+
+    def write(self, text: str) -> Optional[str]:
+        """
+        追加输出
+
+        Returns:
+            应继续转发给前端的文本；超过上限后只返回一次提示，之后返回 None
+        """
+        if not text:
+            return text
+        size = _byte_len(text)
+        self.total_bytes += size
+
+        if self.spill_file is None:
+            self.chunks.append(text)
+            if self.total_bytes <= self.cap_bytes:
+                return text
+            self._spill()
+        else:
+            self.spill_file.write(text)
+            self.tail.append(text)
+            self.tail_bytes += size
+            while self.tail and self.tail_bytes - _byte_len(self.tail[0]) >= self.half:
+                self.tail_bytes -= _byte_len(self.tail.popleft())
+
+        if not self.notified:
+            self.notified = True
+            return f"\n... [输出超过 {self.cap_bytes} 字节，后续内容不再实时显示，完整输出已保存]\n"
+        return None
+
+    def getvalue(self) -> str:
+        """返回捕获的文本，超过上限时为 开头 + 截断说明 + 结尾"""
+        if not self.truncated:
+            return "".join(self.chunks)
+        tail = _take_tail("".join(self.tail), self.half)
+        omitted = self.total_bytes - _byte_len(self.head) - _byte_len(tail)
+        return (
+            f"{self.head}\n"
+            f"... [输出过长已截断: 共 {self.total_bytes} 字节，省略中间 {omitted} 字节；"
+            f"完整输出: artifact://{self.artifact_id()}] ...\n"
+            f"{tail}"
+        )
+
+    def artifact_id(self) -> Optional[str]:
+        if not self.spill_path:
+            return None
+        return os.path.relpath(self.spill_path, ARTIFACTS_DIR).replace(os.sep, "/")
+
+    def close(self) -> Optional[Dict[str, Any]]:
+        """关闭输出文件，返回完整输出的引用信息（未截断时为 None）"""
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        if not self.truncated:
+            return None
+        return {
+            "id": self.artifact_id(),
+            "path": self.spill_path,
+            "stream": self.name,
+            "total_bytes": self.total_bytes,
+        }
+
+
+def resolve_artifact(artifact_id: str) -> str:
+    """将输出引用解析为文件路径，拒绝目录穿越"""
+    path = os.path.abspath(os.path.join(ARTIFACTS_DIR, artifact_id))
+    if not path.startswith(os.path.abspath(ARTIFACTS_DIR) + os.sep) or not os.path.isfile(path):
+        raise FileNotFoundError(f"输出文件不存在: {artifact_id}")
+    return path
+
+
+def read_artifact_page(artifact_id: str, offset: int = 0, limit: int = PAGE_SIZE) -> Dict[str, Any]:
+    """按字节偏移分页读取完整输出"""
+    path = resolve_artifact(artifact_id)
+    total = os.path.getsize(path)
+    offset = max(0, min(offset, total))
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(max(1, limit))
+    content = data.decode("utf-8", errors="ignore")
+    next_offset = offset + len(data)
+    return {
+        "id": artifact_id,
+        "offset": offset,
+        "next_offset": next_offset,
+        "total_bytes": total,
+        "eof": next_offset >= total,
+        "content": content,
+    }
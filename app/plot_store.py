@@ -0,0 +1,112 @@
+"""
+按内容寻址的图表存储
+
+内核在每个代码单元结束时自动导出所有打开的图表（原图 + 缩略图），
+这里按 PNG 内容的 sha256 去重后存入 data/plots，缩略图存入 data/plots/thumbs。
+"""
+import os
+import shutil
+import struct
+import hashlib
+import logging
+from typing import Dict, List, Optional, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PLOTS_DIR = os.path.join(PROJECT_ROOT, "data", "plots")
+THUMBS_DIR = os.path.join(PLOTS_DIR, "thumbs")
+
+# 缩略图宽度（像素），由内核导出图表时使用
+THUMBNAIL_WIDTH = int(os.getenv("IDA_PLOT_THUMBNAIL_WIDTH", "320"))
+
+
+def png_size(path: str) -> Tuple[Optional[int], Optional[int]]:
+    """从 PNG 文件头读取宽高"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(24)
+        if header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+            return struct.unpack(">II", header[16:24])
+    except OSError:
+        pass
+    return None, None
+
+
+def _digest(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _move_into(source: str, dest: str) -> bool:
+    """把临时文件移入存储，目标已存在时丢弃临时文件；返回是否为新文件"""
+    if os.path.exists(dest):
+        os.remove(source)
+        # 重复的图表视为再次使用，容量回收按修改时间判断最近使用
+        os.utime(dest, None)
+        return False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.move(source, dest)
+    return True
+
+
+def relative_path(path: str) -> str:
+    """相对项目根目录的路径，与 PLOT_PATH::./data/plots/... 的约定一致"""
+    return "./" + os.path.relpath(path, PROJECT_ROOT).replace(os.sep, "/")
+
+
+def thumbnail_for(path: str) -> Optional[str]:
+    """图表库中图片对应的缩略图路径，不在图表库或没有缩略图时返回 None"""
+    thumbnail = os.path.join(THUMBS_DIR, os.path.basename(path))
+    if os.path.abspath(os.path.dirname(path)) == PLOTS_DIR and os.path.exists(thumbnail):
+        return thumbnail
+    return None
+
+
+def store_figures(figures: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    把内核导出的图表存入图表库
+
+    Args:
+        figures: 内核返回的 [{"path": 原图, "thumbnail": 缩略图}, ...]
+
+    Returns:
+        结构化的图表引用: id、path、url（相对项目根目录）、thumbnail、width、height、bytes、deduplicated
+    """
+    stored = []
+    for figure in figures or []:
+        source = figure.get("path")
+        if not source or not os.path.exists(source):
+            continue
+        try:
+            digest = _digest(source)
+            plot_id = digest[:16]
+            dest = os.path.join(PLOTS_DIR, f"{plot_id}.png")
+            size = os.path.getsize(source)
+            width, height = png_size(source)
+            is_new = _move_into(source, dest)
+
+            thumbnail = None
+            thumb_source = figure.get("thumbnail")
+            if thumb_source and os.path.exists(thumb_source):
+                thumbnail = os.path.join(THUMBS_DIR, f"{plot_id}.png")
+                _move_into(thumb_source, thumbnail)
+
+            stored.append({
+                "id": plot_id,
+                "path": dest,
+                "url": relative_path(dest),
+                "thumbnail": thumbnail,
+                "width": width,
+                "height": height,
+                "bytes": size,
+                "deduplicated": not is_new,
+            })
+        except OSError as e:
+            logger.error(f"保存图表失败: {e}")
+    if stored:
+        logger.info(f"保存图表 {len(stored)} 张（重复 {sum(1 for p in stored if p['deduplicated'])} 张）")
+    return stored
@@ -0,0 +1,205 @@
+"""
+生成代码的静态预检
+
+在启动内核执行之前用 AST 检查常见问题，能修正的直接改写源码，
+不能修正的直接返回简短诊断作为观察结果，省去一次执行和一轮 LLM 往返：
+- 语法错误：拒绝执行
+- plt.show() 等显示图形界面的调用：自动移除
+- input() 等交互输入：拒绝执行
+- 读取文件时硬编码的路径：文件名与上传文件相同的改写为上传文件路径；
+  工作目录内的相对路径（例如之前步骤生成的文件）以及同一段代码中先写出的文件放行；
+  不存在的绝对路径和指向工作目录以外的相对路径拒绝执行
+"""
+import os
+import re
+import ast
+import logging
+from typing import Dict, List, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+# 会打开图形界面的调用
+SHOW_RECEIVERS = {"plt", "pyplot", "matplotlib.pyplot", "fig", "figure"}
+# 需要交互输入的调用
+INTERACTIVE_CALLS = {"input", "raw_input", "getpass", "getpass.getpass", "breakpoint", "pdb.set_trace"}
+# 读取文件的函数（按最后一段名称匹配），以及文件路径参数的关键字名
+READ_FUNCTIONS = {
+    "read_csv", "read_table", "read_excel", "read_json", "read_parquet", "read_feather",
+    "read_pickle", "read_fwf", "ExcelFile", "load_workbook", "loadtxt", "genfromtxt", "open",
+}
+PATH_KEYWORDS = {"filepath_or_buffer", "io", "path", "path_or_buf", "filename", "fname", "file"}
+# 写出文件的函数（按最后一段名称匹配），以及输出路径参数的关键字名；写模式的 open() 也算在内
+WRITE_FUNCTIONS = {
+    "to_csv", "to_excel", "to_json", "to_parquet", "to_feather", "to_pickle", "to_hdf",
+    "to_stata", "to_html", "savefig", "savetxt", "save", "ExcelWriter",
+}
+OUTPUT_PATH_KEYWORDS = {"path_or_buf", "path", "excel_writer", "fname", "filename", "buf"}
+# Windows 盘符开头的绝对路径（模型常照搬 C:\\Users\\... 这类示例路径）
+_WINDOWS_ABS = re.compile(r"^[A-Za-z]:/")
+
+
+def _dotted_name(node: ast.AST) -> str:
+    """把 a.b.c 形式的表达式还原为字符串"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+        return ".".join(reversed(parts))
+    return ""
+
+
+def _is_write_mode(call: ast.Call) -> bool:
+    """open() 以写模式打开时不属于读取路径检查的范围"""
+    mode = None
+    if len(call.args) > 1 and isinstance(call.args[1], ast.Constant):
+        mode = call.args[1].value
+    for keyword in call.keywords:
+        if keyword.arg == "mode" and isinstance(keyword.value, ast.Constant):
+            mode = keyword.value.value
+    return isinstance(mode, str) and any(flag in mode for flag in "wax+")
+
+
+def _path_argument(call: ast.Call, keywords: set = PATH_KEYWORDS) -> Optional[ast.Constant]:
+    if call.args and isinstance(call.args[0], ast.Constant) and isinstance(call.args[0].value, str):
+        return call.args[0]
+    for keyword in call.keywords:
+        if keyword.arg in keywords and isinstance(keyword.value, ast.Constant) and isinstance(keyword.value.value, str):
+            return keyword.value
+    return None
+
+
+def _normalize(path: str) -> str:
+    return os.path.normpath(path.replace("\\", "/"))
+
+
+def _output_paths(tree: ast.AST) -> set:
+    """同一段代码中以字面量路径写出的文件（规范化后的路径）"""
+    paths = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        short_name = _dotted_name(node.func).rsplit(".", 1)[-1] or getattr(node.func, "attr", "")
+        if short_name == "open" and _is_write_mode(node):
+            path_node = _path_argument(node)
+        elif short_name in WRITE_FUNCTIONS:
+            path_node = _path_argument(node, OUTPUT_PATH_KEYWORDS)
+        else:
+            continue
+        if path_node is not None:
+            paths.add(_normalize(path_node.value))
+    return paths
+
+
+class _SourceEditor:
+    """按 AST 节点位置改写源码（AST 的列偏移是 UTF-8 字节偏移）"""
+
+    def __init__(self, code: str):
+        self.data = code.encode("utf-8")
+        self.line_starts = [0]
+        for index, byte in enumerate(self.data):
+            if byte == 0x0A:
+                self.line_starts.append(index + 1)
+        self.edits: List[Tuple[int, int, bytes]] = []
+
+    def _offset(self, lineno: int, col: int) -> int:
+        return self.line_starts[lineno - 1] + col
+
+    def replace(self, node: ast.AST, text: str):
+        start = self._offset(node.lineno, node.col_offset)
+        end = self._offset(node.end_lineno, node.end_col_offset)
+        self.edits.append((start, end, text.encode("utf-8")))
+
+    def apply(self) -> str:
+        data = self.data
+        for start, end, text in sorted(self.edits, reverse=True):
+            data = data[:start] + text + data[end:]
+        return data.decode("utf-8")
+
+
+def preflight_check(code: str, file_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    预检生成的代码
+
+    Returns:
+        dict: ok（是否可以执行）、code（改写后的代码）、errors（拒绝原因）、fixes（自动修正说明）
+    """
+    errors: List[str] = []
+    fixes: List[str] = []
+
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        line = (e.text or "").rstrip("\n")
+        pointer = " " * max(0, (e.offset or 1) - 1) + "^"
+        errors.append(f"第 {e.lineno} 行 语法错误: {e.msg}\n    {line}\n    {pointer}")
+        return {"ok": False, "code": code, "errors": errors, "fixes": fixes}
+
+    editor = _SourceEditor(code)
+    upload_name = os.path.basename(file_path) if file_path else None
+    written = _output_paths(tree)
+
+    for node in ast.walk(tree):
+        # plt.show()/fig.show() 作为独立语句出现时直接移除
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            func = node.value.func
+            if isinstance(func, ast.Attribute) and func.attr == "show":
+                receiver = _dotted_name(func.value)
+                if receiver in SHOW_RECEIVERS or receiver.startswith("fig"):
+                    editor.replace(node, "pass")
+                    fixes.append(f"第 {node.lineno} 行 已移除 {receiver}.show()，图表请保存为文件")
+                    continue
+
+        if not isinstance(node, ast.Call):
+            continue
+        name = _dotted_name(node.func)
+        short_name = name.rsplit(".", 1)[-1]
+
+        if name in INTERACTIVE_CALLS:
+            errors.append(f"第 {node.lineno} 行 调用了 {name}()，运行环境不支持交互输入")
+            continue
+
+        if short_name not in READ_FUNCTIONS or (short_name == "open" and _is_write_mode(node)):
+            continue
+        path_node = _path_argument(node)
+        if path_node is None:
+            continue
+        literal = path_node.value
+        if file_path and os.path.abspath(literal) == os.path.abspath(file_path):
+            continue
+        if _normalize(literal) in written:
+            # 同一段代码中先写出再读回的文件
+            continue
+        if os.path.isabs(literal) and os.path.exists(literal):
+            continue
+
+        literal_name = os.path.basename(literal.replace("\\", "/"))
+        relative = _normalize(literal)
+        if file_path and literal_name == upload_name:
+            # 文件名与上传文件相同的硬编码路径，改写为实际路径
+            editor.replace(path_node, repr(file_path))
+            fixes.append(f"第 {node.lineno} 行 已将硬编码路径 {literal!r} 改为上传文件路径")
+        elif not (os.path.isabs(relative) or _WINDOWS_ABS.match(relative) or relative == ".." or relative.startswith("../")):
+            # 工作目录内的相对路径（例如之前步骤生成的文件）无法静态判断，放行
+            continue
+        else:
+            hint = f"，请使用文件路径 {file_path!r}" if file_path else ""
+            errors.append(f"第 {node.lineno} 行 读取了不存在的硬编码路径 {literal!r}{hint}")
+
+    new_code = editor.apply() if editor.edits else code
+    # ast.walk 是广度优先，按行号排序后更易读
+    by_line = lambda text: int(text.split(" ", 2)[1])
+    return {"ok": not errors, "code": new_code, "errors": sorted(errors, key=by_line), "fixes": sorted(fixes, key=by_line)}
+
+
+def format_preflight_report(check: Dict[str, Any]) -> str:
+    """把预检结果整理为简短的观察文本"""
+    lines = []
+    if check["errors"]:
+        lines.append("预检未通过，代码未执行:")
+        lines.extend(f"- {error}" for error in check["errors"])
+    if check["fixes"]:
+        lines.append("预检已自动修正:")
+        lines.extend(f"- {fix}" for fix in check["fixes"])
+    return "\n".join(lines)
@@ -0,0 +1,255 @@
+"""
+按文件格式注册的预览器
+
+每个预览器只读取文件开头或元数据（Excel 只读流式读取前几行、Parquet 只读文件尾的
+元数据和第一批数据、Feather 只读结构和第一个记录批、JSON 只读开头一段），
+内存占用与文件大小无关，返回真实的内容预览而不是字节数。
+"""
+import os
+import json
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.sniffer import sniff_file
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_ROWS = 10
+# JSON 预览最多读取的字符数
+JSON_PEEK_CHARS = 64 * 1024
+TEXT_ENCODINGS = ["utf-8", "gbk", "cp936", "gb18030", "latin1"]
+
+# 扩展名 -> (预览函数, 文件类型)
+PREVIEWERS: Dict[str, Tuple[Callable[[str, int, int], str], str]] = {}
+
+
+def register_previewer(*extensions: str, file_type: str = "data"):
+    """注册预览器；file_type 同时作为 detect_file_type 的识别结果"""
+    def decorator(func: Callable[[str, int, int], str]):
+        for extension in extensions:
+            PREVIEWERS[extension.lower()] = (func, file_type)
+        return func
+    return decorator
+
+
+def get_previewer(file_path: str) -> Optional[Callable[[str, int, int], str]]:
+    entry = PREVIEWERS.get(os.path.splitext(file_path)[1].lower())
+    return entry[0] if entry else None
+
+
+def previewer_file_type(file_path: str) -> Optional[str]:
+    entry = PREVIEWERS.get(os.path.splitext(file_path)[1].lower())
+    return entry[1] if entry else None
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip("\n") + f"\n... (preview truncated to approximately {max_chars} characters)"
+
+
+def _frame_text(rows: List[tuple], columns: List[str]) -> str:
+    import pandas as pd
+
+    frame = pd.DataFrame(rows, columns=columns)
+    return frame.to_string(index=False, max_colwidth=40)
+
+
+@register_previewer(".txt", ".md", file_type="text")
+def preview_text(file_path: str, max_lines: int, max_chars: int) -> str:
+    """文本文件：CSV/TSV 使用探测出的编码，其它文本按候选编码读取前若干行"""
+    sniffed = sniff_file(file_path)
+    for encoding in [sniffed["encoding"]] if sniffed else TEXT_ENCODINGS:
+        try:
+            with open(file_path, "r", encoding=encoding) as f:
+                content_parts: List[str] = []
+                total_chars = 0
+                line_count = 0
+                truncated = False
+                while True:
+                    line = f.readline()
+                    if line == "":
+                        break
+                    content_parts.append(line)
+                    total_chars += len(line)
+                    line_count += 1
+                    if total_chars >= max_chars:
+                        truncated = True
+                        break
+                    if line_count >= max_lines:
+                        truncated = bool(f.read(1))
+                        break
+        except UnicodeDecodeError:
+            continue
+
+        preview = "".join(content_parts)
+        if truncated or len(preview) > max_chars:
+            preview = preview[:max_chars].rstrip("\n")
+            preview += f"\n... (preview truncated to {line_count} lines and approximately {len(preview)} characters)"
+        logger.info(f"Loaded preview with encoding {encoding}: {file_path} (lines: {line_count}, chars: {len(preview)})")
+        return preview
+    return preview_binary(file_path, max_lines, max_chars)
+
+
+# CSV/TSV 按文本预览，但属于数据文件
+register_previewer(".csv", ".tsv")(preview_text)
+
+
+@register_previewer(".xlsb")
+def preview_binary(file_path: str, max_lines: int, max_chars: int) -> str:
+    """暂不支持解析的二进制格式：只报告文件大小"""
+    return f"[binary file, length: {os.path.getsize(file_path)} bytes]"
+
+
+@register_previewer(".xlsx", ".xlsm")
+def preview_excel(file_path: str, max_lines: int, max_chars: int) -> str:
+    """Excel：openpyxl 只读模式流式读取每个工作表的前几行"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sections = []
+        for sheet in workbook.worksheets:
+            rows = []
+            for row in sheet.iter_rows(values_only=True):
+                rows.append(row)
+                if len(rows) > max_lines:
+                    break
+            try:
+                dimension = sheet.calculate_dimension()
+            except ValueError:
+                # 文件中没有记录范围时只读模式无法得知
+                dimension = ""
+            header = f"工作表 {sheet.title!r}" + (f"（范围 {dimension}）" if dimension and dimension != "A1:A1" else "")
+            if not rows:
+                sections.append(f"{header}: 空")
+                continue
+            width = max(len(row) for row in rows)
+            names = [str(value) if value is not None else f"Unnamed: {i}" for i, value in enumerate(rows[0])]
+            names += [f"Unnamed: {i}" for i in range(len(names), width)]
+            body = [tuple(row) + (None,) * (width - len(row)) for row in rows[1:]]
+            sections.append(f"{header}:\n{_frame_text(body, names)}")
+    finally:
+        workbook.close()
+    return _truncate(f"Excel 文件，共 {len(sections)} 个工作表\n" + "\n\n".join(sections), max_chars)
+
+
+@register_previewer(".xls")
+def preview_legacy_excel(file_path: str, max_lines: int, max_chars: int) -> str:
+    """旧版 xls：只读取每个工作表的前几行"""
+    import pandas as pd
+
+    sheets = pd.read_excel(file_path, sheet_name=None, nrows=max_lines)
+    sections = [f"工作表 {name!r}:\n{frame.to_string(index=False, max_colwidth=40)}" for name, frame in sheets.items()]
+    return _truncate(f"Excel 文件，共 {len(sections)} 个工作表\n" + "\n\n".join(sections), max_chars)
+
+
+def _schema_text(schema) -> str:
+    return "\n".join(f"- {field.name}: {field.type}" for field in schema)
+
+
+@register_previewer(".parquet")
+def preview_parquet(file_path: str, max_lines: int, max_chars: int) -> str:
+    """Parquet：读取文件尾的元数据和结构，只解码第一批数据"""
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_path)
+    metadata = parquet_file.metadata
+    head = next(parquet_file.iter_batches(batch_size=max_lines), None)
+    text = (
+        f"Parquet 文件: {metadata.num_rows} 行 × {metadata.num_columns} 列，{metadata.num_row_groups} 个行组\n"
+        f"列结构:\n{_schema_text(parquet_file.schema_arrow)}"
+    )
+    if head is not None:
+        text += f"\n前 {head.num_rows} 行:\n{head.to_pandas().to_string(index=False, max_colwidth=40)}"
+    return _truncate(text, max_chars)
+
+
+@register_previewer(".feather", ".arrow")
+def preview_feather(file_path: str, max_lines: int, max_chars: int) -> str:
+    """Feather/Arrow IPC：内存映射读取结构和第一个记录批"""
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    with pa.memory_map(file_path, "r") as source:
+        reader = ipc.open_file(source)
+        schema = reader.schema
+        text = f"Feather 文件: {len(schema)} 列，{reader.num_record_batches} 个记录批\n列结构:\n{_schema_text(schema)}"
+        if reader.num_record_batches:
+            head = reader.get_batch(0).slice(0, max_lines)
+            text += f"\n前 {head.num_rows} 行:\n{head.to_pandas().to_string(index=False, max_colwidth=40)}"
+    return _truncate(text, max_chars)
+
+
+def _read_head(file_path: str, max_chars: int) -> str:
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read(max_chars)
+
+
+@register_previewer(".json", file_type="json")
+def preview_json(file_path: str, max_lines: int, max_chars: int) -> str:
+    """JSON：只读取开头一段，顶层为数组时逐个解析前几个元素"""
+    head = _read_head(file_path, JSON_PEEK_CHARS)
+    stripped = head.lstrip()
+    decoder = json.JSONDecoder()
+    size = os.path.getsize(file_path)
+
+    if stripped.startswith("["):
+        items = []
+        position = 1
+        while len(items) < max_lines:
+            while position < len(stripped) and stripped[position] in " \t\r\n,":
+                position += 1
+            if position >= len(stripped) or stripped[position] == "]":
+                break
+            try:
+                item, position = decoder.raw_decode(stripped, position)
+            except ValueError:
+                break
+            items.append(item)
+        lines = [json.dumps(item, ensure_ascii=False)[:500] for item in items]
+        text = f"JSON 数组（文件大小 {size} 字节），前 {len(items)} 个元素:\n" + "\n".join(lines)
+        return _truncate(text, max_chars)
+
+    try:
+        value, _ = decoder.raw_decode(stripped)
+    except ValueError:
+        # 对象太大，只展示开头
+        return _truncate(f"JSON 文件（文件大小 {size} 字节），开头内容:\n{head}", max_chars)
+    if isinstance(value, dict):
+        keys = ", ".join(list(map(str, value.keys()))[:50])
+        text = f"JSON 对象（文件大小 {size} 字节），顶层键: {keys}\n{json.dumps(value, ensure_ascii=False, indent=2)}"
+    else:
+        text = json.dumps(value, ensure_ascii=False, indent=2)
+    return _truncate(text, max_chars)
+
+
+@register_previewer(".jsonl", ".ndjson", file_type="json")
+def preview_jsonl(file_path: str, max_lines: int, max_chars: int) -> str:
+    """JSON Lines：逐行读取前几条记录"""
+    records = []
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if len(records) >= max_lines:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.dumps(json.loads(line), ensure_ascii=False)[:500])
+            except ValueError:
+                records.append(f"[无法解析] {line[:200]}")
+    text = f"JSON Lines 文件（文件大小 {os.path.getsize(file_path)} 字节），前 {len(records)} 条记录:\n" + "\n".join(records)
+    return _truncate(text, max_chars)
+
+
+def preview_file(file_path: str, max_lines: int = PREVIEW_ROWS, max_chars: int = 4000) -> str:
+    """按扩展名选择预览器；未注册的格式按文本预览，无法解码时只报告文件大小"""
+    previewer = get_previewer(file_path) or preview_text
+    try:
+        return previewer(file_path, max_lines, max_chars)
+    except ImportError as e:
+        logger.warning(f"预览 {file_path} 缺少依赖: {e}")
+    except Exception as e:
+        logger.error(f"预览文件失败: {file_path}: {e}")
+    return preview_binary(file_path, max_lines, max_chars)
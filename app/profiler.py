@@ -0,0 +1,309 @@
+"""
+上传数据集的分块概况分析
+
+上传后在后台按块扫描一遍数据（内存占用与文件大小无关），统计每列的类型、空值率、
+唯一值个数、最小/最大值和示例值。结果按文件内容哈希缓存在 data/cache/profiles，
+以紧凑的结构说明注入提示词，模型第一步就可以直接写分析代码，
+不必先花几轮执行 df.head()/df.dtypes/describe()。
+"""
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, Any, Iterator, Tuple
+
+from app.result_cache import file_digest
+from app.columnar_cache import read_manifest
+from app.sniffer import sniff_file
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PROFILE_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "profiles")
+
+PROFILER_ENABLED = os.getenv("IDA_PROFILER_ENABLED", "1").lower() not in ("0", "false", "no")
+# 第一步思考前最多等待概况分析完成的秒数，超时则退回原始预览
+PROFILE_WAIT_SECONDS = float(os.getenv("IDA_PROFILE_WAIT_SECONDS", "10"))
+
+# 分析逻辑或输出格式变化时递增，使旧缓存失效
+PROFILE_VERSION = 1
+CHUNK_ROWS = 50000
+DISTINCT_CAP = 10000
+SAMPLE_VALUES = 3
+SAMPLE_CHARS = 40
+PROMPT_MAX_COLUMNS = 80
+
+
+class _ColumnStats:
+    """单列的增量统计"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.dtypes: List[str] = []
+        self.distinct: set = set()
+        self.distinct_capped = False
+        self.min = None
+        self.max = None
+        self.samples: List[str] = []
+
+    def update(self, series):
+        import pandas as pd
+
+        self.count += len(series)
+        values = series.dropna()
+        self.nulls += len(series) - len(values)
+        dtype = str(series.dtype)
+        if dtype not in self.dtypes:
+            self.dtypes.append(dtype)
+        if values.empty:
+            return
+
+        if not self.distinct_capped:
+            try:
+                uniques = values.unique()
+            except TypeError:
+                uniques = values.astype(str).unique()
+            for value in uniques:
+                if len(self.distinct) >= DISTINCT_CAP:
+                    self.distinct_capped = True
+                    break
+                try:
+                    self.distinct.add(value)
+                except TypeError:
+                    self.distinct.add(str(value))
+
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            low, high = values.min(), values.max()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+
+        for value in values.head(SAMPLE_VALUES * 4):
+            text = str(value)
+            if len(self.samples) >= SAMPLE_VALUES:
+                break
+            if text not in self.samples:
+                self.samples.append(text[:SAMPLE_CHARS])
+
+    @staticmethod
+    def _scalar(value):
+        if value is None:
+            return None
+        if hasattr(value, "isoformat"):
+            return value.isoformat()
+        if hasattr(value, "item"):
+            return value.item()
+        return value
+
+    def _dtype(self) -> str:
+        """各块推断的类型不一致时，数值列合并为 float64，其余视为 object"""
+        if len(self.dtypes) == 1:
+            return self.dtypes[0]
+        numeric = {"int64", "float64", "Int64", "Float64", "int32", "float32"}
+        if set(self.dtypes) <= numeric:
+            return "float64"
+        return "object"
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "dtype": self._dtype(),
+            "nulls": self.nulls,
+            "null_rate": round(self.nulls / self.count, 4) if self.count else 0.0,
+            "distinct": len(self.distinct),
+            "distinct_capped": self.distinct_capped,
+            "min": self._scalar(self.min),
+            "max": self._scalar(self.max),
+            "samples": self.samples,
+        }
+
+
+def _profile_chunks(name: Optional[str], chunks: Iterator) -> Dict[str, Any]:
+    columns: Dict[str, _ColumnStats] = {}
+    rows = 0
+    for chunk in chunks:
+        rows += len(chunk)
+        for column in chunk.columns:
+            key = str(column)
+            if key not in columns:
+                columns[key] = _ColumnStats(key)
+            columns[key].update(chunk[column])
+    return {"name": name, "rows": rows, "columns": [stats.result() for stats in columns.values()]}
+
+
+def _arrow_batches(batches) -> Iterator:
+    for batch in batches:
+        yield batch.to_pandas()
+
+
+def _csv_chunks(file_path: str) -> Iterator:
+    import pandas as pd
+
+    sniffed = sniff_file(file_path)
+    return pd.read_csv(
+        file_path,
+        sep=sniffed["delimiter"],
+        encoding=sniffed["encoding"],
+        encoding_errors="replace",
+        chunksize=CHUNK_ROWS,
+    )
+
+
+def _excel_tables(file_path: str) -> Iterator[Tuple[str, Iterator]]:
+    """openpyxl 只读模式逐行读取每个工作表，按块组装 DataFrame"""
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            def chunks(sheet=sheet):
+                rows = sheet.iter_rows(values_only=True)
+                header = next(rows, None)
+                if header is None:
+                    return
+                names = [str(value) if value is not None else f"Unnamed: {i}" for i, value in enumerate(header)]
+                buffer = []
+                for row in rows:
+                    buffer.append(row[:len(names)])
+                    if len(buffer) >= CHUNK_ROWS:
+                        yield pd.DataFrame(buffer, columns=names).infer_objects()
+                        buffer = []
+                if buffer:
+                    yield pd.DataFrame(buffer, columns=names).infer_objects()
+            yield sheet.title, chunks()
+    finally:
+        workbook.close()
+
+
+def iter_tables(file_path: str) -> Iterator[Tuple[Optional[str], Iterator]]:
+    """按文件类型返回 (表名, DataFrame 块迭代器)"""
+    import pyarrow.ipc as ipc
+
+    # 列式缓存已就绪时直接按批读取，类型与缓存一致
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        for sheet in manifest["sheets"]:
+            with ipc.open_file(sheet["path"]) as reader:
+                yield sheet.get("sheet"), _arrow_batches(reader.get_batch(i) for i in range(reader.num_record_batches))
+        return
+
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in (".csv", ".tsv"):
+        yield None, _csv_chunks(file_path)
+    elif ext in (".xlsx", ".xlsm"):
+        yield from _excel_tables(file_path)
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq
+
+        yield None, _arrow_batches(pq.ParquetFile(file_path).iter_batches(batch_size=CHUNK_ROWS))
+    elif ext == ".feather":
+        with ipc.open_file(file_path) as reader:
+            yield None, _arrow_batches(reader.get_batch(i) for i in range(reader.num_record_batches))
+    elif ext == ".jsonl":
+        import pandas as pd
+
+        yield None, pd.read_json(file_path, lines=True, chunksize=CHUNK_ROWS)
+    else:
+        raise ValueError(f"不支持分析的文件类型: {ext}")
+
+
+def is_profilable(file_path: Optional[str]) -> bool:
+    if not file_path:
+        return False
+    return os.path.splitext(file_path)[1].lower() in {".csv", ".tsv", ".xlsx", ".xlsm", ".parquet", ".feather", ".jsonl"}
+
+
+def _profile_path(digest: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{digest}.json")
+
+
+def load_profile(digest: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_profile_path(digest), "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return profile if profile.get("version") == PROFILE_VERSION else None
+
+
+def profile_file(file_path: str) -> Dict[str, Any]:
+    """分块扫描文件生成概况，按内容哈希缓存"""
+    digest = file_digest(file_path)
+    profile = load_profile(digest)
+    if profile is not None:
+        return profile
+
+    started = time.time()
+    tables = [_profile_chunks(name, chunks) for name, chunks in iter_tables(file_path)]
+    profile = {
+        "version": PROFILE_VERSION,
+        "digest": digest,
+        "file_name": os.path.basename(file_path),
+        "tables": tables,
+        "elapsed": round(time.time() - started, 3),
+    }
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp_path = f"{_profile_path(digest)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, _profile_path(digest))
+    logger.info(f"数据概况分析完成: {file_path}，{len(tables)} 个表，耗时 {profile['elapsed']:.2f}s")
+    return profile
+
+
+class DatasetProfiler:
+    """在后台线程中分析上传文件，同一文件只分析一次"""
+
+    def __init__(self, enabled: bool = PROFILER_ENABLED):
+        self.enabled = enabled
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dataset-profiler")
+        self.lock = threading.Lock()
+        self.futures: Dict[str, Future] = {}
+
+    def _run(self, file_path: str) -> Optional[Dict[str, Any]]:
+        try:
+            return profile_file(file_path)
+        except Exception as e:
+            logger.error(f"数据概况分析失败: {file_path}: {e}")
+            return None
+
+    def submit(self, file_path: Optional[str]) -> Optional[Future]:
+        """提交后台分析任务（不支持的文件返回 None）"""
+        if not self.enabled or not is_profilable(file_path) or not os.path.exists(file_path):
+            return None
+        key = os.path.abspath(file_path)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.result() is None):
+                future = self.executor.submit(self._run, key)
+                self.futures[key] = future
+        return future
+
+
+def format_schema_block(profile: Optional[Dict[str, Any]]) -> str:
+    """把概况整理为提示词中的紧凑结构说明"""
+    if not profile:
+        return ""
+    lines = ["数据概况（全量扫描结果）:"]
+    for table in profile["tables"]:
+        label = f"表 {table['name']!r}" if table.get("name") is not None else "数据"
+        lines.append(f"{label}: {table['rows']} 行 × {len(table['columns'])} 列")
+        for column in table["columns"][:PROMPT_MAX_COLUMNS]:
+            distinct = f"≥{column['distinct']}" if column["distinct_capped"] else str(column["distinct"])
+            parts = [column["dtype"], f"空值 {column['null_rate']:.1%}", f"唯一值 {distinct}"]
+            if column["min"] is not None:
+                parts.append(f"范围 [{column['min']}, {column['max']}]")
+            if column["samples"]:
+                parts.append("示例: " + " | ".join(column["samples"]))
+            lines.append(f"- {column['name']}: " + ", ".join(parts))
+        if len(table["columns"]) > PROMPT_MAX_COLUMNS:
+            lines.append(f"- ... 另有 {len(table['columns']) - PROMPT_MAX_COLUMNS} 列未列出")
+    return "\n".join(lines)
+
+
+dataset_profiler = DatasetProfiler()
@@ -0,0 +1,165 @@
+"""
+模型回复 JSON 的解析与修复
+
+ReAct 循环要求模型返回 {"thought": ..., "action": {"name": ..., "input": ...}}。
+支持结构化输出（JSON Schema）的服务端会保证格式；不支持时模型偶尔会输出
+markdown 代码块标记、JSON 前后的说明文字、字符串中未转义的换行等，
+json.loads 失败就要多花一轮模型调用。这里先尝试严格解析，失败后在本地修复：
+- 按括号匹配截取第一个完整的 JSON 对象（字符串中的括号不计），丢弃前后的代码块标记和说明文字
+- 转义字符串中的原始换行、制表符等控制字符
+- 删除对象和数组末尾多余的逗号，补齐被截断的字符串和括号
+- 最后尝试按 Python 字面量解析（单引号、True/False/None）
+解析成功、修复成功与失败的次数记录在统计中。
+"""
+import ast
+import json
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+class ReplyParseError(ValueError):
+    """模型回复无法解析为 JSON 对象"""
+
+
+@lru_cache(maxsize=4)
+def reply_schema(actions: Sequence[str]) -> Dict[str, Any]:
+    """模型回复的 JSON Schema（结构化输出的 strict 模式要求所有字段必填、不允许额外字段）"""
+    return {
+        "type": "object",
+        "properties": {
+            "thought": {"type": "string"},
+            "action": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "enum": list(actions)},
+                    "input": {"type": "string"},
+                },
+                "required": ["name", "input"],
+                "additionalProperties": False,
+            },
+        },
+        "required": ["thought", "action"],
+        "additionalProperties": False,
+    }
+
+
+def _extract_object(text: str) -> str:
+    """
+    截取第一个 JSON 对象（之前的代码块标记与说明文字、之后的内容都会被丢弃），
+    同时转义字符串中的控制字符、删除括号前多余的逗号；对象被截断时补齐未结束的字符串和括号。
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ReplyParseError("回复中没有 JSON 对象")
+    out: List[str] = []
+    closers: List[str] = []
+    in_string = False
+    escaped = False
+    for char in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            elif char in _CONTROL_ESCAPES:
+                char = _CONTROL_ESCAPES[char]
+            out.append(char)
+            continue
+        if char in "}]":
+            _strip_trailing_comma(out)
+        out.append(char)
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if closers:
+                closers.pop()
+            if not closers:
+                break
+    if in_string:
+        out.append("\\" if escaped else "")
+        out.append('"')
+    for closer in reversed(closers):
+        _strip_trailing_comma(out)
+        out.append(closer)
+    return "".join(out)
+
+
+def _strip_trailing_comma(out: List[str]):
+    index = len(out) - 1
+    while index >= 0 and out[index] in " \t\r\n":
+        index -= 1
+    if index >= 0 and out[index] == ",":
+        del out[index]
+
+
+def repair_json(text: str) -> Dict[str, Any]:
+    """修复并解析模型回复中的 JSON 对象，失败时抛出 ReplyParseError"""
+    candidate = _extract_object(text or "")
+    try:
+        value = json.loads(candidate)
+    except ValueError:
+        try:
+            value = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError) as e:
+            raise ReplyParseError(f"修复后仍无法解析: {e}") from None
+    if not isinstance(value, dict):
+        raise ReplyParseError("回复不是 JSON 对象")
+    return value
+
+
+class ReplyParser:
+    """解析模型回复，统计严格解析、本地修复与失败的次数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {"replies": 0, "parsed": 0, "repaired": 0, "failed": 0}
+
+    def _record(self, outcome: str):
+        with self.lock:
+            self.stats["replies"] += 1
+            self.stats[outcome] += 1
+
+    def parse(self, text: str, streamed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        解析模型回复
+
+        streamed 为流式增量解析得到的结果：已包含行动名称时直接使用。
+        失败时抛出 ReplyParseError。
+        """
+        if isinstance(streamed, dict) and isinstance(streamed.get("action"), dict) and streamed["action"].get("name"):
+            self._record("parsed")
+            return streamed
+        try:
+            value = json.loads(text)
+            if isinstance(value, dict):
+                self._record("parsed")
+                return value
+        except ValueError:
+            pass
+        try:
+            value = repair_json(text)
+        except ReplyParseError:
+            self._record("failed")
+            raise
+        self._record("repaired")
+        logger.info("模型回复不是合法 JSON，已在本地修复")
+        return value
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+        stats["failure_rate"] = round(stats["failed"] / stats["replies"], 4) if stats["replies"] else 0.0
+        return stats
+
+
+reply_parser = ReplyParser()
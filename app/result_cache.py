@@ -0,0 +1,258 @@
+"""
+按内容寻址的代码执行结果缓存
+
+缓存键 = hash(代码, 输入文件内容哈希, 执行环境版本, 内核上下文)，
+其中内核上下文是同一会话内之前执行过的代码单元的哈希链，保证命中时内核状态一致。
+结果以 JSON 文件保存在 data/cache/exec 下，按总大小做 LRU 淘汰：总大小在内存中累计（第一次写入时扫描一遍目录），
+只有超过上限时才扫描目录，并删除到上限的 LOW_WATER_RATIO，避免每次写入都遍历缓存目录。
+使用随机数或当前时间且未设置种子的代码不会被缓存。
+"""
+import os
+import ast
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CACHE_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "exec")
+
+EXEC_CACHE_ENABLED = os.getenv("IDA_EXEC_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+EXEC_CACHE_MAX_BYTES = int(os.getenv("IDA_EXEC_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# 超出上限后删除到上限的这个比例
+LOW_WATER_RATIO = 0.9
+# 执行器行为变化时递增，使旧缓存失效
+EXECUTOR_VERSION = "1"
+ENV_PACKAGES = ["pandas", "numpy", "scipy", "matplotlib", "openpyxl", "pyarrow"]
+
+# 读取当前时间或系统熵的调用，无法通过设置种子复现
+NONDETERMINISTIC_CALLS = {
+    "time", "time_ns", "perf_counter", "monotonic", "localtime", "ctime",
+    "now", "today", "utcnow", "urandom", "uuid1", "uuid4", "token_hex", "token_bytes",
+}
+UNSEEDABLE_MODULES = {"secrets", "uuid"}
+SEED_CALLS = {"seed", "manual_seed", "set_seed"}
+
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+_file_digest_lock = threading.Lock()
+_env_version: Optional[str] = None
+
+
+def _dotted_name(node: ast.AST) -> str:
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+        return ".".join(reversed(parts))
+    return ""
+
+
+def is_deterministic(code: str) -> bool:
+    """粗略判断代码是否可复现：读取当前时间，或使用随机数但没有设置种子时视为不可复现"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+
+    uses_random = False
+    has_seed = False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = [alias.name for alias in node.names]
+            if isinstance(node, ast.ImportFrom) and node.module:
+                modules.append(node.module)
+            roots = {name.split(".")[0] for name in modules}
+            if roots & UNSEEDABLE_MODULES:
+                return False
+            if "random" in roots:
+                uses_random = True
+        elif isinstance(node, ast.Call):
+            name = _dotted_name(node.func)
+            short_name = name.rsplit(".", 1)[-1]
+            if short_name in NONDETERMINISTIC_CALLS:
+                return False
+            if short_name in SEED_CALLS:
+                has_seed = True
+            elif short_name == "default_rng":
+                if node.args or node.keywords:
+                    has_seed = True
+                else:
+                    uses_random = True
+            elif ".random." in f".{name}.":
+                # np.random.xxx / random.xxx
+                uses_random = True
+            elif short_name == "sample" and not any(k.arg == "random_state" for k in node.keywords):
+                # DataFrame.sample 未指定 random_state
+                uses_random = True
+    return has_seed or not uses_random
+
+
+def file_digest(file_path: Optional[str]) -> str:
+    """计算文件内容的 sha256，按 (路径, 大小, 修改时间) 记忆结果"""
+    if not file_path or not os.path.exists(file_path):
+        return ""
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _file_digest_lock:
+        digest = _file_digests.get(memo_key)
+    if digest:
+        return digest
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with _file_digest_lock:
+        _file_digests[memo_key] = digest
+    return digest
+
+
+def record_file_digest(file_path: str, digest: str):
+    """写入时已算出内容哈希的文件（例如上传入库），直接记入记忆，不必再读一遍"""
+    stat = os.stat(file_path)
+    with _file_digest_lock:
+        _file_digests[(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)] = digest
+
+
+def environment_version() -> str:
+    """执行环境版本：Python 版本、执行器版本以及常用数据分析库的版本"""
+    global _env_version
+    if _env_version is None:
+        from importlib import metadata
+
+        parts = [sys.version.split()[0], EXECUTOR_VERSION]
+        for package in ENV_PACKAGES:
+            try:
+                parts.append(f"{package}={metadata.version(package)}")
+            except metadata.PackageNotFoundError:
+                parts.append(f"{package}=none")
+        _env_version = ";".join(parts)
+    return _env_version
+
+
+def make_key(code: str, input_digest: str, context: str = "") -> str:
+    hasher = hashlib.sha256()
+    for part in (code, input_digest, environment_version(), context):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """磁盘上的执行结果缓存，按总大小做 LRU 淘汰（以文件修改时间作为最近使用时间）"""
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = EXEC_CACHE_MAX_BYTES, enabled: bool = EXEC_CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # 缓存目录的总字节数，第一次写入时扫描得到，之后按写入与淘汰累计（None 表示尚未扫描）
+        self.total_bytes: Optional[int] = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "skipped_nondeterministic": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path, None)
+        except (OSError, ValueError):
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        entry = dict(entry, cached_at=time.time())
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入执行缓存失败: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.stats["stores"] += 1
+            if self.total_bytes is None:
+                scan = True
+            else:
+                self.total_bytes += size - replaced
+                scan = self.total_bytes > self.max_bytes
+        if scan:
+            self.evict()
+
+    def _scan(self) -> list:
+        """扫描缓存目录，返回 [(修改时间, 大小, 路径)]"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        扫描缓存目录校正总大小；超过上限时删除最久未使用的条目，直到低于上限的 LOW_WATER_RATIO
+
+        总大小会因容量回收等外部删除而偏大，偏大只会让扫描提前发生，扫描后即校正。
+        """
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * LOW_WATER_RATIO
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+        with self.lock:
+            self.total_bytes = total
+            self.stats["evictions"] += evicted
+
+    def record_skip(self):
+        """记录因代码不可复现而跳过缓存的次数"""
+        with self.lock:
+            self.stats["skipped_nondeterministic"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats, enabled=self.enabled, total_bytes=self.total_bytes, max_bytes=self.max_bytes)
+
+
+result_cache = ResultCache()
@@ -0,0 +1,212 @@
+"""
+全局代码执行调度器
+
+进程内所有会话（Chainlit 与 app/main.py 的 FastAPI 接口）共用同一个调度器：
+- 同时运行的代码单元数量有上限
+- 排队任务按用户轮转（round-robin），每次从轮转队首的用户取一个任务，避免单个用户占满执行资源
+- 同一用户的排队任务中，预估较短的代码优先，等待时间越长优先级越高
+- 等待超过 MAX_QUEUE_WAIT 秒的任务不受轮转顺序限制，按排队先后直接出队，作为防止饿死的兜底
+"""
+import os
+import re
+import time
+import heapq
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Callable, Any
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_EXECUTIONS = int(
+    os.getenv("IDA_MAX_CONCURRENT_EXECUTIONS", str(max(1, min(4, (os.cpu_count() or 2) // 2))))
+)
+# 排队时每等待 1 秒抵消的预估成本，防止长任务被短任务无限推后
+AGING_PER_SECOND = 2.0
+# 等待超过这么多秒的任务优先于所有未超时的任务出队
+MAX_QUEUE_WAIT = float(os.getenv("IDA_SCHEDULER_MAX_WAIT", "60"))
+
+# 预估成本较高的操作
+HEAVY_PATTERNS = [
+    r"read_(csv|excel|parquet|json|feather)", r"\.merge\(", r"\.join\(", r"\.groupby\(",
+    r"\.apply\(", r"\.pivot", r"\.fit\(", r"\.plot\(", r"plt\.", r"sns\.", r"for\s+.+\s+in\s+",
+]
+
+
+class ExecutionCancelled(Exception):
+    """排队中的执行被取消"""
+
+
+def estimate_cost(code: str) -> float:
+    """粗略预估代码执行成本：代码行数加上重量级操作的权重"""
+    lines = [line for line in (code or "").splitlines() if line.strip() and not line.strip().startswith("#")]
+    cost = float(len(lines))
+    for pattern in HEAVY_PATTERNS:
+        cost += 10 * len(re.findall(pattern, code or ""))
+    return cost
+
+
+class _Ticket:
+    def __init__(self, seq: int, user_id: str, cost: float):
+        self.seq = seq
+        self.user_id = user_id
+        self.cost = cost
+        self.enqueued_at = time.time()
+        self.granted_at: Optional[float] = None
+        self.cancelled = False
+
+    def priority(self, now: float) -> float:
+        return self.cost - AGING_PER_SECOND * (now - self.enqueued_at)
+
+    @property
+    def wait_time(self) -> float:
+        return (self.granted_at or time.time()) - self.enqueued_at
+
+
+class ExecutionScheduler:
+    """有界并发、按用户公平轮转的执行调度器"""
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_EXECUTIONS):
+        self.max_workers = max(1, max_workers)
+        self.cond = threading.Condition()
+        self.running = 0
+        # 用户 -> 排队中的任务；OrderedDict 的顺序即轮转顺序
+        self.queues: "OrderedDict[str, List[_Ticket]]" = OrderedDict()
+        self.counter = itertools.count(1)
+        self.stats = {"executed": 0, "queued": 0, "cancelled": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    # ---------- 内部调度（调用方需持有锁） ----------
+
+    def _pick(self, queues: "OrderedDict[str, List[_Ticket]]", now: float) -> Optional[_Ticket]:
+        """从轮转队首的用户取出其优先级最高的任务，并把该用户移到队尾；有超时任务时先取最早的超时任务"""
+        for user_id in list(queues.keys()):
+            queues[user_id][:] = [t for t in queues[user_id] if not t.cancelled]
+            if not queues[user_id]:
+                del queues[user_id]
+        if not queues:
+            return None
+
+        overdue = [t for tickets in queues.values() for t in tickets if now - t.enqueued_at >= MAX_QUEUE_WAIT]
+        if overdue:
+            best = min(overdue, key=lambda t: t.seq)
+            user_id = best.user_id
+        else:
+            user_id = next(iter(queues))
+            best = min(queues[user_id], key=lambda t: (t.priority(now), t.seq))
+        tickets = queues[user_id]
+        tickets.remove(best)
+        queues.move_to_end(user_id)
+        if not tickets:
+            del queues[user_id]
+        return best
+
+    def _dispatch(self):
+        now = time.time()
+        while self.running < self.max_workers:
+            ticket = self._pick(self.queues, now)
+            if ticket is None:
+                break
+            ticket.granted_at = now
+            self.running += 1
+        self.cond.notify_all()
+
+    def _position(self, target: _Ticket) -> int:
+        """模拟调度顺序，计算任务前面还有多少个排队任务"""
+        queues = OrderedDict((user, list(tickets)) for user, tickets in self.queues.items())
+        now = time.time()
+        position = 0
+        while True:
+            ticket = self._pick(queues, now)
+            if ticket is None or ticket is target:
+                return position
+            position += 1
+
+    # ---------- 对外接口 ----------
+
+    def acquire(
+        self,
+        user_id: str,
+        code: str,
+        on_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> _Ticket:
+        """
+        申请一个执行槽位，必要时阻塞排队
+
+        on_update 在排队位置变化时收到 {"position": 排队位置, "wait_time": 已等待秒数}，
+        position 从 1 开始（1 表示下一个出队，前面还有 position - 1 个任务），获得槽位时收到 position 为 0 的最终通知。
+        """
+        ticket = _Ticket(next(self.counter), user_id or "anonymous", estimate_cost(code))
+        last_position = None
+        with self.cond:
+            self.queues.setdefault(ticket.user_id, []).append(ticket)
+            self._dispatch()
+            queued = ticket.granted_at is None
+            if queued:
+                self.stats["queued"] += 1
+
+            while ticket.granted_at is None:
+                if cancel_event is not None and cancel_event.is_set():
+                    ticket.cancelled = True
+                    self.stats["cancelled"] += 1
+                    self._dispatch()
+                    raise ExecutionCancelled("执行已取消")
+                position = self._position(ticket)
+                if on_update and position != last_position:
+                    last_position = position
+                    self._notify(on_update, {"position": position + 1, "wait_time": round(ticket.wait_time, 2)})
+                self.cond.wait(timeout=0.5)
+
+            self.stats["executed"] += 1
+            self.stats["total_wait"] += ticket.wait_time
+            self.stats["max_wait"] = max(self.stats["max_wait"], ticket.wait_time)
+
+        if queued:
+            logger.info(f"执行任务出队: 用户={ticket.user_id}, 等待 {ticket.wait_time:.2f}s, 预估成本={ticket.cost:.0f}")
+            if on_update:
+                self._notify(on_update, {"position": 0, "wait_time": round(ticket.wait_time, 2)})
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        """释放执行槽位"""
+        with self.cond:
+            self.running = max(0, self.running - 1)
+            self._dispatch()
+
+    @contextmanager
+    def slot(
+        self,
+        user_id: str,
+        code: str,
+        on_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ):
+        """在执行槽位内运行代码"""
+        ticket = self.acquire(user_id, code, on_update, cancel_event)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @staticmethod
+    def _notify(callback: Callable[[Dict[str, Any]], None], info: Dict[str, Any]):
+        try:
+            callback(info)
+        except Exception as e:
+            logger.warning(f"排队状态回调失败: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.cond:
+            stats = dict(self.stats)
+            stats["running"] = self.running
+            stats["max_workers"] = self.max_workers
+            stats["waiting"] = sum(len(tickets) for tickets in self.queues.values())
+            stats["waiting_users"] = len(self.queues)
+        executed = stats["executed"]
+        stats["avg_wait"] = (stats.pop("total_wait") / executed) if executed else 0.0
+        return stats
+
+
+execution_scheduler = ExecutionScheduler()
@@ -0,0 +1,162 @@
+"""
+文本数据文件的编码与分隔符探测
+
+只读取文件开头、中间和结尾的几段样本（一次打开文件），探测编码和分隔符，
+结果按文件内容哈希缓存在 data/cache/sniff。预览、列式缓存、概况分析都使用同一份结果，
+生成的代码通过提示词中的参数和环境变量 IDA_FILE_ENCODING / IDA_FILE_SEP 第一次就能正确读取文件。
+"""
+import os
+import csv
+import json
+import codecs
+import logging
+import threading
+from typing import Dict, Optional, Any, List
+
+from app.result_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SNIFF_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "sniff")
+
+TEXT_DATA_EXTENSIONS = {".csv", ".tsv"}
+# 每段样本的字节数，以及文件中取样的段数（开头、中间各段、结尾）
+SAMPLE_BYTES = 64 * 1024
+SAMPLE_COUNT = 4
+# 候选编码按顺序尝试；gb18030 兼容 gbk/cp936，latin1 总能解码，作为兜底
+CANDIDATE_ENCODINGS = ["utf-8", "gb18030", "big5", "latin1"]
+CANDIDATE_DELIMITERS = ",\t;|"
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+_memo: Dict[str, Dict[str, Any]] = {}
+_memo_lock = threading.Lock()
+
+
+def is_text_data(file_path: Optional[str]) -> bool:
+    if not file_path:
+        return False
+    return os.path.splitext(file_path)[1].lower() in TEXT_DATA_EXTENSIONS
+
+
+def _read_samples(file_path: str) -> List[bytes]:
+    """均匀读取几段样本；中间的样本对齐到整行，避免切断多字节字符"""
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        if size <= SAMPLE_BYTES * SAMPLE_COUNT:
+            return [f.read()]
+        samples = []
+        step = (size - SAMPLE_BYTES) // (SAMPLE_COUNT - 1)
+        for index in range(SAMPLE_COUNT):
+            f.seek(index * step)
+            data = f.read(SAMPLE_BYTES)
+            if index > 0:
+                data = data[data.find(b"\n") + 1:]
+            if index < SAMPLE_COUNT - 1:
+                data = data[:data.rfind(b"\n") + 1]
+            samples.append(data)
+        return samples
+
+
+def detect_encoding(samples: List[bytes]) -> str:
+    head = samples[0] if samples else b""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    for encoding in CANDIDATE_ENCODINGS:
+        try:
+            for sample in samples:
+                sample.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin1"
+
+
+def detect_delimiter(text: str, default: str) -> str:
+    """用开头若干行探测分隔符"""
+    lines = text.splitlines()[:50]
+    sample = "\n".join(lines)
+    if not sample.strip():
+        return default
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=CANDIDATE_DELIMITERS).delimiter
+    except csv.Error:
+        # 探测失败时选各行出现次数一致且最多的候选分隔符
+        counts = {d: [line.count(d) for line in lines if line] for d in CANDIDATE_DELIMITERS}
+        consistent = [d for d, c in counts.items() if c and min(c) > 0 and len(set(c)) == 1]
+        return max(consistent, key=lambda d: counts[d][0]) if consistent else default
+
+
+def _cache_path(digest: str) -> str:
+    return os.path.join(SNIFF_DIR, f"{digest}.json")
+
+
+def sniff_file(file_path: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    探测文本数据文件的编码和分隔符
+
+    Returns:
+        {"encoding", "delimiter"}；不是文本数据文件时返回 None
+    """
+    if not is_text_data(file_path) or not os.path.exists(file_path):
+        return None
+    digest = file_digest(file_path)
+    with _memo_lock:
+        cached = _memo.get(digest)
+    if cached is not None:
+        return cached
+    try:
+        with open(_cache_path(digest), "r", encoding="utf-8") as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        result = None
+
+    if result is None:
+        samples = _read_samples(file_path)
+        encoding = detect_encoding(samples)
+        default = "\t" if file_path.lower().endswith(".tsv") else ","
+        result = {
+            "encoding": encoding,
+            "delimiter": detect_delimiter(samples[0].decode(encoding, errors="replace"), default),
+        }
+        try:
+            os.makedirs(SNIFF_DIR, exist_ok=True)
+            tmp_path = f"{_cache_path(digest)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, _cache_path(digest))
+        except OSError as e:
+            logger.warning(f"写入编码探测缓存失败: {e}")
+        logger.info(f"文件编码探测: {file_path} -> encoding={result['encoding']}, sep={result['delimiter']!r}")
+
+    with _memo_lock:
+        _memo[digest] = result
+    return result
+
+
+def file_env(file_path: Optional[str]) -> Dict[str, str]:
+    """传给执行内核的环境变量"""
+    if not file_path:
+        return {}
+    env = {"IDA_FILE_PATH": file_path}
+    sniffed = sniff_file(file_path)
+    if sniffed:
+        env["IDA_FILE_ENCODING"] = sniffed["encoding"]
+        env["IDA_FILE_SEP"] = sniffed["delimiter"]
+    return env
+
+
+def format_read_options(sniffed: Optional[Dict[str, Any]]) -> str:
+    """提示词中的读取参数说明"""
+    if not sniffed:
+        return ""
+    return (
+        f"文件编码与分隔符已探测，读取原文件时请直接使用: "
+        f"pd.read_csv(文件路径, encoding={sniffed['encoding']!r}, sep={sniffed['delimiter']!r})"
+        f"（也可从环境变量 IDA_FILE_ENCODING / IDA_FILE_SEP 读取）"
+    )
@@ -0,0 +1,293 @@
+"""
+嵌入式 SQL 查询引擎（DuckDB）
+
+run_sql 行动在服务进程内用 DuckDB 查询上传文件：文件以 pyarrow 数据集的形式注册为表，
+DuckDB 多线程流式扫描、把投影和过滤下推到扫描中，聚合超出内存上限时溢写到磁盘，
+适合对比内存还大的文件做聚合和筛选，而不必在执行内核里用 pandas 整个读入。
+已有列式缓存时扫描缓存（Excel 的每个工作表各一张表），否则直接扫描原文件。
+
+注册完数据表后关闭外部访问并锁定配置，查询只能读取这几张表，不能读写其它文件。
+完整结果按批写入 data/cache/sql/<键>.parquet（键由文件内容哈希和 SQL 决定，相同查询直接复用），
+观察结果只包含前 SQL_MAX_ROWS 行；后续 Python 代码可以读取这个文件。
+不超过 SQL_LOAD_MAX_ROWS 行、SQL_LOAD_MAX_BYTES 字节的结果在下一次执行代码前读入会话内核的 sql_result，
+更大的结果只提供文件路径 sql_result_path，由代码按需分块或按列读取。
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+
+from app.result_cache import file_digest
+from app.columnar_cache import read_manifest, safe_name, table_from_frame
+from app.sniffer import sniff_file
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SQL_DIR = os.path.join(PROJECT_ROOT, "data", "cache", "sql")
+SPILL_DIR = os.path.join(SQL_DIR, "spill")
+
+SQL_ENABLED = os.getenv("IDA_SQL_ENABLED", "1").lower() not in ("0", "false", "no")
+# 观察结果中最多展示的行数
+SQL_MAX_ROWS = int(os.getenv("IDA_SQL_MAX_ROWS", "200"))
+SQL_TIMEOUT = int(os.getenv("IDA_SQL_TIMEOUT", "300"))
+SQL_THREADS = int(os.getenv("IDA_SQL_THREADS", str(os.cpu_count() or 2)))
+SQL_MEMORY_LIMIT = os.getenv("IDA_SQL_MEMORY_LIMIT", "2GB")
+# 自动读入会话内核的结果上限（行数与 parquet 文件字节数），超出时只提供路径
+SQL_LOAD_MAX_ROWS = int(os.getenv("IDA_SQL_LOAD_MAX_ROWS", "1000000"))
+SQL_LOAD_MAX_BYTES = int(os.getenv("IDA_SQL_LOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+
+BATCH_ROWS = 65536
+# 结果文件格式或表注册方式变化时递增，使旧结果失效
+SQL_VERSION = 1
+DEFAULT_TABLE = "data"
+
+
+def is_available() -> bool:
+    if not SQL_ENABLED:
+        return False
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _table_name(sheet: Optional[str]) -> str:
+    if sheet is None:
+        return DEFAULT_TABLE
+    name = safe_name(sheet).lower()
+    return name if re.match(r"^[a-z_]", name) else f"t_{name}"
+
+
+def _datasets(file_path: str) -> List[Tuple[str, Any]]:
+    """上传文件对应的 (表名, pyarrow 数据集或表)"""
+    import pyarrow.dataset as ds
+
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        return [(_table_name(sheet.get("sheet")), ds.dataset(sheet["path"], format="ipc")) for sheet in manifest["sheets"]]
+
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in (".csv", ".tsv"):
+        import pyarrow.csv as pa_csv
+
+        sniffed = sniff_file(file_path)
+        csv_format = ds.CsvFileFormat(
+            parse_options=pa_csv.ParseOptions(delimiter=sniffed["delimiter"]),
+            read_options=pa_csv.ReadOptions(encoding=sniffed["encoding"]),
+        )
+        return [(DEFAULT_TABLE, ds.dataset(file_path, format=csv_format))]
+    if ext == ".parquet":
+        return [(DEFAULT_TABLE, ds.dataset(file_path, format="parquet"))]
+    if ext in (".feather", ".arrow"):
+        return [(DEFAULT_TABLE, ds.dataset(file_path, format="ipc"))]
+    if ext in (".xlsx", ".xlsm", ".xls"):
+        # 较大的 Excel 上传后会转换为列式缓存；到这里的是未转换的小文件，直接读入
+        import pandas as pd
+
+        sheets = pd.read_excel(file_path, sheet_name=None)
+        return [(_table_name(str(name)), table_from_frame(frame)) for name, frame in sheets.items()]
+    raise ValueError(f"不支持用 SQL 查询的文件类型: {ext}")
+
+
+def table_names(file_path: Optional[str]) -> List[str]:
+    """可查询的表名；不支持时返回空列表"""
+    if not file_path or not os.path.exists(file_path) or not is_available():
+        return []
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        return [_table_name(sheet.get("sheet")) for sheet in manifest["sheets"]]
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in (".csv", ".tsv", ".parquet", ".feather", ".arrow"):
+        return [DEFAULT_TABLE]
+    if ext in (".xlsx", ".xlsm"):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(file_path, read_only=True)
+        try:
+            return [_table_name(name) for name in workbook.sheetnames]
+        finally:
+            workbook.close()
+    return []
+
+
+def _connect(file_path: str):
+    import duckdb
+
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    con = duckdb.connect(":memory:")
+    con.execute(f"SET threads = {max(1, SQL_THREADS)}")
+    con.execute(f"SET memory_limit = '{SQL_MEMORY_LIMIT}'")
+    con.execute(f"SET temp_directory = '{SPILL_DIR}'")
+    for name, dataset in _datasets(file_path):
+        con.register(name, dataset)
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    return con
+
+
+def _result_path(digest: str, sql: str) -> str:
+    key = hashlib.sha256(f"{SQL_VERSION}\x00{digest}\x00{sql.strip()}".encode("utf-8")).hexdigest()
+    return os.path.join(SQL_DIR, f"{key}.parquet")
+
+
+def _read_cached(path: str) -> Dict[str, Any]:
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    head = next(parquet_file.iter_batches(batch_size=SQL_MAX_ROWS), None)
+    return {
+        "columns": parquet_file.schema_arrow.names,
+        "rows": parquet_file.metadata.num_rows,
+        "preview": head.to_pandas() if head is not None else None,
+    }
+
+
+def run_query(
+    sql: str,
+    file_path: str,
+    timeout: float = SQL_TIMEOUT,
+    cancel_event: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    """
+    在上传文件上执行 SQL，结果按批写入 parquet
+
+    Returns:
+        {"status", "error", "columns", "rows", "preview", "path", "elapsed", "cached"}；
+        preview 为前 SQL_MAX_ROWS 行的 DataFrame
+    """
+    started = time.time()
+    result: Dict[str, Any] = {
+        "status": "ok", "error": None, "columns": [], "rows": 0,
+        "preview": None, "path": None, "elapsed": 0.0, "cached": False,
+    }
+    path = _result_path(file_digest(file_path), sql)
+    if os.path.exists(path):
+        result.update(_read_cached(path), path=path, cached=True, elapsed=round(time.time() - started, 3))
+        return result
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    con = None
+    finished = threading.Event()
+    interrupted: List[str] = []
+
+    def watchdog():
+        # 超时或用户中止时中断正在运行的查询
+        while not finished.wait(0.2):
+            reason = "timeout" if time.time() - started > timeout else None
+            if cancel_event is not None and cancel_event.is_set():
+                reason = "cancelled"
+            if reason and con is not None:
+                interrupted.append(reason)
+                con.interrupt()
+                return
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    watcher = threading.Thread(target=watchdog, name="sql-watchdog", daemon=True)
+    try:
+        con = _connect(file_path)
+        watcher.start()
+        reader = con.execute(sql).fetch_record_batch(BATCH_ROWS)
+        head: List[Any] = []
+        head_rows = 0
+        writer = pq.ParquetWriter(tmp_path, reader.schema)
+        try:
+            for batch in reader:
+                writer.write_batch(batch)
+                result["rows"] += batch.num_rows
+                if head_rows < SQL_MAX_ROWS:
+                    head.append(batch.slice(0, SQL_MAX_ROWS - head_rows))
+                    head_rows += head[-1].num_rows
+        finally:
+            writer.close()
+        os.replace(tmp_path, path)
+        result["columns"] = reader.schema.names
+        result["preview"] = pa.Table.from_batches(head, schema=reader.schema).to_pandas()
+        result["path"] = path
+    except Exception as e:
+        result["status"] = "error"
+        if interrupted and interrupted[0] == "timeout":
+            result["error"] = f"查询超过 {timeout} 秒未完成，已中断"
+        elif interrupted:
+            result["error"] = "查询已取消"
+        else:
+            result["error"] = str(e)
+    finally:
+        finished.set()
+        if con is not None:
+            con.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    result["elapsed"] = round(time.time() - started, 3)
+    logger.info(
+        f"SQL 查询完成: 状态={result['status']}, {result['rows']} 行, 耗时 {result['elapsed']:.2f}s"
+        + (f", 错误: {result['error']}" if result["error"] else "")
+    )
+    return result
+
+
+def should_load(result: Dict[str, Any]) -> bool:
+    """查询结果是否小到可以自动读入会话内核"""
+    if result["status"] != "ok" or not result["path"]:
+        return False
+    try:
+        size = os.path.getsize(result["path"])
+    except OSError:
+        return False
+    return result["rows"] <= SQL_LOAD_MAX_ROWS and size <= SQL_LOAD_MAX_BYTES
+
+
+def load_result_code(path: str, preload: bool = True) -> str:
+    """
+    在执行内核中设置查询结果变量的代码
+
+    sql_result_path 总是指向结果文件；preload 时把结果读入 sql_result，
+    否则把 sql_result 置为 None，避免沿用上一次查询的结果。
+    """
+    code = f"sql_result_path = r'{path}'\n"
+    if preload:
+        return code + "import pandas as pd\nsql_result = pd.read_parquet(sql_result_path)"
+    return code + "sql_result = None"
+
+
+def format_sql_result(result: Dict[str, Any], in_session: bool = False, loaded: bool = False) -> str:
+    """把查询结果整理为观察文本（loaded 表示结果会读入会话内核的 sql_result）"""
+    if result["status"] != "ok":
+        return f"SQL 执行错误: {result['error']}"
+    preview = result["preview"]
+    if preview is None or preview.empty:
+        text = f"查询结果为空（列: {', '.join(result['columns'])}）"
+    else:
+        text = preview.to_string(index=False, max_colwidth=60)
+        if result["rows"] > len(preview):
+            text += f"\n... 共 {result['rows']} 行，仅显示前 {len(preview)} 行"
+    text += f"\n\n查询耗时 {result['elapsed']:.2f}s" + ("（复用之前的相同查询结果）" if result["cached"] else "")
+    if in_session and loaded:
+        text += f"\n完整结果已读入后续 Python 代码中的变量 sql_result（DataFrame），文件路径在变量 sql_result_path 中"
+    elif in_session:
+        text += (
+            f"\n完整结果较大（{result['rows']} 行），未自动读入内存，sql_result 为 None；文件路径在变量 sql_result_path 中，"
+            "请用 pd.read_parquet(sql_result_path, columns=[...]) 只读需要的列，"
+            "或用 pyarrow.parquet.ParquetFile(sql_result_path).iter_batches() 分块处理，也可以先在 SQL 中聚合"
+        )
+    else:
+        text += f"\n完整结果可在 Python 代码中用 pd.read_parquet(r'{result['path']}') 读取"
+    return text
+
+
+def describe_for_prompt(file_path: Optional[str]) -> str:
+    """提示词中的可查询表说明；不可用时返回空字符串"""
+    names = table_names(file_path)
+    if not names:
+        return ""
+    return (
+        f"run_sql 可查询的表: {', '.join(names)}（DuckDB SQL 方言，直接扫描全量数据，内存占用与文件大小无关）。"
+        f"对大文件做聚合、分组、筛选、排序时优先使用 run_sql；观察结果最多显示 {SQL_MAX_ROWS} 行，请在 SQL 中先聚合或 LIMIT。"
+    )
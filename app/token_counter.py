@@ -0,0 +1,58 @@
+"""
+本地 token 计数
+
+优先使用 tiktoken 按模型对应的编码计数；编码文件不可用（例如离线环境无法下载）时
+退回到近似估算：中日韩字符每个约 1 个 token，其余字符约 4 个一个 token。
+计数只用于日志、统计和上下文预算，不需要与服务端完全一致。
+"""
+import re
+import logging
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from langchain_core.messages import BaseMessage
+
+from app.llm_client import LLM_MODEL_NAME
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的角色、分隔符等固定开销（与 OpenAI 聊天格式的计数方式一致）
+MESSAGE_OVERHEAD = 4
+_CJK = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """模型对应的 tiktoken 编码；不可用时返回 None（只尝试一次）"""
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(LLM_MODEL_NAME)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.info(f"tiktoken 编码不可用，使用近似 token 计数: {e}")
+        return None
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """一段文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """一条消息的 token 数（含固定开销）"""
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+
+def count_message_tokens(messages: Iterable[BaseMessage]) -> int:
+    """消息列表的输入 token 数"""
+    return sum(message_tokens(message) for message in messages) + 3
@@ -11,11 +11,19 @@ IDA Agent - 智能数据分析助手
 
 import os
 import re
+import asyncio
 import logging
 from typing import Dict, List, Optional, Any
 import chainlit as cl
 import aiofiles
 from app.langgraph_workflow import process_query_streaming, detect_file_type
+from app.kernel import kernel_manager, kernel_pool
+from app.plot_store import thumbnail_for
+from app.columnar_cache import columnar_cache
+from app.profiler import dataset_profiler
+from app.large_file import large_file_sampler
+from app.blob_store import ingest_file, ingest_bytes
+from app.janitor import janitor
 
 # 配置日志
 logging.basicConfig(
@@ -72,6 +80,10 @@ async def on_chat_start():
 
     await cl.Message(content=welcome_msg).send()
 
+    # 在后台补足预热内核池，并启动 data/ 目录的容量回收
+    kernel_pool.warm()
+    janitor.start()
+
     # 初始化会话状态
     cl.user_session.set("file_path", None)
     logger.info("新的聊天会话已开始")
@@ -83,28 +95,61 @@ async def on_chat_resume(thread):
     当用户点击历史对话时触发
     """
     logger.info(f"恢复聊天会话")
+    janitor.start()
     
     # 从线程元数据中恢复文件路径 (如果有的话)
+    missing_file = None
     try:
         if hasattr(thread, 'metadata') and thread.metadata:
             metadata = thread.metadata
-            if "file_path" in metadata:
-                file_path = metadata["file_path"]
-                # 验证文件是否仍然存在
+            file_path = metadata.get("file_path")
+            if file_path:
+                # 验证文件是否仍然存在（可能已被容量回收删除）
                 if os.path.exists(file_path):
                     cl.user_session.set("file_path", file_path)
+                    # 会话存续期间该文件不会被回收
+                    janitor.pin(file_path, cl.user_session.get("id"))
                     logger.info(f"恢复文件路径: {file_path}")
                 else:
                     logger.warning(f"历史文件不存在: {file_path}")
                     cl.user_session.set("file_path", None)
+                    janitor.record_resume_missing()
+                    await update_thread_metadata({"file_path": None})
+                    missing_file = os.path.basename(file_path)
     except Exception as e:
         logger.warning(f"恢复会话元数据时出错: {e}")
         cl.user_session.set("file_path", None)
     
     # 发送恢复消息
     resume_msg = f"📚 **会话已恢复**\n\n继续您的数据分析之旅..."
+    if missing_file:
+        resume_msg += (
+            f"\n\n⚠️ 该会话关联的文件 `{missing_file}` 已在存储空间回收时被删除，"
+            f"无法继续基于它分析。如需继续，请重新上传该文件。"
+        )
     await cl.Message(content=resume_msg).send()
 
+@cl.on_chat_end
+async def on_chat_end():
+    """
+    聊天会话结束时释放该会话的常驻 Python 内核
+    """
+    session_id = cl.user_session.get("id")
+    if session_id:
+        kernel_manager.shutdown_kernel(session_id)
+        janitor.release(session_id)
+        logger.info(f"会话结束，已关闭内核: {session_id}")
+
+@cl.on_stop
+async def on_stop():
+    """
+    用户点击停止按钮时，中断当前会话内核中正在运行的代码
+    """
+    session_id = cl.user_session.get("id")
+    if session_id:
+        kernel_manager.interrupt(session_id)
+        logger.info(f"用户中止执行: {session_id}")
+
 # ==================== 步骤装饰器函数 ====================
 
 @cl.step(name="思考", type="thinking")
@@ -145,35 +190,91 @@ async def action_step(action: str, action_input: Dict = None):
     current_step.output = content
     return content
 
-@cl.step(name="代码执行", type="code_execution")
-async def code_execution_step(code: str):
+async def open_streaming_step(name: str, step_type: str, header: str = "") -> cl.Step:
+    """
+    打开一个随模型生成逐步写入内容的步骤（思考、行动决策），生成结束后需要调用 close_step 关闭
+    """
+    step = cl.Step(name=name, type=step_type)
+    await step.__aenter__()
+    if header:
+        await step.stream_token(header)
+    return step
+
+def action_stream_header(action: str) -> str:
+    """流式显示行动输入前的标题：代码行动打开代码块，最终答案显示答案标题"""
+    content = f"**决策:** {action}\n" if action else ""
+    if action == "final_answer":
+        return content + "\n**答案:** "
+    language = "sql" if action == "run_sql" else "python"
+    return content + f"\n**{'SQL' if language == 'sql' else '代码'}:**\n```{language}\n"
+
+async def open_code_execution_step(code: str, data_scope: Optional[str] = None, language: str = "python") -> cl.Step:
     """
-    显示代码执行步骤
+    打开代码执行步骤，执行期间的输出会持续流式写入该步骤
     Args:
         code: 要执行的Python代码
+        data_scope: 大文件模式下本步骤使用的数据（sample 或 full）
+        language: python 或 sql（run_sql 行动）
     Returns:
-        执行状态信息
+        已打开的步骤对象，执行结束后需要调用 close_step 关闭
     """
-    current_step = cl.context.current_step
-    current_step.input = code
-    current_step.language = "python"
-    
+    scope_label = {"sample": "（样本数据）", "full": "（全量数据）"}.get(data_scope, "")
+    title = "SQL 查询" if language == "sql" else "代码执行"
+    step = cl.Step(name=f"{title}{scope_label}", type="code_execution", show_input=language)
+    step.input = code
+    await step.__aenter__()
+
     # 流式显示执行状态
-    await current_step.stream_token("⏳ 正在执行代码...\n\n")
-    
-    return "代码执行中..."
+    await step.stream_token("⏳ 正在执行查询...\n\n" if language == "sql" else "⏳ 正在执行代码...\n\n")
+    return step
+
+async def close_step(step: Optional[cl.Step]):
+    """关闭手动打开的步骤"""
+    if step and hasattr(step, '__aexit__'):
+        await step.__aexit__(None, None, None)
 
 @cl.step(name="执行结果", type="result", show_input=False)
-async def execution_result_step(result: str):
+async def execution_result_step(
+    result: str,
+    artifacts: Optional[List[Dict]] = None,
+    usage: Optional[Dict] = None,
+    plots: Optional[List[Dict]] = None,
+):
     """
     显示代码执行结果
     Args:
         result: 执行结果文本
+        artifacts: 被截断输出的完整内容文件
+        usage: 本次执行的资源使用记录
+        plots: 执行结束时自动捕获的图表
     Returns:
         执行结果
     """
     current_step = cl.context.current_step
     current_step.output = result
+    if usage:
+        cpu = (usage.get("cpu_user") or 0) + (usage.get("cpu_sys") or 0)
+        peak_mb = (usage.get("peak_rss_kb") or 0) / 1024
+        current_step.output += (
+            f"\n\n⏱ 耗时 {usage.get('wall_time', 0):.2f}s · CPU {cpu:.2f}s · 峰值内存 {peak_mb:.1f}MB"
+        )
+
+    # 输出过长时附上完整输出文件，供用户下载查看
+    elements = []
+    for artifact in artifacts or []:
+        if artifact.get("path") and os.path.exists(artifact["path"]):
+            elements.append(cl.File(
+                name=f"完整输出_{artifact.get('stream', 'stdout')}.log",
+                path=artifact["path"],
+                display="inline",
+            ))
+    # 图表以缩略图内联显示，原图在最终报告中引用
+    for plot in plots or []:
+        image_path = plot.get("thumbnail") or plot.get("path")
+        if image_path and os.path.exists(image_path):
+            elements.append(cl.Image(path=image_path, name=f"{plot['id']}.png", display="inline"))
+    if elements:
+        current_step.elements = elements
     return result
 
 @cl.step(name="观察", type="observation")
@@ -217,6 +318,11 @@ async def on_message(message: cl.Message):
                     # 保存上传的文件
                     file_path = await save_uploaded_file(element)
                     cl.user_session.set("file_path", file_path)
+                    janitor.pin(file_path, cl.user_session.get("id"))
+                    # 后台转换为列式缓存并分析数据概况，后续执行步骤读取更快
+                    columnar_cache.submit(file_path)
+                    dataset_profiler.submit(file_path)
+                    large_file_sampler.submit(file_path)
                     
                     # 更新线程元数据以保存文件路径到聊天历史
                     await update_thread_metadata({"file_path": file_path})
@@ -234,16 +340,38 @@ async def on_message(message: cl.Message):
         await cl.Message(content="请输入您的问题或需求。").send()
         return
 
+    current_exec_step = None
     try:
         # 调用流式处理函数，实时嵌套步骤
         current_round_step = None
         current_round_num = None
+        # 模型生成过程中流式写入的思考/行动步骤
+        streaming_thought_step = None
+        streaming_action_step = None
+        streaming_action = None
+        thought_streamed = False
         
-        async for chunk in process_query_streaming(user_input, file_path, []):
+        # 用户角色决定代码执行的资源限制
+        user = cl.user_session.get("user")
+        user_role = (user.metadata or {}).get("role") if user else None
+
+        async for chunk in process_query_streaming(
+            user_input,
+            file_path,
+            [],
+            session_id=cl.user_session.get("id"),
+            user_role=user_role,
+            user_id=user.identifier if user else None,
+        ):
             chunk_type = chunk.get("type")
             step_num = chunk.get("step", 0)
             
             if chunk_type == "step_start":
+                # 上一轮未正常结束的流式步骤一并关闭
+                await close_step(streaming_thought_step)
+                await close_step(streaming_action_step)
+                streaming_thought_step = streaming_action_step = None
+                thought_streamed = False
                 # 如果是新的一轮，关闭之前的轮次步骤
                 if current_round_step and hasattr(current_round_step, '__aexit__'):
                     await current_round_step.__aexit__(None, None, None)
@@ -253,27 +381,107 @@ async def on_message(message: cl.Message):
                 await current_round_step.__aenter__()
                 current_round_num = step_num
                 
+            elif chunk_type == "thought_delta" and current_round_step:
+                # 模型生成思考内容时逐段显示
+                if streaming_thought_step is None:
+                    streaming_thought_step = await open_streaming_step("思考", "thinking")
+                    thought_streamed = True
+                await streaming_thought_step.stream_token(chunk.get("content", ""))
+
+            elif chunk_type == "action_delta" and current_round_step:
+                # 模型生成代码（或最终答案）时逐段显示
+                await close_step(streaming_thought_step)
+                streaming_thought_step = None
+                if streaming_action_step is None:
+                    streaming_action = chunk.get("action", "")
+                    streaming_action_step = await open_streaming_step(
+                        "行动决策", "action", action_stream_header(streaming_action)
+                    )
+                await streaming_action_step.stream_token(chunk.get("content", ""))
+
             elif chunk_type == "thought" and current_round_step:
-                # 在当前轮次内显示思考过程
-                thought_content = chunk.get("content", "")
-                await thinking_step(thought_content)
+                # 在当前轮次内显示思考过程（已流式显示时只关闭步骤）
+                if streaming_thought_step is not None:
+                    await close_step(streaming_thought_step)
+                    streaming_thought_step = None
+                elif not thought_streamed:
+                    thought_content = chunk.get("content", "")
+                    await thinking_step(thought_content)
                 
             elif chunk_type == "action" and current_round_step:
-                # 在当前轮次内显示行动决策
+                # 在当前轮次内显示行动决策（已流式显示时补上代码块结尾并关闭步骤）
                 action = chunk.get("action", "")
                 action_input = chunk.get("action_input", {})
-                if action and action.strip():
+                if streaming_action_step is not None:
+                    if streaming_action != "final_answer":
+                        await streaming_action_step.stream_token("\n```")
+                    await close_step(streaming_action_step)
+                    streaming_action_step = None
+                elif action and action.strip():
                     await action_step(action, action_input)
                     
             elif chunk_type == "code_execution_start" and current_round_step:
                 # 在当前轮次内显示代码执行
                 code = chunk.get("code", "")
-                await code_execution_step(code)
+                await close_step(current_exec_step)
+                current_exec_step = await open_code_execution_step(code, chunk.get("data_scope"), chunk.get("language", "python"))
+
+            elif chunk_type == "large_file_mode":
+                # 大文件模式：显示抽样进度与样本规模
+                size_mb = chunk.get("file_size", 0) / 1024 / 1024
+                if chunk.get("status") == "sampling":
+                    await cl.Message(content=f"📦 文件较大（{size_mb:.0f}MB），正在抽取样本用于探索性分析...").send()
+                else:
+                    lines = [f"📦 大文件模式：探索性步骤使用样本，最终计算在全量数据上运行（抽样耗时 {chunk.get('elapsed', 0):.1f}s）"]
+                    for table in chunk.get("tables", []):
+                        strata = f"，按 {table['strata_column']} 分层" if table.get("strata_column") else ""
+                        lines.append(f"- {table.get('name') or '数据'}: 样本 {table['sample_rows']} 行 / 共 {table['rows_total']} 行{strata}")
+                    await cl.Message(content="\n".join(lines)).send()
+
+            elif chunk_type == "context_compacted":
+                # 上下文超出 token 预算，较早步骤的观察结果已压缩
+                target = "生成报告" if chunk.get("scope") == "report" else "继续分析"
+                await cl.Message(
+                    content=f"🗜️ 上下文较长，为{target}压缩了 {chunk.get('compacted_steps', 0)} 个较早步骤的输出"
+                    f"（{chunk.get('before_tokens', 0)} → {chunk.get('after_tokens', 0)} tokens）"
+                ).send()
+
+            elif chunk_type == "llm_queued" and current_round_step:
+                # 全局大模型限流：排队或退避重试时在当前轮次中提示
+                status = chunk.get("status")
+                if status == "waiting":
+                    reason = {"rate_limited": "服务端限流", "tokens_per_minute": "每分钟 token 数已满", "requests_per_minute": "每分钟请求数已满"}
+                    await current_round_step.stream_token(
+                        f"⌛ 大模型请求排队中（{reason.get(chunk.get('reason'), '繁忙')}，前面还有 {max(0, chunk.get('position', 1) - 1)} 个请求）\n"
+                    )
+                elif status == "retrying":
+                    await current_round_step.stream_token(
+                        f"🔁 大模型请求失败（{chunk.get('error')}），{chunk.get('delay', 0):.1f}s 后第 {chunk.get('attempt')} 次重试\n"
+                    )
+                elif status == "granted":
+                    await current_round_step.stream_token(f"▶️ 排队结束，等待 {chunk.get('wait_time', 0):.1f}s\n")
+
+            elif chunk_type == "code_execution_queued" and current_exec_step:
+                # 全局执行队列繁忙时显示排队位置
+                position = chunk.get("position", 0)
+                wait_time = chunk.get("wait_time", 0)
+                if position > 0:
+                    await current_exec_step.stream_token(f"⌛ 排队中，前面还有 {position - 1} 个任务（已等待 {wait_time:.1f}s）\n")
+                else:
+                    await current_exec_step.stream_token(f"▶️ 排队结束，等待 {wait_time:.1f}s，开始执行\n\n")
+
+            elif chunk_type == "code_execution_output" and current_exec_step:
+                # 代码运行期间实时追加输出
+                await current_exec_step.stream_token(chunk.get("content", ""))
                 
             elif chunk_type == "code_execution_result" and current_round_step:
                 # 在当前轮次内显示执行结果
+                await close_step(current_exec_step)
+                current_exec_step = None
                 result = chunk.get("result", "")
-                await execution_result_step(result)
+                if chunk.get("cached"):
+                    result = f"♻️ 命中执行缓存，未重新运行\n\n{result}"
+                await execution_result_step(result, chunk.get("artifacts"), chunk.get("usage"), chunk.get("plots"))
                 
             elif chunk_type == "observation" and current_round_step:
                 # 在当前轮次内显示观察结果
@@ -308,6 +516,8 @@ async def on_message(message: cl.Message):
         logger.error(f"处理消息时出错: {e}")
         await cl.Message(content=f"❌ **处理失败:** {str(e)}").send()
         return
+    finally:
+        await close_step(current_exec_step)
 
 # ==================== 辅助函数 ====================
 
@@ -331,7 +541,7 @@ async def update_thread_metadata(metadata: Dict[str, Any]):
 
 async def save_uploaded_file(file: cl.File) -> str:
     """
-    保存上传的文件到本地data目录
+    把上传的文件存入按内容寻址的存储（data/blobs），返回 data/uploads 下带原文件名的路径
     支持从file.path复制或file.content保存两种方式
     
     Args:
@@ -366,42 +576,14 @@ async def save_uploaded_file(file: cl.File) -> str:
             logger.error(f"文件大小为0: {file.name}")
             raise ValueError(f"文件 '{file.name}' 大小为0字节，请确保文件包含数据")
         
-        # 确保 data 目录存在
-        data_dir = os.path.join(os.path.dirname(__file__), 'data')
-        os.makedirs(data_dir, exist_ok=True)
-
-        # 生成唯一文件名
-        import time
-        timestamp = int(time.time())
-        name, ext = os.path.splitext(file.name)
-        safe_name = f"{name}_{timestamp}{ext}"
-        dest_path = os.path.join(data_dir, safe_name)
-
+        # 从 Chainlit 临时文件复制入库（不改动临时文件本身），内容相同的文件只保存一份
         try:
-            # 复制文件到目标目录
-            import shutil
-            shutil.copy2(source_path, dest_path)
-            
-            # 验证复制是否成功
-            if not os.path.exists(dest_path):
-                raise ValueError(f"文件复制失败，目标路径不存在: {dest_path}")
-                
-            dest_size = os.path.getsize(dest_path)
-            if dest_size != source_size:
-                raise ValueError(f"文件复制不完整，源文件: {source_size} 字节，目标文件: {dest_size} 字节")
-            
-            logger.info(f"文件已成功保存: {dest_path} (大小: {dest_size} 字节)")
-            return dest_path
-            
+            stored = await asyncio.to_thread(ingest_file, source_path, file.name)
         except Exception as e:
-            logger.error(f"文件复制失败: {e}")
-            # 清理可能创建的不完整文件
-            if os.path.exists(dest_path):
-                try:
-                    os.remove(dest_path)
-                except:
-                    pass
+            logger.error(f"文件入库失败: {e}")
             raise e
+        logger.info(f"文件已成功保存: {stored['file_path']} (大小: {stored['size']} 字节)")
+        return stored['file_path']
     
     # 回退到旧方法（兼容旧版本）
     elif hasattr(file, 'content') and file.content is not None:
@@ -411,33 +593,13 @@ async def save_uploaded_file(file: cl.File) -> str:
         if len(content) == 0:
             raise ValueError(f"文件 '{file.name}' 内容为空")
         
-        # 确保 data 目录存在
-        data_dir = os.path.join(os.path.dirname(__file__), 'data')
-        os.makedirs(data_dir, exist_ok=True)
-
-        # 生成唯一文件名
-        import time
-        timestamp = int(time.time())
-        name, ext = os.path.splitext(file.name)
-        safe_name = f"{name}_{timestamp}{ext}"
-        dest_path = os.path.join(data_dir, safe_name)
-
         try:
-            # 保存文件内容
-            async with aiofiles.open(dest_path, 'wb') as f:
-                await f.write(content)
-            
-            logger.info(f"文件已保存: {dest_path} (大小: {len(content)} 字节)")
-            return dest_path
-            
+            stored = await asyncio.to_thread(ingest_bytes, content, file.name)
         except Exception as e:
             logger.error(f"文件保存失败: {e}")
-            if os.path.exists(dest_path):
-                try:
-                    os.remove(dest_path)
-                except:
-                    pass
             raise e
+        logger.info(f"文件已保存: {stored['file_path']} (大小: {stored['size']} 字节)")
+        return stored['file_path']
     
     else:
         logger.error(f"无法获取文件内容，文件对象缺少path和content属性")
@@ -478,13 +640,16 @@ async def send_message_with_images(finalResponse: str) -> bool:
                     # 提取文件名作为图片的name
                     image_name = os.path.basename(image_path)
                     
-                    # 创建图片元素
-                    image = cl.Image(path=image_path, name=image_name, display="inline")
-                    
+                    # 图表库中的图片内联显示缩略图，原图作为附件下载
+                    thumbnail = thumbnail_for(image_path)
+                    elements = [cl.Image(path=thumbnail or image_path, name=image_name, display="inline")]
+                    if thumbnail:
+                        elements.append(cl.File(name=image_name, path=image_path, display="inline"))
+
                     # 发送图片消息，可以附带空文本
                     await cl.Message(
                         content="",  # 发送空内容以避免多余的文本
-                        elements=[image],
+                        elements=elements,
                     ).send()
                 else:
                     # 如果图片不存在，可以发送一条错误提示
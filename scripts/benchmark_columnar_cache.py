@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+列式缓存读取性能对比
+
+生成指定大小的 CSV（以及可选的 Excel）测试文件，对比：
+- 直接解析原文件（pd.read_csv / pd.read_excel），即每个执行步骤原来的读取方式
+- 一次性转换为列式缓存的耗时
+- 从列式缓存读取（pd.read_feather，以及内存映射的 pyarrow.feather.read_table）
+
+用法:
+    python scripts/benchmark_columnar_cache.py --csv-mb 150 --excel-rows 200000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from app.columnar_cache import convert_file
+
+
+def make_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "id": np.arange(rows),
+        "date": pd.date_range("2000-01-01", periods=rows, freq="min").strftime("%Y-%m-%d %H:%M:%S"),
+        "region": rng.choice(["华东", "华南", "华北", "西南", "东北"], rows),
+        "category": rng.choice([f"cat_{i}" for i in range(50)], rows),
+        "amount": rng.normal(1000, 250, rows).round(2),
+        "quantity": rng.integers(1, 500, rows),
+        "ratio": rng.random(rows),
+        "note": rng.choice(["", "退货", "促销", "新客户", "批发订单"], rows),
+    })
+
+
+def write_csv(path: str, target_mb: float):
+    """按块追加写入，直到文件达到目标大小"""
+    chunk_rows = 200_000
+    seed = 0
+    header = True
+    while not os.path.exists(path) or os.path.getsize(path) < target_mb * 1024 * 1024:
+        frame = make_frame(chunk_rows, seed)
+        frame["id"] += seed * chunk_rows
+        frame.to_csv(path, mode="a", header=header, index=False)
+        header = False
+        seed += 1
+
+
+def timed(func, repeat: int) -> float:
+    """多次运行取中位数（秒）"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def report(label: str, size: int, baseline: float, convert: float, cached: float, mapped: float):
+    print(f"\n[{label}] 文件大小 {size / 1024 / 1024:.1f}MB")
+    print(f"  原方式读取:         {baseline:8.3f}s")
+    print(f"  一次性转换:         {convert:8.3f}s")
+    print(f"  读取列式缓存:       {cached:8.3f}s  (加速 {baseline / max(cached, 1e-9):.1f}x)")
+    print(f"  内存映射(Arrow 表): {mapped:8.3f}s  (加速 {baseline / max(mapped, 1e-9):.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列式缓存读取性能对比")
+    parser.add_argument("--csv-mb", type=float, default=120, help="CSV 测试文件大小（MB）")
+    parser.add_argument("--excel-rows", type=int, default=0, help="Excel 测试文件行数，0 表示跳过")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数")
+    parser.add_argument("--workdir", default=None, help="测试文件目录，默认使用临时目录")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ida_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"测试目录: {workdir}")
+
+    csv_path = os.path.join(workdir, "bench.csv")
+    if not os.path.exists(csv_path):
+        write_csv(csv_path, args.csv_mb)
+    baseline = timed(lambda: pd.read_csv(csv_path), args.repeat)
+    started = time.perf_counter()
+    manifest = convert_file(csv_path)
+    convert = time.perf_counter() - started
+    cache_path = manifest["sheets"][0]["path"]
+    cached = timed(lambda: pd.read_feather(cache_path), args.repeat)
+    mapped = timed(lambda: feather.read_table(cache_path, memory_map=True), args.repeat)
+    report("CSV", os.path.getsize(csv_path), baseline, convert, cached, mapped)
+
+    if args.excel_rows > 0:
+        excel_path = os.path.join(workdir, "bench.xlsx")
+        if not os.path.exists(excel_path):
+            with pd.ExcelWriter(excel_path) as writer:
+                make_frame(args.excel_rows).to_excel(writer, sheet_name="orders", index=False)
+                make_frame(args.excel_rows // 10, seed=1).to_excel(writer, sheet_name="returns", index=False)
+        baseline = timed(lambda: pd.read_excel(excel_path, sheet_name=None), args.repeat)
+        started = time.perf_counter()
+        manifest = convert_file(excel_path)
+        convert = time.perf_counter() - started
+        paths = [sheet["path"] for sheet in manifest["sheets"]]
+        cached = timed(lambda: [pd.read_feather(path) for path in paths], args.repeat)
+        mapped = timed(lambda: [feather.read_table(path, memory_map=True) for path in paths], args.repeat)
+        report("Excel", os.path.getsize(excel_path), baseline, convert, cached, mapped)
+
+
+if __name__ == "__main__":
+    main()
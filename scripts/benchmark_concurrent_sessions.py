@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+多会话并发测试
+
+在同一个事件循环（相当于一个 Chainlit worker）中同时运行 N 个 process_query_streaming 会话，
+大模型替换为固定延迟的模拟模型，第一轮执行一段代码、第二轮给出最终答案，最后生成报告。
+同时运行一个心跳协程，每 50ms 醒来一次，记录事件循环的最大延迟：
+- 大模型调用是异步的：N 个会话的总耗时接近单个会话，而不是 N 倍
+- 等待模型期间事件循环不被阻塞：心跳的最大延迟远小于模型延迟
+
+用法:
+    python scripts/benchmark_concurrent_sessions.py --sessions 8 --latency 2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Any, List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import app.langgraph_workflow as workflow
+
+
+class SlowChatModel(BaseChatModel):
+    """固定延迟的模拟模型：先执行代码，看到观察结果后给出最终答案"""
+
+    latency: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        if any(isinstance(m, HumanMessage) and "观察" in str(m.content) for m in messages):
+            return json.dumps({"thought": "已得到结果", "action": {"name": "final_answer", "input": "完成"}}, ensure_ascii=False)
+        if len(messages) == 1:
+            # 生成报告
+            return "# 报告\n\n完成"
+        return json.dumps({
+            "thought": "先算一下",
+            "action": {"name": "execute_code", "input": "print(sum(range(1000)))"},
+        }, ensure_ascii=False)
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+
+async def run_session(index: int) -> float:
+    started = time.perf_counter()
+    async for event in workflow.process_query_streaming(f"会话 {index}", session_id=f"bench-{index}"):
+        if event["type"] == "error":
+            raise RuntimeError(event["message"])
+    return time.perf_counter() - started
+
+
+async def heartbeat(stop: asyncio.Event, interval: float = 0.05) -> float:
+    """返回事件循环的最大延迟（秒）"""
+    worst = 0.0
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - expected)
+    return worst
+
+
+async def main_async(sessions: int, latency: float):
+    workflow.llm = SlowChatModel(latency=latency)
+
+    # 单个会话的基准耗时（含内核启动）
+    single = await run_session(-1)
+
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(stop))
+    started = time.perf_counter()
+    durations = await asyncio.gather(*(run_session(i) for i in range(sessions)))
+    total = time.perf_counter() - started
+    stop.set()
+    lag = await beat
+
+    print(f"模拟模型延迟 {latency:.2f}s，单个会话耗时 {single:.2f}s")
+    print(f"{sessions} 个会话并发: 总耗时 {total:.2f}s（串行预计 {single * sessions:.2f}s）")
+    print(f"各会话耗时: 最短 {min(durations):.2f}s，最长 {max(durations):.2f}s")
+    print(f"事件循环最大延迟: {lag * 1000:.0f}ms")
+
+    for i in range(-1, sessions):
+        workflow.kernel_manager.shutdown_kernel(f"bench-{i}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多会话并发测试")
+    parser.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    parser.add_argument("--latency", type=float, default=2.0, help="模拟模型每次调用的延迟（秒）")
+    args = parser.parse_args()
+    asyncio.run(main_async(args.sessions, args.latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 测试从仓库根目录导入 app 包；共享的大模型客户端在导入时创建，需要一个（不会被使用的）API key
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("OPENAI_API_KEY", "test")
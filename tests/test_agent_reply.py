@@ -0,0 +1,45 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from langchain_core.messages import HumanMessage
+
+from app import langgraph_workflow as workflow
+from app.llm_cache import LLMCache
+
+REPLY = {"thought": "先看前几行", "action": {"name": "execute_code", "input": "print(df.head())"}}
+# 代码结束后模型还在生成，流式解析在 action.input 完成时提前结束
+CHUNKS = ['{"thought": "先看前几行", "action": {"name": "execute_code", ', '"input": "print(df.head())"', '}', '}']
+
+
+class FakeModel:
+    model_name = "fake-model"
+    temperature = 0
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+
+    async def astream(self, messages, **kwargs):
+        for text in self.chunks:
+            self.sent += 1
+            yield SimpleNamespace(content=text)
+
+
+def test_early_stop_returns_and_caches_complete_reply(tmp_path, monkeypatch):
+    model = FakeModel(CHUNKS)
+    cache = LLMCache(str(tmp_path / "responses.sqlite"), enabled=True)
+    monkeypatch.setattr(workflow, "llm", model)
+    monkeypatch.setattr(workflow, "llm_cache", cache)
+    messages = [HumanMessage(content="看看数据")]
+
+    text, data = asyncio.run(workflow.stream_agent_reply(messages))
+    assert model.sent == 2
+    assert data == REPLY
+    assert json.loads(text) == REPLY
+    assert workflow.reply_parser.parse(text, data) == REPLY
+
+    # 命中缓存时得到同样完整的回复
+    assert json.loads(cache.get(workflow.make_cache_key(model, messages))) == REPLY
+    assert asyncio.run(workflow.stream_agent_reply(messages)) == (text, data)
+    assert model.sent == 2
@@ -0,0 +1,75 @@
+from langchain_core.messages import HumanMessage
+
+from app.context_budget import compact_text, compact_texts, compact_steps, MAX_LINE_CHARS
+from app.token_counter import count_tokens
+
+
+def filler(count, prefix="plain text line without digits"):
+    return [f"{prefix} {'x' * (i % 5)}" for i in range(count)]
+
+
+def long_output():
+    lines = ["head one", "head two", "head three"]
+    lines += filler(200)
+    lines += ["mean revenue = 1234.5"]
+    lines += filler(200)
+    lines += ["Traceback (most recent call last):", "ValueError: bad column", "图表已自动保存: PLOT_PATH::/plots/a.png"]
+    lines += filler(200)
+    lines += ["tail one", "tail two", "tail three"]
+    return "\n".join(lines)
+
+
+def test_short_text_is_unchanged():
+    assert compact_text("a\nb\nc", 100) == "a\nb\nc"
+
+
+def test_keeps_errors_plots_edges_and_numbers():
+    text = long_output()
+    result = compact_text(text, 80)
+    for kept in ("head one", "tail three", "Traceback", "ValueError: bad column", "PLOT_PATH::/plots/a.png", "1234.5"):
+        assert kept in result
+    assert "...（省略" in result
+    assert count_tokens(result) < count_tokens(text) / 5
+
+
+def test_errors_are_kept_even_over_budget():
+    text = "\n".join(filler(50) + [f"Error {i}: failure" for i in range(30)] + filler(50))
+    result = compact_text(text, 10)
+    assert all(f"Error {i}: failure" in result for i in range(30))
+
+
+def test_long_lines_are_clipped():
+    text = "\n".join(["Error: " + "y" * 5000] + filler(100))
+    result = compact_text(text, 50)
+    assert max(len(line) for line in result.splitlines()) <= MAX_LINE_CHARS + 3
+
+
+def test_compact_texts_keeps_the_last_result():
+    texts = [long_output(), long_output(), long_output()]
+    result, info = compact_texts(texts, count_tokens(texts[-1]) + 2000)
+    assert result[-1] == texts[-1]
+    assert result[0] != texts[0]
+    assert info["compacted_steps"] == 2
+    assert info["after_tokens"] < info["before_tokens"]
+
+
+def test_compact_texts_within_budget_is_noop():
+    texts = ["a", "b"]
+    assert compact_texts(texts, 1000) == (texts, None)
+
+
+def render(step):
+    return [HumanMessage(content=step.get("prompt_observation") or step["observation"])]
+
+
+def test_compact_steps_is_sticky_and_skips_latest():
+    steps = [{"observation": long_output()} for _ in range(3)]
+    budget = count_tokens(steps[-1]["observation"]) + 2000
+    info = compact_steps(steps, budget, render)
+    assert info["compacted_steps"] >= 1
+    assert "prompt_observation" not in steps[-1]
+    compacted = [step["prompt_observation"] for step in steps[:-1] if "prompt_observation" in step]
+
+    # 再次调用时已压缩的内容保持不变，之前的消息前缀稳定
+    assert compact_steps(steps, budget, render) is None
+    assert [step["prompt_observation"] for step in steps[:-1] if "prompt_observation" in step] == compacted
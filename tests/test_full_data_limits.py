@@ -0,0 +1,49 @@
+import sys
+
+import pytest
+
+from app import kernel
+from app.kernel import full_data_limits, get_resource_limits, kernel_pool
+from app.langgraph_workflow import safe_code_executor
+
+# 约 2 秒 CPU 时间的单元格
+BUSY_CELL = """# ida:full-data
+import time
+started = time.process_time()
+while time.process_time() - started < 2:
+    pass
+print("done")
+"""
+
+
+@pytest.fixture(scope="module", autouse=True)
+def shutdown_pool():
+    yield
+    kernel_pool.shutdown()
+
+
+def test_full_data_limits_cover_timeout_and_memory(monkeypatch):
+    monkeypatch.setattr(kernel, "FULL_DATA_MEMORY_MB", 16384)
+    limits = full_data_limits(get_resource_limits("user"), 600)
+    assert limits["cpu_seconds"] >= 600
+    assert limits["memory_mb"] == 16384
+    assert limits["file_size_mb"] == get_resource_limits("user")["file_size_mb"]
+
+
+def test_zero_memory_limit_means_unlimited(monkeypatch):
+    monkeypatch.setattr(kernel, "FULL_DATA_MEMORY_MB", 0)
+    assert "memory_mb" not in full_data_limits(get_resource_limits("user"), 600)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="需要 rlimit")
+def test_full_data_cell_outlives_role_cpu_limit(monkeypatch):
+    monkeypatch.setenv("IDA_LIMITS_USER", "cpu_seconds=1")
+
+    # 普通步骤按角色的 CPU 时间限制终止
+    output, _ = safe_code_executor(BUSY_CELL, {"user_role": "user"})
+    assert "CPU 时间" in output
+
+    # 全量数据步骤的 CPU 时间放宽到超时秒数
+    output, _ = safe_code_executor(BUSY_CELL, {"user_role": "user", "execution_timeout": 30})
+    assert "done" in output
+    assert "资源限制" not in output
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from app.json_stream import IncrementalJSONParser
+
+REPLY = {
+    "thought": "先看一下数据 \"结构\"\n再统计",
+    "action": {"name": "execute_code", "input": "import pandas as pd\nprint(df['金额'].sum())"},
+    "extra": [1, -2.5, True, None, {"k": "v"}],
+}
+
+
+def feed_all(parser, pieces):
+    events = []
+    for piece in pieces:
+        events.extend(parser.feed(piece))
+    return events
+
+
+def deltas(events, path):
+    return "".join(value for kind, event_path, value in events if kind == "delta" and event_path == path)
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64])
+def test_any_chunking_gives_the_same_result(size):
+    text = json.dumps(REPLY, ensure_ascii=False)
+    parser = IncrementalJSONParser()
+    events = feed_all(parser, [text[i:i + size] for i in range(0, len(text), size)])
+    assert parser.done
+    assert parser.root == REPLY
+    assert deltas(events, ("thought",)) == REPLY["thought"]
+    assert deltas(events, ("action", "input")) == REPLY["action"]["input"]
+    assert events[-1] == ("end", (), REPLY)
+
+
+def test_partial_result_is_available_while_streaming():
+    parser = IncrementalJSONParser()
+    parser.feed('{"thought": "分析中", "action": {"name": "execute_co')
+    assert parser.value_at(("thought",)) == "分析中"
+    assert parser.value_at(("action", "name")) is None
+    parser.feed('de", "input": "print(1)"}}')
+    assert parser.value_at(("action", "name")) == "execute_code"
+
+
+def test_escapes_split_across_chunks():
+    parser = IncrementalJSONParser()
+    events = feed_all(parser, ['{"a": "x\\', 'ny\\u4e', '2d\\ud83d', '\\ude00"}'])
+    assert parser.root == {"a": "x\ny中😀"}
+    assert "\n" in deltas(events, ("a",))
+
+
+def test_skips_prefix_and_ignores_trailing_text():
+    parser = IncrementalJSONParser()
+    feed_all(parser, ["```json\n", '{"n": 12, "ok": false}', "\n```\n多余的说明"])
+    assert parser.done
+    assert parser.root == {"n": 12, "ok": False}
+
+
+def test_end_events_for_nested_values():
+    parser = IncrementalJSONParser()
+    events = parser.feed('{"a": [1, {"b": "c"}]}')
+    ends = [(path, value) for kind, path, value in events if kind == "end"]
+    assert (("a", 0), 1) in ends
+    assert (("a", 1, "b"), "c") in ends
+    assert (("a",), [1, {"b": "c"}]) in ends
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from app import llm_cache as cache_module
+from app.llm_cache import LLMCache, make_key, normalize_messages
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+
+def make_cache(tmp_path, monkeypatch, **kwargs):
+    clock = FakeClock()
+    monkeypatch.setattr(cache_module, "time", clock)
+    options = dict(ttl=3600, max_bytes=10 ** 6, enabled=True)
+    options.update(kwargs)
+    return LLMCache(str(tmp_path / "responses.sqlite"), **options), clock
+
+
+def test_key_ignores_whitespace_but_not_model_or_temperature():
+    model = SimpleNamespace(model_name="m1", temperature=0)
+    a = [SystemMessage(content="系统\r\n提示  \n"), HumanMessage(content=" 问题 ")]
+    b = [SystemMessage(content="系统\n提示"), HumanMessage(content="问题")]
+    assert normalize_messages(a) == normalize_messages(b)
+    assert make_key(model, a) == make_key(model, b)
+    assert make_key(model, a) != make_key(SimpleNamespace(model_name="m2", temperature=0), a)
+    assert make_key(model, a) != make_key(SimpleNamespace(model_name="m1", temperature=0.7), a)
+
+
+def test_hit_and_miss(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch)
+    assert cache.get("k") is None
+    cache.put("k", "m1", "回复")
+    assert cache.get("k") == "回复"
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["stores"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    cache, clock = make_cache(tmp_path, monkeypatch, ttl=60)
+    cache.put("k", "m1", "回复")
+    clock.now += 59
+    assert cache.get("k") == "回复"
+    clock.now += 2
+    assert cache.get("k") is None
+    assert cache.get_stats()["expired"] == 1
+
+
+def test_put_removes_expired_entries(tmp_path, monkeypatch):
+    cache, clock = make_cache(tmp_path, monkeypatch, ttl=60)
+    cache.put("old", "m1", "a")
+    clock.now += 120
+    cache.put("new", "m1", "b")
+    assert cache.get_stats()["expired"] == 1
+    count = cache.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    assert count == 1
+
+
+def test_evicts_least_recently_used_to_low_water(tmp_path, monkeypatch):
+    cache, clock = make_cache(tmp_path, monkeypatch, max_bytes=1000)
+    for name in "abcd":
+        cache.put(name, "m1", name * 200)
+        clock.now += 1
+    # 读取 a 后它成为最近使用的条目
+    assert cache.get("a") == "a" * 200
+    clock.now += 1
+    cache.put("e", "m1", "e" * 200)
+    cache.put("f", "m1", "f" * 200)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    total = cache.connection.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+    assert total <= 1000 * cache_module.LOW_WATER_RATIO
+    assert cache.get_stats()["evictions"] >= 2
+
+
+def test_disabled_cache_does_nothing(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch, enabled=False)
+    cache.put("k", "m1", "回复")
+    assert cache.get("k") is None
+    assert asyncio.run(cache.aget("k")) is None
+    assert cache.connection is None
+
+
+def test_version_is_part_of_the_key(monkeypatch):
+    # 保存格式变化后递增版本，旧版本的条目不会再命中
+    model = SimpleNamespace(model_name="m1", temperature=0)
+    key = make_key(model, "问题")
+    monkeypatch.setattr(cache_module, "LLM_CACHE_VERSION", "1")
+    assert make_key(model, "问题") != key
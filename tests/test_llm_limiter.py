@@ -0,0 +1,107 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from app import llm_limiter as limiter_module
+from app.llm_limiter import LLMLimiter, is_retryable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(limiter_module, "time", fake)
+    return fake
+
+
+def api_error(cls, status, headers=None):
+    request = httpx.Request("POST", "http://llm.test/v1/chat/completions")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return cls("error", response=response, body=None)
+
+
+def test_token_bucket_refills_per_second(clock):
+    limiter = LLMLimiter(rpm=0, tpm=6000)
+    limiter.tokens = 0.0
+    limiter.refilled_at = clock.now
+    assert limiter._token_wait(1000) == pytest.approx(10.0)
+    clock.now += 4
+    assert limiter._token_wait(1000) == pytest.approx(6.0)
+    assert limiter.tokens == pytest.approx(400.0)
+
+
+def test_token_bucket_is_capped_at_tpm(clock):
+    limiter = LLMLimiter(rpm=0, tpm=6000)
+    clock.now += 3600
+    assert limiter._token_wait(10) == 0.0
+    assert limiter.tokens == pytest.approx(6000.0)
+
+
+def test_request_window_waits_for_oldest_request(clock):
+    limiter = LLMLimiter(rpm=3, tpm=0)
+    for offset in (0, 10, 20):
+        limiter.sent.append(clock.now + offset)
+    clock.now += 30
+    assert limiter._request_wait() == pytest.approx(30.0)
+    clock.now += 30
+    assert limiter._request_wait() == 0.0
+    assert len(limiter.sent) == 2
+
+
+def test_unlimited_never_waits(clock):
+    limiter = LLMLimiter(rpm=0, tpm=0)
+    limiter.sent.extend([clock.now] * 10)
+    assert limiter._request_wait() == 0.0
+    assert limiter._token_wait(10 ** 9) == 0.0
+
+
+def test_acquire_waits_for_tokens_and_reports_queue():
+    limiter = LLMLimiter(rpm=0, tpm=6000)
+    events = []
+
+    async def run():
+        await limiter.acquire(6000)
+        await limiter.acquire(20, events.append)
+
+    asyncio.run(run())
+    assert [event["status"] for event in events] == ["waiting", "granted"]
+    assert events[0]["reason"] == "tokens_per_minute"
+    assert events[1]["wait_time"] >= 0.15
+    assert limiter.get_stats()["queued"] == 1
+
+
+def test_acquire_records_requests_in_window():
+    limiter = LLMLimiter(rpm=5, tpm=0)
+
+    async def run():
+        for _ in range(3):
+            await limiter.acquire(1)
+
+    asyncio.run(run())
+    assert limiter.get_stats()["recent_requests"] == 3
+
+
+def test_retryable_errors():
+    assert is_retryable(api_error(openai.RateLimitError, 429))
+    assert is_retryable(api_error(openai.InternalServerError, 503))
+    assert not is_retryable(api_error(openai.BadRequestError, 400))
+
+
+def test_rate_limit_backoff_uses_retry_after_and_pauses_all_requests():
+    limiter = LLMLimiter(rpm=0, tpm=0, max_retries=2)
+    error = api_error(openai.RateLimitError, 429, {"retry-after": "0.05"})
+
+    assert asyncio.run(limiter.backoff(error, 0))
+    assert limiter.paused_until > 0
+    assert limiter.stats["rate_limited"] == 1
+    assert not asyncio.run(limiter.backoff(error, 2))
+    assert limiter.stats["failures"] == 1
@@ -0,0 +1,142 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import blob_store, main
+
+BOUNDARY = "ida-test-boundary"
+HEADERS = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+
+
+def multipart(filename, chunks):
+    """分块生成 multipart 请求体；传给 TestClient 的生成器会以分块传输发送，不带 Content-Length"""
+    yield f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="instruction"\r\n\r\n统计行数\r\n'.encode()
+    yield (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    yield from chunks
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, "BLOB_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setattr(blob_store, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 1000)
+    monkeypatch.setattr(main, "UPLOAD_FORM_SLACK_BYTES", 1000)
+    monkeypatch.setattr(main, "UPLOAD_EXTENSIONS", {".csv"})
+    for background in (main.columnar_cache, main.dataset_profiler, main.large_file_sampler):
+        monkeypatch.setattr(background, "submit", lambda file_path: None)
+
+    calls = []
+
+    async def fake_stream(instruction, file_path=None, history_messages=None, session_id=None, user_role=None, user_id=None):
+        calls.append({"instruction": instruction, "file_path": file_path, "user_id": user_id})
+        yield {"type": "final_answer", "step": 1, "content": "共 2 行"}
+        yield {"type": "final_response", "content": "完成", "intermediate_steps": [], "execution_result": None, "file_path": file_path}
+
+    monkeypatch.setattr(main, "process_query_streaming", fake_stream)
+    test_client = TestClient(main.app)
+    test_client.calls = calls
+    return test_client
+
+
+def stream_events(response):
+    lines = [line[len("data: "):] for line in response.text.splitlines() if line.startswith("data: ")]
+    return [json.loads(line) for line in lines if line != "[DONE]"]
+
+
+def test_normal_upload_is_processed(client):
+    response = client.post("/api/process", content=b"".join(multipart("sales.csv", [b"a,b\n1,2\n3,4\n"])), headers=HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["response"] == "共 2 行"
+    with open(body["file_path"], "rb") as f:
+        assert f.read() == b"a,b\n1,2\n3,4\n"
+    assert client.calls[0]["user_id"] == "testclient"
+
+
+def test_chunked_upload_is_streamed(client):
+    response = client.post("/api/process-stream", content=multipart("sales.csv", [b"a,b\n", b"1,2\n"]), headers=HEADERS)
+    assert response.status_code == 200
+    events = stream_events(response)
+    assert events[0] == {"type": "final_answer", "step": 1, "content": "共 2 行"}
+    assert client.calls[0]["file_path"].endswith("sales.csv")
+
+
+def test_empty_upload_is_accepted(client):
+    response = client.post("/api/process", content=b"".join(multipart("empty.csv", [])), headers=HEADERS)
+    assert response.status_code == 200
+    with open(response.json()["file_path"], "rb") as f:
+        assert f.read() == b""
+
+
+def test_declared_oversized_body_is_rejected_before_parsing(client):
+    response = client.post("/api/process", content=b"".join(multipart("big.csv", [b"x" * 5000])), headers=HEADERS)
+    assert response.status_code == 413
+    assert not client.calls
+
+
+def test_chunked_oversized_body_is_rejected_while_reading(client):
+    response = client.post("/api/process-stream", content=multipart("big.csv", [b"x" * 500] * 10), headers=HEADERS)
+    assert response.status_code == 413
+    assert "上限" in response.json()["error"]
+    assert not client.calls
+
+
+def test_file_over_cap_within_form_slack_is_rejected(client):
+    response = client.post("/api/process", content=b"".join(multipart("big.csv", [b"x" * 1500])), headers=HEADERS)
+    assert response.status_code == 413
+    assert not client.calls
+
+
+def test_disallowed_extension_is_rejected(client):
+    response = client.post("/api/process", content=b"".join(multipart("script.py", [b"print(1)\n"])), headers=HEADERS)
+    assert response.status_code == 415
+    assert not client.calls
+
+
+def test_stream_endpoint_executes_code_through_shared_scheduler(monkeypatch):
+    from app import langgraph_workflow as workflow
+
+    replies = iter([("execute_code", "print(40 + 2)"), ("final_answer", "结果是 42")])
+
+    async def fake_agent(state, on_delta=None):
+        action, action_input = next(replies)
+        state["current_step"] += 1
+        state["intermediate_steps"].append({"thought": "t", "action": action, "action_input": action_input, "observation": ""})
+        state["action"], state["action_input"] = action, action_input
+        if action == "final_answer":
+            state["is_done"] = True
+            state["final_answer"] = action_input
+        return state
+
+    async def fake_report(last_thought, results, on_event=None):
+        return "报告: " + " ".join(results)
+
+    slots = []
+    original_slot = main.execution_scheduler.slot
+
+    def recording_slot(user_id, code, *args, **kwargs):
+        slots.append((user_id, code))
+        return original_slot(user_id, code, *args, **kwargs)
+
+    monkeypatch.setattr(workflow, "react_agent_node", fake_agent)
+    monkeypatch.setattr(workflow, "makeReport", fake_report)
+    monkeypatch.setattr(workflow, "safe_code_executor", lambda code, state, on_output=None: ("42\n", {
+        "output_artifacts": [], "execution_usage": None, "execution_cached": False, "execution_plots": [],
+    }))
+    monkeypatch.setattr(workflow.result_cache, "enabled", False)
+    # 工作流与接口使用的是同一个调度器实例
+    assert workflow.execution_scheduler is main.execution_scheduler
+    monkeypatch.setattr(main.execution_scheduler, "slot", recording_slot)
+
+    executed = main.execution_scheduler.get_stats()["executed"]
+    response = TestClient(main.app).post("/api/process-stream", data={"instruction": "算一下"})
+    events = stream_events(response)
+
+    assert slots == [("testclient", "print(40 + 2)")]
+    assert main.execution_scheduler.get_stats()["executed"] == executed + 1
+    assert any(event["type"] == "final_answer" and "42" in event["content"] for event in events)
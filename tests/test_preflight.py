@@ -0,0 +1,86 @@
+from app.preflight import preflight_check, format_preflight_report
+
+UPLOAD = "/srv/data/uploads/0123456789abcdef/sales.csv"
+
+
+def test_rewrites_path_with_upload_basename():
+    check = preflight_check('import pandas as pd\ndf = pd.read_csv("/mnt/data/sales.csv")', UPLOAD)
+    assert check["ok"]
+    assert repr(UPLOAD) in check["code"]
+    assert len(check["fixes"]) == 1
+
+
+def test_rewrites_windows_path_with_upload_basename():
+    check = preflight_check('pd.read_csv("C:\\\\Users\\\\me\\\\sales.csv")', UPLOAD)
+    assert check["ok"]
+    assert repr(UPLOAD) in check["code"]
+
+
+def test_keeps_relative_workspace_file_with_same_extension():
+    code = 'pd.read_csv("summary.csv")\npd.read_csv("out/daily.csv")'
+    check = preflight_check(code, UPLOAD)
+    assert check["ok"]
+    assert check["code"] == code
+    assert not check["fixes"]
+
+
+def test_rejects_missing_absolute_path_with_same_extension():
+    check = preflight_check('pd.read_csv("/tmp/other_dir/x.csv")', UPLOAD)
+    assert not check["ok"]
+    assert "/tmp/other_dir/x.csv" in check["errors"][0]
+    assert "x.csv" in check["code"]
+
+
+def test_rejects_relative_path_outside_workspace():
+    check = preflight_check('open("../../etc/x.csv")', UPLOAD)
+    assert not check["ok"]
+
+
+def test_rejects_missing_windows_path():
+    check = preflight_check('pd.read_excel("C:/Users/me/other.xlsx")', UPLOAD)
+    assert not check["ok"]
+
+
+def test_existing_absolute_path_and_upload_path_pass(tmp_path):
+    existing = tmp_path / "lookup.csv"
+    existing.write_text("a\n1\n")
+    code = f"pd.read_csv({str(existing)!r})\npd.read_csv({UPLOAD!r})"
+    check = preflight_check(code, UPLOAD)
+    assert check["ok"]
+    assert check["code"] == code
+
+
+def test_write_mode_open_is_not_checked():
+    check = preflight_check('open("/tmp/nowhere/result.txt", "w").write("x")', UPLOAD)
+    assert check["ok"]
+
+
+def test_files_written_in_the_same_cell_can_be_read_back():
+    code = (
+        "df.to_csv('/tmp/ida_missing/x.csv', index=False)\n"
+        "df.groupby('a').sum().to_parquet(path='/tmp/ida_missing/g.parquet')\n"
+        "with open('/tmp/ida_missing/notes.txt', 'w') as f:\n"
+        "    f.write('x')\n"
+        "a = pd.read_csv('/tmp/ida_missing/x.csv')\n"
+        "b = pd.read_parquet('/tmp/ida_missing/g.parquet')\n"
+        "c = open('/tmp/ida_missing/notes.txt').read()\n"
+    )
+    check = preflight_check(code, UPLOAD)
+    assert check["ok"], check["errors"]
+    assert check["code"] == code
+    # 没有写出的路径仍然报告
+    assert not preflight_check(code + "pd.read_csv('/tmp/ida_missing/y.csv')", UPLOAD)["ok"]
+
+
+def test_removes_plt_show_and_rejects_input():
+    check = preflight_check("import matplotlib.pyplot as plt\nplt.show()\nx = input()", UPLOAD)
+    assert not check["ok"]
+    assert "plt.show" not in check["code"]
+    report = format_preflight_report(check)
+    assert "input" in report and "plt.show()" in report
+
+
+def test_syntax_error():
+    check = preflight_check("def f(:\n    pass", UPLOAD)
+    assert not check["ok"]
+    assert "语法错误" in check["errors"][0]
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from app.reply_parser import ReplyParser, ReplyParseError, repair_json, reply_schema
+
+EXPECTED = {"thought": "t", "action": {"name": "execute_code", "input": "print(1)"}}
+
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"thought": "t", "action": {"name": "execute_code", "input": "print(1)"}}\n```',
+    '好的，下面是回复：{"thought": "t", "action": {"name": "execute_code", "input": "print(1)"}} 以上。',
+    '{"thought": "t", "action": {"name": "execute_code", "input": "print(1)",},}',
+    '{"thought": "t", "action": {"name": "execute_code", "input": "print(1)"',
+    "{'thought': 't', 'action': {'name': 'execute_code', 'input': 'print(1)'}}",
+])
+def test_repairs_common_reply_mistakes(text):
+    assert repair_json(text) == EXPECTED
+
+
+def test_escapes_raw_newlines_inside_strings():
+    text = '{"thought": "第一行\n第二行", "action": {"name": "execute_code", "input": "a = 1\n\tprint(a)"}}'
+    value = repair_json(text)
+    assert value["thought"] == "第一行\n第二行"
+    assert value["action"]["input"] == "a = 1\n\tprint(a)"
+
+
+def test_keeps_braces_fences_and_commas_inside_strings():
+    code = 'd = {"a": [1, 2,]}\nprint("```", d)'
+    text = '```json\n{"thought": "t", "action": {"name": "execute_code", "input": ' + json.dumps(code) + ",}}\n```"
+    assert repair_json(text)["action"]["input"] == code
+
+
+def test_truncated_string_is_closed():
+    value = repair_json('{"thought": "还没写完')
+    assert value == {"thought": "还没写完"}
+
+
+@pytest.mark.parametrize("text", ["", "没有 JSON", "{[}", "[1, 2]"])
+def test_unrepairable_replies_raise(text):
+    with pytest.raises(ReplyParseError):
+        repair_json(text)
+
+
+def test_parser_records_outcomes():
+    parser = ReplyParser()
+    assert parser.parse('{"thought": "t"}') == {"thought": "t"}
+    assert parser.parse('```json\n{"thought": "t"}\n```') == {"thought": "t"}
+    with pytest.raises(ReplyParseError):
+        parser.parse("无法解析")
+    stats = parser.get_stats()
+    assert (stats["parsed"], stats["repaired"], stats["failed"]) == (1, 1, 1)
+    assert stats["failure_rate"] == pytest.approx(1 / 3, abs=1e-4)
+
+
+def test_parser_prefers_streamed_result():
+    parser = ReplyParser()
+    assert parser.parse("", streamed=EXPECTED) is EXPECTED
+    assert parser.get_stats()["parsed"] == 1
+
+
+def test_schema_requires_known_actions():
+    schema = reply_schema(("execute_code", "final_answer"))
+    action = schema["properties"]["action"]
+    assert action["properties"]["name"]["enum"] == ["execute_code", "final_answer"]
+    assert schema["required"] == ["thought", "action"]
+    assert schema["additionalProperties"] is False
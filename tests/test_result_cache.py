@@ -0,0 +1,63 @@
+import os
+import time
+
+from app.result_cache import ResultCache, LOW_WATER_RATIO
+
+
+def entry(n):
+    return {"status": "ok", "stdout": "x" * n}
+
+
+def disk_bytes(cache):
+    return sum(size for _, size, _ in cache._scan())
+
+
+def test_running_total_scans_once(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 6)
+    scans = []
+    original = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or original())
+    for i in range(20):
+        cache.put(f"{i:064x}", entry(100))
+    assert len(scans) == 1
+    assert cache.total_bytes == disk_bytes(cache)
+
+
+def test_overwrite_does_not_double_count(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 6)
+    key = "ab" * 32
+    cache.put(key, entry(100))
+    cache.put(key, entry(300))
+    assert cache.total_bytes == disk_bytes(cache)
+    assert cache.get(key)["stdout"] == "x" * 300
+
+
+def test_evicts_least_recently_used_to_low_water(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=2000)
+    keys = [f"{i:064x}" for i in range(5)]
+    for i, key in enumerate(keys):
+        cache.put(key, entry(300))
+        path = cache._path(key)
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    # 读取会刷新最近使用时间
+    assert cache.get(keys[0]) is not None
+    cache.put("f" * 64, entry(300))
+
+    assert cache.total_bytes == disk_bytes(cache)
+    assert cache.total_bytes <= 2000 * LOW_WATER_RATIO
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get("f" * 64) is not None
+    assert cache.get_stats()["evictions"] > 0
+
+
+def test_external_deletion_is_corrected_on_next_scan(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1500)
+    keys = [f"{i:064x}" for i in range(5)]
+    for key in keys[:4]:
+        cache.put(key, entry(300))
+    # 外部删除后累计值偏大，超过上限时扫描校正，实际未超限就不淘汰
+    os.remove(cache._path(keys[0]))
+    cache.put(keys[4], entry(300))
+    assert cache.total_bytes == disk_bytes(cache)
+    assert cache.get_stats()["evictions"] == 0
@@ -0,0 +1,81 @@
+import time
+import threading
+from collections import OrderedDict
+
+from app import scheduler
+from app.scheduler import ExecutionScheduler, _Ticket
+
+NOW = 1000.0
+
+
+def ticket(seq, user_id, cost, waited=0.0):
+    t = _Ticket(seq, user_id, cost)
+    t.enqueued_at = NOW - waited
+    return t
+
+
+def queues(*tickets):
+    result = OrderedDict()
+    for t in tickets:
+        result.setdefault(t.user_id, []).append(t)
+    return result
+
+
+def drain(pending):
+    order = []
+    while True:
+        t = ExecutionScheduler()._pick(pending, NOW)
+        if t is None:
+            return order
+        order.append(t.seq)
+
+
+def test_users_alternate_regardless_of_cost():
+    # alice 不断提交便宜的任务，也不能让 bob 的昂贵任务一直等待
+    pending = queues(
+        ticket(1, "alice", 1), ticket(2, "alice", 1), ticket(3, "alice", 1),
+        ticket(4, "bob", 50), ticket(5, "bob", 60),
+    )
+    assert drain(pending) == [1, 4, 2, 5, 3]
+
+
+def test_cheaper_cell_first_within_one_user():
+    pending = queues(ticket(1, "alice", 5), ticket(2, "alice", 1), ticket(3, "bob", 4))
+    assert drain(pending) == [2, 3, 1]
+
+
+def test_equal_priority_rotates_between_users():
+    pending = queues(ticket(1, "alice", 2), ticket(2, "alice", 2), ticket(3, "bob", 2), ticket(4, "bob", 2))
+    assert drain(pending) == [1, 3, 2, 4]
+
+
+def test_waiting_lowers_priority_within_user():
+    # 等待 20 秒抵消 40 的预估成本
+    assert drain(queues(ticket(1, "alice", 10), ticket(2, "alice", 45, waited=20))) == [2, 1]
+
+
+def test_overdue_ticket_goes_first(monkeypatch):
+    monkeypatch.setattr(scheduler, "MAX_QUEUE_WAIT", 30.0)
+    monkeypatch.setattr(scheduler, "AGING_PER_SECOND", 0.0)
+    pending = queues(ticket(1, "alice", 1), ticket(2, "alice", 1), ticket(3, "bob", 500, waited=31))
+    assert drain(pending) == [3, 1, 2]
+
+
+def test_cancelled_tickets_are_skipped():
+    cancelled = ticket(1, "alice", 1)
+    cancelled.cancelled = True
+    pending = queues(cancelled, ticket(2, "bob", 9))
+    assert drain(pending) == [2]
+    assert not pending
+
+
+def test_position_updates_are_one_based_until_granted():
+    sched = ExecutionScheduler(max_workers=1)
+    updates = []
+    holder = sched.acquire("alice", "print(1)")
+    waiter = threading.Thread(target=lambda: sched.release(sched.acquire("bob", "print(2)", on_update=updates.append)))
+    waiter.start()
+    time.sleep(0.3)
+    sched.release(holder)
+    waiter.join(timeout=5)
+    assert [update["position"] for update in updates] == [1, 0]